@@ -11,7 +11,8 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        REQUIRE_IF_MATCH=False
     )
     
     if test_config is None:
@@ -26,10 +27,33 @@ def create_app(test_config=None):
     
     db.init_app(app)
 
+    from . import engine
+    engine.init_app(app)
+
+    from .schemas import schemas
+    schemas.init_app(app)
+
+    from . import instrumentation
+    instrumentation.init_app(app)
+
+    from . import profiling
+    profiling.init_app(app)
+
+    from . import slowlog
+    slowlog.init_app(app)
+
+    from . import cache
+    cache.init_app(app)
+
+    from . import sweep
+    sweep.init_app(app)
+
     from . import models
     app.cli.add_command(models.init_db_command)
     app.cli.add_command(models.reset_db_command)
     app.cli.add_command(models.clear_db_command)
+    app.cli.add_command(models.upgrade_db_command)
+    app.cli.add_command(models.generate_db_command)
 
     from . import api
     app.register_blueprint(api.api_bp)
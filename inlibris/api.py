@@ -2,28 +2,38 @@ import json
 from flask import Blueprint, request, Response, redirect
 from flask_restful import Resource, Api
 from inlibris.constants import *
-from inlibris.utils import LibraryBuilder
+from inlibris.utils import LibraryBuilder, create_error_response, prefers_schema_urls, SCHEMA_URL_PREFERENCE
+from inlibris.schemas import schemas
+from inlibris.cache import get_cache
+from inlibris.instrumentation import get_metrics
 
 root_bp = Blueprint("root", __name__, url_prefix="", static_folder="static")
 api_bp = Blueprint("api", __name__, url_prefix="/inlibris/api", static_folder="static")
 api = Api(api_bp)
 
-from inlibris.resources.patron import PatronItem, PatronCollection
-from inlibris.resources.book import BookItem, BookCollection
-from inlibris.resources.loan import LoanItem, LoansByPatron
+from inlibris.resources.patron import PatronItem, PatronCollection, PatronSearch
+from inlibris.resources.book import BookItem, BookCollection, BookSearch
+from inlibris.resources.loan import LoanItem, LoanRenewal, LoansByPatron
+from inlibris.resources.circulation import CheckoutsByPatron, Checkins
 from inlibris.resources.hold import HoldItem, HoldsOnBook, HoldsByPatron
 
 '''
 Connect all the resources to their URIs.
 '''
 api.add_resource(PatronCollection, "/patrons/")
+api.add_resource(PatronSearch, "/patrons/search/")
 api.add_resource(PatronItem, "/patrons/<patron_id>/")
 
 api.add_resource(BookCollection, "/books/")
+api.add_resource(BookSearch, "/books/search/")
 api.add_resource(BookItem, "/books/<book_id>/")
 
 api.add_resource(LoansByPatron, "/patrons/<patron_id>/loans/")
 api.add_resource(LoanItem, "/books/<book_id>/loan/")
+api.add_resource(LoanRenewal, "/books/<book_id>/loan/renew/")
+
+api.add_resource(CheckoutsByPatron, "/patrons/<patron_id>/checkouts/")
+api.add_resource(Checkins, "/checkins/")
 
 api.add_resource(HoldsOnBook, "/books/<book_id>/holds/")
 api.add_resource(HoldsByPatron, "/patrons/<patron_id>/holds/")
@@ -39,8 +49,72 @@ def api_entrypoint():
     body.add_namespace("inlibris", LINK_RELATIONS_URL)
     body.add_control_all_patrons()
     body.add_control_all_books()
+    body.add_control_search_patrons()
+    body.add_control_search_books()
+    body.add_control_checkin()
     return Response(json.dumps(body), 200, mimetype=MASON)
 
+@api_bp.route("/_cache/")
+def cache_stats():
+    """
+    Hit and miss counters of the response cache of this process.
+    """
+    return Response(json.dumps(get_cache().stats()), 200, mimetype="application/json")
+
+@api_bp.route("/_metrics")
+def metrics():
+    """
+    Request metrics and response cache counters of this process in the
+    Prometheus text format.
+    """
+    stats = get_cache().stats()
+    lines = [
+        "# HELP inlibris_response_cache_hits_total Response cache hits.",
+        "# TYPE inlibris_response_cache_hits_total counter",
+        "inlibris_response_cache_hits_total {}".format(stats["hits"]),
+        "# HELP inlibris_response_cache_misses_total Response cache misses.",
+        "# TYPE inlibris_response_cache_misses_total counter",
+        "inlibris_response_cache_misses_total {}".format(stats["misses"]),
+        "# HELP inlibris_response_cache_entries Entries in the response cache.",
+        "# TYPE inlibris_response_cache_entries gauge",
+        "inlibris_response_cache_entries {}".format(stats["entries"]),
+    ]
+    body = get_metrics().render() + "\n".join(lines) + "\n"
+    return Response(body, 200, mimetype="text/plain; version=0.0.4")
+
+@api_bp.route("/schemas/<name>/<version>/")
+def schema(name, version):
+    """
+    A JSON schema of the controls. The version in the URL changes with the
+    schema, so the response can be cached for good. Only the current version
+    of each schema is served.
+    """
+    try:
+        data, current = schemas.source(name)
+    except KeyError:
+        current = None
+    if version != current:
+        return create_error_response(404,
+            "Schema not found",
+            None
+        )
+
+    response = Response(data, 200, mimetype="application/schema+json")
+    response.set_etag(current)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@api_bp.after_request
+def add_preference_headers(response):
+    """
+    The Mason documents of the API, and so their ETags, differ by the
+    "Prefer" header of the request, so caches must keep them apart.
+    """
+    response.vary.add("Prefer")
+    if response.mimetype == MASON and prefers_schema_urls():
+        response.headers["Preference-Applied"] = SCHEMA_URL_PREFERENCE
+    return response
+
 @root_bp.route(LINK_RELATIONS_URL)
 def namespace():
     return redirect(APIARY_URL + "link-relations/", 200)
@@ -0,0 +1,243 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import Response, current_app, has_app_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from inlibris.utils import embed_names, with_embedded, prefers_schema_urls
+
+'''
+In-process cache for rendered GET responses. Cached entries are tagged with
+the entities they were built from (e.g. "book" for any book collection page
+and "book:1" for book 1), and committing a write through the ORM session
+invalidates the tags of the rows it wrote, so only the affected entries are
+dropped.
+
+Writes made by other processes (other workers, CLI commands) can't invalidate
+this cache, which is why the entries also expire after RESPONSE_CACHE_TTL
+seconds.
+'''
+
+CacheEntry = namedtuple("CacheEntry", ["data", "etag", "mimetype"])
+
+class LRUCache(object):
+    """
+    Cache backend that holds at most "max_entries" entries and drops the
+    least recently used one when full. Entries older than "ttl" seconds are
+    treated as missing.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, entry, tags, generation):
+        """
+        Store "entry" under "key". "generation" is the value of the generation
+        attribute from before the entry was built. If anything was
+        invalidated since then the entry may be stale and is not stored.
+        """
+
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (entry, time.monotonic() + self.ttl, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries)
+        }
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+class NullCache(LRUCache):
+    """
+    Cache backend that never stores anything. Still counts the misses.
+    """
+
+    def set(self, key, entry, tags, generation):
+        pass
+
+CACHE_BACKENDS = {
+    "lru": LRUCache,
+    "null": NullCache,
+}
+
+def init_app(app):
+    """
+    Create the cache backend of the app. RESPONSE_CACHE_BACKEND is either the
+    name of one of the CACHE_BACKENDS or a class with the same interface.
+    """
+
+    app.config.setdefault("RESPONSE_CACHE_BACKEND", "lru")
+    app.config.setdefault("RESPONSE_CACHE_SIZE", 1024)
+    app.config.setdefault("RESPONSE_CACHE_TTL", 60)
+
+    backend = app.config["RESPONSE_CACHE_BACKEND"]
+    if isinstance(backend, str):
+        backend = CACHE_BACKENDS[backend]
+    app.extensions["response_cache"] = backend(
+        max_entries=app.config["RESPONSE_CACHE_SIZE"],
+        ttl=app.config["RESPONSE_CACHE_TTL"]
+    )
+
+def get_cache():
+    return current_app.extensions["response_cache"]
+
+def _tag_values(kwargs):
+    # The ids in the URLs are strings, so "/books/01/" gives "01". The tags of
+    # the writes are made from the integer ids, so the ids are normalized to
+    # match them.
+    values = {}
+    for name, value in kwargs.items():
+        if isinstance(value, str) and value.isascii() and value.isdigit():
+            value = int(value)
+        values[name] = value
+    return values
+
+def cached(*tags, embed=None):
+    """
+    Decorator for resource GET methods that serves 200 responses from the
+    cache. "tags" are formatted with the keyword arguments of the method, so
+    "book:{book_id}" becomes "book:1" for book 1, also when it was requested
+    as "/books/01/". Should be applied on top of the conditional decorator, so
+    that the ETag is cached with the body and a cache hit can also answer
+    "If-None-Match" without touching the database.
+
+    "embed" maps the names accepted in the "embed" query parameter to the
+    extra tags of the embedded documents.
+
+    The responses are cached by their path and query, and by whether the
+    schemas of the controls are inline or linked (see prefers_schema_urls).
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            key = request.full_path
+            if prefers_schema_urls():
+                key += " schemaurl"
+            entry = cache.get(key)
+            if entry is not None:
+                if entry.etag is not None and request.if_none_match.contains_weak(entry.etag):
+                    response = Response(status=304)
+                else:
+                    response = Response(entry.data, 200, mimetype=entry.mimetype)
+                if entry.etag is not None:
+                    response.set_etag(entry.etag)
+                response.headers["X-Cache"] = "HIT"
+                return response
+
+            generation = cache.generation
+            response = method(*args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                etag, _ = response.get_etag()
+                cache.set(
+                    key,
+                    CacheEntry(response.get_data(), etag, response.mimetype),
+                    [tag.format(**_tag_values(kwargs)) for tag in with_embedded(tags, embed or {}, embed_names())],
+                    generation
+                )
+            response.headers["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
+
+'''
+Invalidating the cache when writes are committed.
+'''
+
+# Loans and holds are embedded in the documents of their patron and book, so
+# writing one also invalidates e.g. "patron:2" and "book:1".
+EMBEDDED_IN = ("patron_id", "book_id")
+
+def _row_tags(obj):
+    table = obj.__tablename__
+    tags = [table, "{}:{}".format(table, obj.id)]
+    state = inspect(obj)
+    for column in EMBEDDED_IN:
+        if column not in state.attrs:
+            continue
+        # Both the old and the new parent when the row was moved
+        history = state.attrs[column].history
+        for value in history.sum() or [getattr(obj, column)]:
+            if value is not None:
+                tags.append("{}:{}".format(column[:-len("_id")], value))
+    return tags
+
+def invalidate_on_commit(session, *objs):
+    """
+    Invalidate the tags of "objs" when "session" commits. For rows written
+    with SQL statements that bypass the ORM, which the session can't see.
+    """
+
+    tags = session.info.setdefault("cache_tags", set())
+    for obj in objs:
+        tags.update(_row_tags(obj))
+
+@event.listens_for(Session, "after_flush")
+def _collect_tags(session, flush_context):
+    tags = session.info.setdefault("cache_tags", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tags.update(_row_tags(obj))
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_tags(session):
+    tags = session.info.pop("cache_tags", None)
+    if tags and has_app_context() and "response_cache" in current_app.extensions:
+        get_cache().invalidate(tags)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_tags(session, previous_transaction):
+    session.info.pop("cache_tags", None)
@@ -5,4 +5,12 @@ LOAN_PROFILE = "/profiles/loan-profile/"
 HOLD_PROFILE = "/profiles/hold-profile/"
 ERROR_PROFILE = "/profiles/error-profile/"
 LINK_RELATIONS_URL = "/inlibris/link-relations/"
-APIARY_URL = "https://inlibris.docs.apiary.io/#reference/"
\ No newline at end of file
+APIARY_URL = "https://inlibris.docs.apiary.io/#reference/"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+MAX_SEARCH_TERMS = 10
+MAX_BATCH_KEYS = 100
+# Largest integer SQLite can store, larger query parameters can't be bound
+MAX_SQL_INTEGER = 2 ** 63 - 1
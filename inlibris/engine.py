@@ -0,0 +1,60 @@
+from sqlalchemy import event
+
+from inlibris import db
+
+'''
+SQLite connection tuning. The PRAGMAs of the profile selected with the config
+value SQLITE_PROFILE are set on every new connection of the app's engine.
+Single PRAGMAs can be overridden or added with the SQLITE_PRAGMAS dictionary,
+e.g. in instance/config.py:
+
+    SQLITE_PROFILE = "production"
+    SQLITE_PRAGMAS = {"busy_timeout": 10000}
+'''
+
+SQLITE_PROFILES = {
+    "default": {
+        "foreign_keys": "ON",
+    },
+    "production": {
+        # Readers don't block the writer and the writer doesn't block readers
+        "journal_mode": "WAL",
+        # In WAL mode the database can't get corrupted with NORMAL, only the
+        # last transactions can be lost on power failure
+        "synchronous": "NORMAL",
+        # Wait for the write lock (ms) instead of failing with "database is locked"
+        "busy_timeout": 5000,
+        # Read the database file through a 256 MiB memory map
+        "mmap_size": 268435456,
+        # 64 MiB page cache per connection (negative values are KiB)
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    },
+}
+
+def profile_pragmas(app):
+    """
+    Return the PRAGMAs to set for the app as a dictionary.
+    """
+
+    pragmas = dict(SQLITE_PROFILES[app.config["SQLITE_PROFILE"]])
+    pragmas.update(app.config["SQLITE_PRAGMAS"])
+    return pragmas
+
+def init_app(app):
+    app.config.setdefault("SQLITE_PROFILE", "default")
+    app.config.setdefault("SQLITE_PRAGMAS", {})
+
+    engine = db.get_engine(app)
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = profile_pragmas(app)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
@@ -0,0 +1,167 @@
+import random
+from datetime import datetime, timedelta
+
+from inlibris import db
+from inlibris.models import Patron, Book, Loan, Hold, TRACKED_TABLES, bump_versions
+from inlibris.holds import ON_HOLD, REQUESTED, PICKUP_DAYS
+
+'''
+Generator for large synthetic datasets, used to reproduce production-scale
+performance problems locally. The rows are built from a seeded random number
+generator, so the same arguments always give the same database, and they are
+written with batched Core inserts instead of ORM objects.
+
+The barcode ranges of the schemas (100000-199999 for patrons, 200000-299999
+for books) limit both patrons and books to 100000 rows. Larger datasets get
+their size from the holds, which have no such limit.
+'''
+
+MAX_PATRONS = 100000
+MAX_BOOKS = 100000
+
+FIRSTNAMES = [
+    "Aino", "Eino", "Helmi", "Ilmari", "Kaarina", "Lauri", "Maija", "Niilo",
+    "Oona", "Pekka", "Riikka", "Sakari", "Tuuli", "Veikko", "Sally", "Sydney",
+]
+LASTNAMES = [
+    "Aaltonen", "Heikkinen", "Kinnunen", "Korhonen", "Laine", "Makela",
+    "Nieminen", "Rantanen", "Salminen", "Virtanen", "Stover", "Springer",
+]
+TITLE_WORDS = [
+    "maailma", "hotelli", "karhu", "joki", "yo", "sankari", "talvi", "meri",
+    "kirja", "ystava", "kaupunki", "metsa", "tarina", "kesa", "valo", "tie",
+]
+FORMATS = ["book"] * 8 + ["CD", "DVD"]
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _patrons(rng, count, today):
+    barcodes = rng.sample(range(100000, 100000 + MAX_PATRONS), count)
+    for i, barcode in enumerate(barcodes):
+        firstname = rng.choice(FIRSTNAMES)
+        lastname = rng.choice(LASTNAMES)
+        yield {
+            "id": i + 1,
+            "barcode": barcode,
+            "firstname": firstname,
+            "lastname": lastname,
+            "email": "{}.{}{}@example.com".format(firstname.lower(), lastname.lower(), i + 1),
+            "group": "Staff" if rng.random() < 0.01 else "Customer",
+            "status": "Active",
+            "regdate": today - timedelta(days=rng.randint(0, 20 * 365)),
+        }
+
+def _books(rng, count, today):
+    barcodes = rng.sample(range(200000, 200000 + MAX_BOOKS), count)
+    for i, barcode in enumerate(barcodes):
+        words = rng.sample(TITLE_WORDS, rng.randint(1, 4))
+        yield {
+            "id": i + 1,
+            "barcode": barcode,
+            "title": " ".join(words).capitalize(),
+            "author": "{}, {}".format(rng.choice(LASTNAMES), rng.choice(FIRSTNAMES)),
+            "pubyear": rng.randint(1950, today.year),
+            "format": rng.choice(FORMATS),
+            "description": "ISBN 978-951-{}-{}".format(rng.randint(10, 99), rng.randint(1000, 9999)),
+            "loantime": rng.choice((14, 28, 28, 28)),
+            "renewlimit": 10,
+        }
+
+def _loans(rng, count, patrons, books, today, loaned):
+    # Some patrons borrow much more than others, so the patron ids are skewed
+    # towards the small end. The ids of the loaned books are added to
+    # "loaned" for the holds.
+    for i, book_id in enumerate(rng.sample(range(1, books + 1), count)):
+        loaned.add(book_id)
+        loandate = today - timedelta(days=rng.randint(0, 60))
+        renewed = rng.choice((0, 0, 0, 1, 2))
+        yield {
+            "id": i + 1,
+            "book_id": book_id,
+            "patron_id": int(patrons * rng.random() ** 2) + 1,
+            "loandate": loandate,
+            "renewaldate": loandate + timedelta(days=14) if renewed else None,
+            "duedate": loandate + timedelta(days=28 * (renewed + 1)),
+            "renewed": renewed,
+            "status": "Renewed" if renewed else "Charged",
+        }
+
+def _holds(rng, count, patrons, books, today, loaned):
+    # A few popular titles collect most of the holds. As in the API, the first
+    # hold on a book that is not loaned is kept for pickup and the rest wait
+    # in the queue.
+    queued = set()
+    for i in range(count):
+        holddate = today - timedelta(days=rng.randint(0, 90))
+        book_id = int(books * rng.random() ** 3) + 1
+        on_hold = book_id not in loaned and book_id not in queued
+        queued.add(book_id)
+        yield {
+            "id": i + 1,
+            "book_id": book_id,
+            "patron_id": rng.randint(1, patrons),
+            "holddate": holddate,
+            "expirationdate": holddate + timedelta(days=45),
+            "pickupdate": today + timedelta(days=PICKUP_DAYS) if on_hold else None,
+            "status": ON_HOLD if on_hold else REQUESTED,
+        }
+
+def validate_args(patrons, books, loans_ratio):
+    """
+    Check the arguments of generate_db. Raises ValueError if there are more
+    patrons or books than barcodes or the loans ratio is not a share.
+    """
+
+    if not 0 < patrons <= MAX_PATRONS:
+        raise ValueError("The number of patrons must be between 1 and {}".format(MAX_PATRONS))
+    if not 0 < books <= MAX_BOOKS:
+        raise ValueError("The number of books must be between 1 and {}".format(MAX_BOOKS))
+    if not 0 <= loans_ratio <= 1:
+        raise ValueError("The loans ratio must be between 0 and 1")
+
+def generate_db(patrons, books, loans_ratio=0.3, holds_ratio=0.5, seed=0,
+                batch_size=10000, today=None):
+    """
+    Insert "patrons" patrons and "books" books into empty tables, loan
+    "loans_ratio" of the books and place "holds_ratio" holds per book. Dates
+    are relative to the date "today" (default: the current date), so the same
+    seed and date always give the same rows. Returns the number of rows
+    inserted into each table as a dictionary.
+
+    Raises ValueError if there are more patrons or books than barcodes.
+    """
+
+    validate_args(patrons, books, loans_ratio)
+
+    rng = random.Random(seed)
+    today = datetime.combine(today or datetime.now().date(), datetime.min.time())
+    counts = {
+        "patron": patrons,
+        "book": books,
+        "loan": int(books * loans_ratio),
+        "hold": int(books * holds_ratio),
+    }
+    # The loans are inserted before the holds are generated
+    loaned = set()
+    tables = [
+        (Patron.__table__, _patrons(rng, patrons, today)),
+        (Book.__table__, _books(rng, books, today)),
+        (Loan.__table__, _loans(rng, counts["loan"], patrons, books, today, loaned)),
+        (Hold.__table__, _holds(rng, counts["hold"], patrons, books, today, loaned)),
+    ]
+
+    with db.engine.begin() as connection:
+        for table, rows in tables:
+            for batch in _batches(rows, batch_size):
+                connection.execute(table.insert(), batch)
+        bump_versions(connection, TRACKED_TABLES)
+
+    return counts
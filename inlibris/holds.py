@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, exists, func, select
+from sqlalchemy.orm import aliased
+
+from inlibris.models import Loan, Hold
+from inlibris import db
+
+'''
+The hold queue of each book. Holds wait in the queue as "Requested" in the
+order they were placed (by id). When the book is free, the first of them is
+promoted to "On hold" and the book is kept for that patron until the pickup
+date. A book has at most one hold "On hold" at a time.
+
+Every operation is a lookup or a range scan of the index on (book_id, status,
+id) of the hold table, so none of them reads the whole queue of a busy title.
+The changes are made through the session of the caller and committed with
+the rest of its changes, e.g. the promotion with the return of the loan.
+'''
+
+REQUESTED = "Requested"
+ON_HOLD = "On hold"
+EXPIRED = "Expired"
+ACTIVE_STATUSES = (ON_HOLD, REQUESTED)
+
+# Days a hold stays in the queue unless the patron gives an expiration date
+EXPIRATION_DAYS = 45
+
+# Days the patron has to pick up the book after the hold is promoted
+PICKUP_DAYS = 7
+
+def queue_position():
+    """
+    Column expression for the place of a hold in the queue of its book: the
+    number of requested holds placed before it. Add one to get the position
+    of a requested hold.
+    """
+
+    ahead = aliased(Hold)
+    return (select([func.count(ahead.id)])
+        .where(and_(
+            ahead.book_id == Hold.book_id,
+            ahead.status == REQUESTED,
+            ahead.id < Hold.id
+        ))
+        .correlate(Hold)
+        .label("position")
+    )
+
+def position_of(hold, ahead):
+    """
+    The 1-based position of a requested hold, 0 for a hold that is ready for
+    pickup and None for any other hold.
+    """
+
+    if hold.status == ON_HOLD:
+        return 0
+    if hold.status == REQUESTED:
+        return ahead + 1
+    return None
+
+def promote_next_holds(book_ids, today=None):
+    """
+    Promote the first requested hold of each of "book_ids" that is not loaned
+    and has no hold on it yet. Returns the promoted holds.
+    """
+
+    if not book_ids:
+        return []
+    today = today or datetime.now()
+
+    on_hold = aliased(Hold)
+    first = (db.session.query(func.min(Hold.id))
+        .filter(Hold.book_id.in_(book_ids), Hold.status == REQUESTED)
+        .filter(~exists().where(Loan.book_id == Hold.book_id))
+        .filter(~exists().where(and_(on_hold.book_id == Hold.book_id, on_hold.status == ON_HOLD)))
+        .group_by(Hold.book_id)
+    )
+    holds = Hold.query.filter(Hold.id.in_(first)).all()
+    for hold in holds:
+        hold.status = ON_HOLD
+        hold.pickupdate = today + timedelta(days=PICKUP_DAYS)
+    return holds
+
+def held_for_others(patron_id, book_ids):
+    """
+    The books of "book_ids" that are kept for pickup for another patron than
+    "patron_id", as a dictionary from book id to the hold. These can only be
+    loaned to the patron of the hold.
+    """
+
+    if not book_ids:
+        return {}
+    holds = (Hold.query
+        .filter(Hold.book_id.in_(book_ids), Hold.status == ON_HOLD)
+        .filter(Hold.patron_id != patron_id)
+        .all()
+    )
+    return dict((hold.book_id, hold) for hold in holds)
+
+def fulfill_holds(patron_id, book_ids):
+    """
+    Remove the holds of a patron on "book_ids" when the patron borrows them.
+    """
+
+    if not book_ids:
+        return
+    holds = (Hold.query
+        .filter(Hold.book_id.in_(book_ids))
+        .filter(Hold.patron_id == patron_id, Hold.status.in_(ACTIVE_STATUSES))
+        .all()
+    )
+    for hold in holds:
+        db.session.delete(hold)
@@ -0,0 +1,239 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from collections import deque
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from inlibris import db
+
+'''
+Request instrumentation. Hooks into the SQLAlchemy engine of the app to count
+the SQL statements that each request runs. The count can be added to the
+responses as the "X-Query-Count" header by setting the config value
+QUERY_COUNT_HEADER, which lets the tests assert a fixed query budget per
+endpoint.
+
+With the config value METRICS (on by default) the latency, SQL statements
+and time, response size and status code of every API request are also
+recorded per resource class and method, and served in the Prometheus text
+format by the /inlibris/api/_metrics endpoint. Each thread records into its
+own shard of counters without locking, and the shards are only added up
+when the metrics are read. The shard of a finished thread is added to a
+single total of the finished threads.
+'''
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if has_request_context() and start is not None:
+        g.query_time = g.get("query_time", 0.0) + time.perf_counter() - start
+
+def query_count():
+    """
+    Return the number of SQL statements the current request has run so far.
+    """
+
+    return g.get("query_count", 0)
+
+class _Series(object):
+    """
+    The counters of one resource and method.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency = 0.0
+        self.count = 0
+        self.statuses = {}
+        self.size = 0
+        self.sized = 0
+        self.statements = 0
+        self.sql_time = 0.0
+
+    def observe(self, seconds, status, size, statements, sql_time):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency += seconds
+        self.count += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if size is not None:
+            self.size += size
+            self.sized += 1
+        self.statements += statements
+        self.sql_time += sql_time
+
+    def add(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.latency += other.latency
+        self.count += other.count
+        for status, count in list(other.statuses.items()):
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.size += other.size
+        self.sized += other.sized
+        self.statements += other.statements
+        self.sql_time += other.sql_time
+
+class Metrics(object):
+    """
+    Request metrics of an app, recorded into one shard per thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = {}
+        self._finished = deque()
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            # Only taken once per thread
+            with self._lock:
+                self._fold_finished()
+                self._shards[id(shard)] = shard
+            weakref.finalize(threading.current_thread(), self._finished.append, shard)
+        return shard
+
+    def _fold_finished(self):
+        # The shards of finished threads are added to one total, so the
+        # counters never go down and a thread-per-request server doesn't keep
+        # a shard per request. The finalizers of the threads only append to
+        # the deque, because they can run in the garbage collector anywhere,
+        # also while the lock is held. Called with the lock held.
+        while self._finished:
+            shard = self._finished.popleft()
+            del self._shards[id(shard)]
+            for key, series in shard.items():
+                self._retired.setdefault(key, _Series()).add(series)
+
+    def observe(self, resource, method, seconds, status, size, statements, sql_time):
+        shard = self._shard()
+        series = shard.get((resource, method))
+        if series is None:
+            series = shard[(resource, method)] = _Series()
+        series.observe(seconds, status, size, statements, sql_time)
+
+    def collect(self):
+        """
+        Add up the shards. Returns a dictionary from (resource, method) to
+        the totals.
+        """
+
+        totals = {}
+        with self._lock:
+            self._fold_finished()
+            shards = list(self._shards.values())
+            for key, series in self._retired.items():
+                totals.setdefault(key, _Series()).add(series)
+        for shard in shards:
+            for key, series in list(shard.items()):
+                totals.setdefault(key, _Series()).add(series)
+        return totals
+
+    def render(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+
+        totals = sorted(self.collect().items())
+        lines = []
+
+        def header(name, kind, text):
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        def labels(resource, method, **extra):
+            pairs = [("resource", resource), ("method", method)] + sorted(extra.items())
+            return ",".join('{}="{}"'.format(key, value) for key, value in pairs)
+
+        name = "inlibris_request_duration_seconds"
+        header(name, "histogram", "Latency of the API requests.")
+        for (resource, method), series in totals:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), series.buckets):
+                cumulative += count
+                lines.append("{}_bucket{{{}}} {}".format(name, labels(resource, method, le=bound), cumulative))
+            lines.append("{}_sum{{{}}} {}".format(name, labels(resource, method), series.latency))
+            lines.append("{}_count{{{}}} {}".format(name, labels(resource, method), series.count))
+
+        name = "inlibris_requests_total"
+        header(name, "counter", "API requests by response status code.")
+        for (resource, method), series in totals:
+            for status, count in sorted(series.statuses.items()):
+                lines.append("{}{{{}}} {}".format(name, labels(resource, method, status=status), count))
+
+        name = "inlibris_response_size_bytes"
+        header(name, "summary", "Size of the API responses with a known length.")
+        for (resource, method), series in totals:
+            lines.append("{}_sum{{{}}} {}".format(name, labels(resource, method), series.size))
+            lines.append("{}_count{{{}}} {}".format(name, labels(resource, method), series.sized))
+
+        name = "inlibris_sql_statements_total"
+        header(name, "counter", "SQL statements run by the API requests.")
+        for (resource, method), series in totals:
+            lines.append("{}{{{}}} {}".format(name, labels(resource, method), series.statements))
+
+        name = "inlibris_sql_duration_seconds_total"
+        header(name, "counter", "Time spent in SQL statements by the API requests.")
+        for (resource, method), series in totals:
+            lines.append("{}{{{}}} {}".format(name, labels(resource, method), series.sql_time))
+
+        return "\n".join(lines) + "\n"
+
+def get_metrics():
+    return current_app.extensions["metrics"]
+
+def _resource_name():
+    # The name of the Resource class of Flask-RESTful views, otherwise the
+    # name of the view function
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, "view_class", None)
+    if view_class is not None:
+        return view_class.__name__
+    return request.endpoint.rsplit(".", 1)[-1]
+
+def init_app(app):
+    app.config.setdefault("QUERY_COUNT_HEADER", False)
+    app.config.setdefault("METRICS", True)
+    engine = db.get_engine(app)
+    event.listen(engine, "before_cursor_execute", _before_query)
+    event.listen(engine, "after_cursor_execute", _after_query)
+    app.extensions["metrics"] = Metrics()
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def add_query_count_header(response):
+        if app.config["QUERY_COUNT_HEADER"]:
+            response.headers["X-Query-Count"] = str(query_count())
+        return response
+
+    @app.after_request
+    def record_metrics(response):
+        # Only the requests to the API, streamed responses until the response
+        # starts
+        if app.config["METRICS"] and request.blueprint == "api" and "request_start" in g:
+            get_metrics().observe(
+                _resource_name(),
+                request.method,
+                time.perf_counter() - g.request_start,
+                response.status_code,
+                None if response.is_streamed else response.calculate_content_length(),
+                query_count(),
+                g.get("query_time", 0.0)
+            )
+        return response
@@ -1,16 +1,31 @@
 import click
 import json
 import re
+import time
 from datetime import datetime
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
 from flask.cli import with_appcontext
+from sqlalchemy import collate, event, inspect, select, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
 from inlibris import db
 
 '''
 CLI commands are defined here. They are added to the App in the __init__.py file.
 '''
 
+def _drop_all():
+    # Reflecting also picks up the internal tables of SQLite, such as the
+    # sqlite_stat1 table that ANALYZE creates, and the full-text search
+    # tables, which can't be dropped or created like the others.
+    drop_book_search(db.engine)
+    db.reflect()
+    for table in list(db.metadata.tables.values()):
+        if table.name.startswith("sqlite_"):
+            db.metadata.remove(table)
+    db.drop_all()
+
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
@@ -22,8 +37,7 @@ def init_db_command():
 @click.command("reset-db")
 @with_appcontext
 def reset_db_command():
-    db.reflect()
-    db.drop_all()
+    _drop_all()
     db.create_all()
     from tests.utils import _populate_db
     _populate_db(db)
@@ -32,11 +46,75 @@ def reset_db_command():
 @click.command("clear-db")
 @with_appcontext
 def clear_db_command():
-    db.reflect()
-    db.drop_all()
+    _drop_all()
     db.create_all()
     click.echo('Cleared the database.')
 
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    added, created = upgrade_db()
+    click.echo('Upgraded the database: added {} columns, created {} indexes.'.format(len(added), len(created)))
+
+@click.command("generate-db")
+@click.option("--patrons", default=1000, show_default=True, help="Number of patrons (max 100000).")
+@click.option("--books", default=10000, show_default=True, help="Number of books (max 100000).")
+@click.option("--loans-ratio", default=0.3, show_default=True, help="Share of the books that are loaned.")
+@click.option("--holds-ratio", default=0.5, show_default=True, help="Holds per book.")
+@click.option("--seed", default=0, show_default=True, help="Seed of the random number generator.")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows per INSERT.")
+@with_appcontext
+def generate_db_command(patrons, books, loans_ratio, holds_ratio, seed, batch_size):
+    from inlibris.generate import generate_db, validate_args
+    # Checked before dropping anything, so a typo can't empty the database
+    try:
+        validate_args(patrons, books, loans_ratio)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    _drop_all()
+    db.create_all()
+    counts = generate_db(patrons, books, loans_ratio, holds_ratio, seed, batch_size)
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+    click.echo('Generated the database: {patron} patrons, {book} books, {loan} loans, {hold} holds.'.format(**counts))
+
+def upgrade_db():
+    """
+    Bring an existing database up to date with the models without touching
+    the data: create missing tables, the missing columns (which must have a
+    server default or be nullable) and the missing indexes of existing
+    tables, then refresh the statistics the query planner uses. Returns the
+    names of the added columns as "table.column" and the names of the
+    created indexes, including the full-text index "book_fts".
+    """
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                db.session.execute(text("ALTER TABLE {} ADD COLUMN {}".format(table.name, ddl)))
+                added.append("{}.{}".format(table.name, column.name))
+    db.session.commit()
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+    if db.engine.dialect.name == "sqlite" and "book_fts" not in inspector.get_table_names():
+        with db.engine.begin() as connection:
+            create_book_search(connection, rebuild=True)
+        created.append("book_fts")
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+    return added, created
+
 '''
 All database models are defined here.
 '''
@@ -50,10 +128,19 @@ class Patron(db.Model):
     group = db.Column(db.String(64), nullable=False, default="Customer")
     status = db.Column(db.String(64), nullable=False, default="Active")
     regdate = db.Column(db.DateTime, nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
     
     loans = db.relationship("Loan", back_populates="patron")
     holds = db.relationship("Hold", back_populates="patron")
 
+    __mapper_args__ = {"version_id_col": version}
+
+# Prefix searches of patrons by name and email. LIKE is case-insensitive in
+# SQLite, so it can only use indexes with the NOCASE collation.
+db.Index("ix_patron_firstname_nocase", collate(Patron.firstname, "NOCASE"))
+db.Index("ix_patron_lastname_nocase", collate(Patron.lastname, "NOCASE"))
+db.Index("ix_patron_email_nocase", collate(Patron.email, "NOCASE"))
+
 class Book(db.Model):
     id = db.Column(db.Integer, unique=True, nullable=False, primary_key=True)
     barcode = db.Column(db.Integer, unique=True, nullable=False)
@@ -64,31 +151,194 @@ class Book(db.Model):
     description = db.Column(db.String(512), nullable=False, default="")
     loantime = db.Column(db.Integer, nullable=False, default=28)
     renewlimit = db.Column(db.Integer, nullable=False, default=10)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
     
     loan = db.relationship("Loan", cascade="all, delete-orphan", back_populates="book")
     holds = db.relationship("Hold", cascade="all, delete-orphan", back_populates="book")
 
+    __mapper_args__ = {"version_id_col": version}
+
 class Loan(db.Model):
     id = db.Column(db.Integer, unique=True, nullable=False, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey("book.id", ondelete="CASCADE"), unique=True)
-    patron_id = db.Column(db.Integer, db.ForeignKey("patron.id"))
+    patron_id = db.Column(db.Integer, db.ForeignKey("patron.id"), index=True)
     loandate = db.Column(db.DateTime, nullable=False)
     renewaldate = db.Column(db.DateTime, default=None)
-    duedate = db.Column(db.DateTime, nullable=False)
+    duedate = db.Column(db.DateTime, nullable=False, index=True)
     renewed = db.Column(db.Integer, default=0, nullable=False)
     status = db.Column(db.String(64), default="Charged", nullable=False)
+    version = db.Column(db.Integer, nullable=False, server_default="1")
     
     book = db.relationship("Book", back_populates="loan")
     patron = db.relationship("Patron", back_populates="loans")
 
+    __table_args__ = (
+        # Finding overdue loans
+        db.Index("ix_loan_status_duedate", "status", "duedate"),
+    )
+    # UPDATEs and DELETEs through the session check the version of the row
+    # and bump it, so a write based on an old read fails with StaleDataError
+    __mapper_args__ = {"version_id_col": version}
+
 class Hold(db.Model):
     id = db.Column(db.Integer, unique=True, nullable=False, primary_key=True)
     book_id = db.Column(db.Integer, db.ForeignKey("book.id", ondelete="CASCADE"))
-    patron_id = db.Column(db.Integer, db.ForeignKey("patron.id"))
+    patron_id = db.Column(db.Integer, db.ForeignKey("patron.id"), index=True)
     holddate = db.Column(db.DateTime, nullable=False)
-    expirationdate = db.Column(db.DateTime, nullable=False)
+    expirationdate = db.Column(db.DateTime, nullable=False, index=True)
     pickupdate = db.Column(db.DateTime, default=None)
     status = db.Column(db.String(64), default="Requested", nullable=False)
     
     book = db.relationship("Book", back_populates="holds")
     patron = db.relationship("Patron", back_populates="holds")
+
+    __table_args__ = (
+        # Listing the holds on a book by status in the order they were placed,
+        # also serves the lookups by book_id alone (e.g. the cascade)
+        db.Index("ix_hold_book_id_status_id", "book_id", "status", "id"),
+        # Finding expired holds
+        db.Index("ix_hold_status_expirationdate", "status", "expirationdate"),
+    )
+
+class ChangeCounter(db.Model):
+    '''
+    A version counter for each of the tables above. A counter is bumped every
+    time its table is written through the ORM session, so a GET resource can
+    tell if its data may have changed by reading the counters instead of
+    querying and serializing the data.
+    '''
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+'''
+Keeping the change counters up to date.
+'''
+
+TRACKED_TABLES = ("patron", "book", "loan", "hold")
+
+# Deleting a row from the key table also deletes rows from these tables
+# through the ON DELETE CASCADE foreign keys.
+CASCADED_TABLES = {"book": ("loan", "hold")}
+
+def _initial_version():
+    # Counters start from the current time in milliseconds instead of zero,
+    # so an ETag from before the database was reset can't match again.
+    return int(time.time() * 1000)
+
+@event.listens_for(ChangeCounter.__table__, "after_create")
+def _insert_counters(target, connection, **kw):
+    version = _initial_version()
+    connection.execute(target.insert(), [
+        {"name": name, "version": version} for name in TRACKED_TABLES
+    ])
+
+def bump_versions(connection, tables):
+    """
+    Increment the change counters of "tables" using "connection". Writes that
+    bypass the ORM session (e.g. Core UPDATEs) must call this themselves.
+    """
+
+    counters = ChangeCounter.__table__
+    for name in sorted(tables):
+        result = connection.execute(
+            counters.update()
+            .where(counters.c.name == name)
+            .values(version=counters.c.version + 1)
+        )
+        if result.rowcount == 0:
+            connection.execute(counters.insert().values(name=name, version=_initial_version()))
+
+def get_versions(tables):
+    """
+    Read the change counters of "tables" in one query. Returns a list of
+    versions in the same order as "tables".
+    """
+
+    rows = dict(db.session.query(ChangeCounter.name, ChangeCounter.version)
+        .filter(ChangeCounter.name.in_(tables))
+        .all()
+    )
+    return [rows.get(name, 0) for name in tables]
+
+def get_row_versions(column, value, tables):
+    """
+    Read the id and version of the row of a versioned model whose "column"
+    equals "value", and the change counters of "tables", in one query.
+    Returns a tuple (id, version, counters), where the counters are in the
+    same order as "tables", or None if there is no such row.
+    """
+
+    model = column.class_
+    counters = [
+        select([ChangeCounter.version]).where(ChangeCounter.name == name).label(name)
+        for name in tables
+    ]
+    row = db.session.query(model.id, model.version, *counters).filter(column == value).first()
+    if row is None:
+        return None
+    return row[0], row[1], [version or 0 for version in row[2:]]
+
+@event.listens_for(Session, "after_flush")
+def _bump_flushed_tables(session, flush_context):
+    tables = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tables.add(obj.__tablename__)
+    for obj in session.deleted:
+        tables.update(CASCADED_TABLES.get(obj.__tablename__, ()))
+    tables.intersection_update(TRACKED_TABLES)
+    if tables:
+        bump_versions(session.connection(), tables)
+
+'''
+Full-text search of the book catalog. The FTS5 table book_fts indexes the
+title, author and description of the books without storing them a second
+time (an "external content" table), and the triggers keep it in sync with
+every write to the book table, including the ones that bypass the ORM.
+'''
+
+BOOK_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+        title, author, description, content='book', content_rowid='id'
+    )""",
+    # Weigh matches in the title over the author and the description
+    "INSERT INTO book_fts(book_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts(rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_update AFTER UPDATE OF title, author, description ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+        INSERT INTO book_fts(rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END""",
+]
+
+def create_book_search(connection, rebuild=False):
+    """
+    Create the full-text search table and its triggers. With "rebuild" the
+    books already in the database are indexed too.
+    """
+
+    for statement in BOOK_SEARCH_DDL:
+        connection.execute(text(statement))
+    if rebuild:
+        connection.execute(text("INSERT INTO book_fts(book_fts) VALUES ('rebuild')"))
+
+def drop_book_search(connection):
+    # The triggers are dropped with the book table
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS book_fts"))
+
+@event.listens_for(Book.__table__, "after_create")
+def _create_book_search(target, connection, **kw):
+    if connection.dialect.name == "sqlite":
+        create_book_search(connection)
+
+@event.listens_for(Book.__table__, "before_drop")
+def _drop_book_search(target, connection, **kw):
+    drop_book_search(connection)
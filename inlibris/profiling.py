@@ -0,0 +1,143 @@
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import time
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from inlibris import db
+
+'''
+On-demand profiling of single requests. When the config value
+PROFILING_SECRET is set, a request that carries the secret in the
+"X-Profile" header is run under cProfile and its SQL statements are
+recorded with their start times and durations. The secret is never read
+from the URL, which ends up in access logs. The profile is written to
+PROFILE_DIR (default: "profiles" in the instance folder) as a pstats dump,
+which can be opened with e.g. snakeviz, together with a text summary. The
+name of the files is returned in the "X-Profile" response header. Other
+requests only pay for one dictionary lookup.
+'''
+
+ENVIRON_KEY = "inlibris.profile"
+
+# Functions in the summary, by cumulative time
+SUMMARY_FUNCTIONS = 40
+
+class _Profile(object):
+    """
+    The SQL timeline of a profiled request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = []
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and context is not None:
+        profile = request.environ.get(ENVIRON_KEY)
+        if profile is not None:
+            context._profile_start = time.perf_counter()
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_profile_start", None)
+    if start is not None:
+        profile = request.environ[ENVIRON_KEY]
+        profile.statements.append((
+            start - profile.start,
+            time.perf_counter() - start,
+            " ".join(statement.split()),
+            parameters
+        ))
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware that profiles the requests with the secret. The whole
+    request is profiled, including the routing of Flask and the reading of
+    a streamed response.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def _requested(self, environ):
+        secret = self.app.config["PROFILING_SECRET"]
+        if not secret:
+            return False
+        given = environ.get("HTTP_X_PROFILE")
+        return given is not None and hmac.compare_digest(given.encode(), secret.encode())
+
+    def __call__(self, environ, start_response):
+        if not self._requested(environ):
+            return self.wsgi_app(environ, start_response)
+
+        profile = environ[ENVIRON_KEY] = _Profile()
+        started = {}
+        written = []
+
+        # The response is held back until the profile is written, so that
+        # its name can be sent in the headers
+        def capture_start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+            return written.append
+
+        def run():
+            iterable = self.wsgi_app(environ, capture_start_response)
+            try:
+                return b"".join(written) + b"".join(iterable)
+            finally:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+
+        profiler = cProfile.Profile()
+        body = profiler.runcall(run)
+        elapsed = time.perf_counter() - profile.start
+
+        name = self._write(environ, profiler, profile, started["status"], elapsed)
+        start_response(started["status"], list(started["headers"]) + [("X-Profile", name)])
+        return [body]
+
+    def _write(self, environ, profiler, profile, status, elapsed):
+        folder = self.app.config["PROFILE_DIR"]
+        os.makedirs(folder, exist_ok=True)
+        path = environ.get("PATH_INFO", "/")
+        name = "{}-{}{}".format(
+            datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+            environ.get("REQUEST_METHOD", "GET"),
+            path.replace("/", "_").rstrip("_")
+        )
+        profiler.dump_stats(os.path.join(folder, name + ".prof"))
+
+        summary = io.StringIO()
+        summary.write("{} {}?{} -> {}\n".format(
+            environ.get("REQUEST_METHOD"), path, environ.get("QUERY_STRING", ""), status
+        ))
+        sql_time = sum(duration for _, duration, _, _ in profile.statements)
+        summary.write("Total {:.2f} ms, {} SQL statements in {:.2f} ms\n\n".format(
+            elapsed * 1000, len(profile.statements), sql_time * 1000
+        ))
+        summary.write("SQL timeline (start ms, duration ms):\n")
+        for offset, duration, statement, parameters in profile.statements:
+            summary.write("{:9.2f} {:9.2f}  {}  {!r}\n".format(
+                offset * 1000, duration * 1000, statement, parameters
+            ))
+        summary.write("\n")
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats("cumulative").print_stats(SUMMARY_FUNCTIONS)
+        with open(os.path.join(folder, name + ".txt"), "w") as f:
+            f.write(summary.getvalue())
+        return name
+
+def init_app(app):
+    app.config.setdefault("PROFILING_SECRET", None)
+    app.config.setdefault("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+    engine = db.get_engine(app)
+    event.listen(engine, "before_cursor_execute", _before_query)
+    event.listen(engine, "after_cursor_execute", _after_query)
+    app.wsgi_app = ProfilingMiddleware(app, app.wsgi_app)
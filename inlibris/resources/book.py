@@ -1,12 +1,22 @@
-from flask import Response, request, url_for
+from flask import Response, request, url_for, stream_with_context
 from flask_restful import Resource
 from datetime import datetime
 import json
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import or_, text
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
 
-from inlibris.models import Book
-from inlibris.utils import LibraryBuilder, create_error_response
+from inlibris.models import Book, Loan, Hold
+from inlibris.utils import (
+    LibraryBuilder, book_item, patron_item, loan_item, hold_item, create_error_response,
+    conditional, check_if_match, row_etag, stale_response, update_from_json,
+    parse_embed_arg, parse_page_args, parse_key_list_arg, parse_search_args,
+    fetch_by_keys, keyset_page, stream_collection, fts_query
+)
+from inlibris.cache import cached
 from inlibris.constants import *
+from inlibris.schemas import schemas
 from inlibris import db
 
 class BookItem(Resource):
@@ -14,16 +24,34 @@ class BookItem(Resource):
     HTTP method implementations for the BookItem resource. Supports GET, PUT and DELETE.
     '''
 
+    @cached("book:{book_id}", embed={"loan": ("patron",), "holds": ("patron",), "patron": ("patron",)})
+    @conditional(embed={"loan": ("loan", "patron"), "holds": ("hold", "patron")}, row=(Book.id, "book_id"))
     def get(self, book_id):
         '''
-        Gets the information for a single book.
+        Gets the information for a single book. With the query parameter
+        "embed=loan,holds" the book's loan (null when not loaned) and holds
+        are included in the document, and with "patron" also the patron of
+        the loan and of each hold (null when the patron has been deleted).
 
-        Input: book_id
+        Input: book_id, optional query parameter "embed"
         Output HTTP responses:
             200 OK (when book_id is valid)
+            400 Bad Request (when embed is invalid)
             404 Not Found (when book_id is invalid)
         '''
-        book = Book.query.filter_by(id=book_id).first()
+        try:
+            embed = parse_embed_arg(("loan", "holds", "patron"))
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # Each embedded collection is loaded with one more query
+        query = Book.query
+        if "loan" in embed:
+            query = query.options(selectinload(Book.loan).joinedload(Loan.patron))
+        if "holds" in embed:
+            query = query.options(selectinload(Book.holds).joinedload(Hold.patron))
+
+        book = query.filter_by(id=book_id).first()
         if book is None:
             return create_error_response(404, "Not found", 
                 "No book was found with the id {}".format(book_id)
@@ -49,20 +77,37 @@ class BookItem(Resource):
         body.add_control_loan_of(book_id)
         body.add_control_edit_book(book_id)
         body.add_control_delete_book(book_id)
-        
+
+        if "loan" in embed:
+            body["loan"] = None
+            for loan in book.loan:
+                body["loan"] = loan_item(loan, book, loan.patron)
+                if "patron" in embed:
+                    body["loan"]["patron"] = None if loan.patron is None else patron_item(loan.patron)
+        if "holds" in embed:
+            body["holds"] = []
+            for hold in book.holds:
+                item = hold_item(hold, book, hold.patron)
+                if "patron" in embed:
+                    item["patron"] = None if hold.patron is None else patron_item(hold.patron)
+                body["holds"].append(item)
+
         return Response(json.dumps(body), 200, mimetype=MASON)
 
     def put(self, book_id):
         '''
-        Edit a book.
+        Edit a book. With an "If-Match" header the book is only edited if
+        it hasn't changed since the ETag was read.
 
         Input: book_id in URI and a JSON document as HTTP request body.
         Output HTTP responses:
-            204 (when book information was updated succesfully)
+            204 (when book information was updated succesfully, with the new ETag)
             400 (when JSON document didn't validate against the schema)
             404 (when book_id is invalid)
             409 (when trying to change the barcode to one that is already reserved)
+            412 (when the book has changed since the ETag in If-Match was read)
             415 (when HTTP request body is not JSON)
+            428 (when If-Match is missing and REQUIRE_IF_MATCH is set)
         '''
         if not request.json:
             return create_error_response(415,
@@ -71,56 +116,76 @@ class BookItem(Resource):
             )
 
         try:
-            validate(request.json, LibraryBuilder.book_schema())
+            schemas.validate("book", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        if not Book.query.filter_by(id=book_id).all():
+        # One query finds both the book being edited and a possible other book
+        # that already has the new barcode.
+        books = Book.query.filter(
+            or_(Book.id == book_id, Book.barcode == request.json["barcode"])
+        ).all()
+        book = next((b for b in books if str(b.id) == str(book_id)), None)
+
+        if book is None:
             return create_error_response(404,
                 "Book not found",
                 None
             )
 
-        if (Book.query.filter_by(barcode=request.json["barcode"]).all()
-            and int(Book.query.filter_by(barcode=request.json["barcode"]).first().id) != int(book_id)):
+        error = check_if_match(book)
+        if error is not None:
+            return error
+
+        if any(b is not book for b in books):
             return create_error_response(409,
                 "Barcode reserved",
                 "Another book already has a barcode '{}'".format(request.json["barcode"])
             )
 
-        book = Book.query.filter_by(id=book_id).first()
-
-        db.session.delete(book)
-        db.session.commit()
-
-        book = Book(
-            id=book_id,
-            **request.json
-        )
+        # Update the row in place so that the book keeps its loan and holds
+        update_from_json(book, LibraryBuilder.book_schema(), request.json)
+        try:
+            db.session.flush()
+            etag = row_etag(book)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return stale_response()
 
-        db.session.add(book)
-        db.session.commit()
-
-        return Response(status=204)
+        response = Response(status=204)
+        response.set_etag(etag)
+        return response
 
     def delete(self, book_id):
         '''
-        Delete a book from the database
+        Delete a book from the database. With an "If-Match" header the book
+        is only deleted if it hasn't changed since the ETag was read.
 
         Input: book_id
         Output HTTP responses:
             204 (when book was deleted succesfully)
             404 (when book_id is invalid)
+            412 (when the book has changed since the ETag in If-Match was read)
+            428 (when If-Match is missing and REQUIRE_IF_MATCH is set)
         '''
-        if not Book.query.filter_by(id=book_id).all():
+        book = Book.query.filter_by(id=book_id).first()
+        if book is None:
             return create_error_response(404,
                 "Book not found",
                 None
             )
+
+        error = check_if_match(book)
+        if error is not None:
+            return error
         
-        book = Book.query.filter_by(id=book_id).first()
         db.session.delete(book)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return stale_response()
 
         return Response(status=204)
 
@@ -129,40 +194,62 @@ class BookCollection(Resource):
     HTTP method implementations for the BookCollection resource. Supports GET and POST.
     '''
 
+    @cached("book")
+    @conditional("book")
     def get(self):
         '''
-        Gets the info for all books in the database.
+        Gets one page of the books in the database, ordered by id. With the
+        query parameter "stream=true" all the books are returned in a streamed
+        response instead, which is generated while the books are read from the
+        database. With "ids" or "barcodes" (a comma separated list) exactly
+        those books are returned in the given order, and the keys without a
+        book are listed in "missing".
 
-        Input: None
+        Input: optional query parameters "limit" and "after" or "before", "stream", or "ids" or "barcodes"
         Output HTTP responses:
             200
+            400 (when the pagination parameters or the list of keys are invalid)
         '''
-        body = LibraryBuilder(items=[])
-        books = Book.query.all()
-        print(len(books))
-
-        for book in books:
-            item = LibraryBuilder(
-                id=book.id,
-                barcode=book.barcode,
-                title=book.title,
-                author=book.author,
-                pubyear=book.pubyear,
-                format=book.format,
-                description=book.description,
-                loantime=book.loantime,
-                renewlimit=book.renewlimit
-            )
+        try:
+            keys = parse_key_list_arg()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
 
-            item.add_control("self", url_for("api.bookitem", book_id=book.id))
-            item.add_control("profile", BOOK_PROFILE)
-            body["items"].append(item)
+        stream = request.args.get("stream") == "true" and keys is None
+        if not stream and keys is None:
+            try:
+                limit, after, before = parse_page_args()
+            except ValueError as e:
+                return create_error_response(400, "Invalid query parameter", str(e))
 
+        body = LibraryBuilder(items=[])
         body.add_namespace("inlibris", LINK_RELATIONS_URL + "#")
         body.add_control("self", url_for("api.bookcollection"))
         body.add_control("profile", BOOK_PROFILE)
+
+        if stream:
+            body.add_control_all_patrons()
+            body.add_control_add_book()
+            body.add_control_search_books()
+            books = Book.query.order_by(Book.id).yield_per(STREAM_BATCH_SIZE)
+            return Response(
+                stream_with_context(stream_collection(body, books, book_item)),
+                200,
+                mimetype=MASON
+            )
+
+        if keys is not None:
+            name, values = keys
+            column = Book.id if name == "ids" else Book.barcode
+            books, body["missing"] = fetch_by_keys(Book.query, column, values)
+            body["items"] = [book_item(book) for book in books]
+        else:
+            books, has_prev, has_next = keyset_page(Book.query, Book.id, limit, after, before)
+            body["items"] = [book_item(book) for book in books]
+            body.add_control_pages(url_for("api.bookcollection"), books, limit, has_prev, has_next)
         body.add_control_all_patrons()
         body.add_control_add_book()
+        body.add_control_search_books()
 
         return Response(json.dumps(body), 200, mimetype=MASON)
 
@@ -185,7 +272,7 @@ class BookCollection(Resource):
             )
 
         try:
-            validate(request.json, LibraryBuilder.book_schema())
+            schemas.validate("book", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -205,4 +292,56 @@ class BookCollection(Resource):
         headerDictionary = {}
         headerDictionary['Location'] = url_for("api.bookitem", book_id=Book.query.filter_by(barcode=request.json["barcode"]).first().id)
         
-        return Response(status=201, headers=headerDictionary)
\ No newline at end of file
+        return Response(status=201, headers=headerDictionary)
+
+
+# The join reads the matching books in rank order straight from the full-text
+# index, so the cost depends on the number of matches instead of the size of
+# the catalog.
+SEARCH_QUERY = text(
+    "SELECT book.* FROM book_fts JOIN book ON book.id = book_fts.rowid "
+    "WHERE book_fts MATCH :query "
+    "ORDER BY book_fts.rank, book.id "
+    "LIMIT :limit OFFSET :offset"
+)
+
+class BookSearch(Resource):
+    '''
+    HTTP method implementations for the BookSearch resource. Supports GET.
+    '''
+
+    @cached("book")
+    @conditional("book")
+    def get(self):
+        '''
+        Full-text search of the books by title, author and description. All
+        the words of the query must match, the last one also as a prefix.
+        The results are ordered by relevance, matches in the title first.
+
+        Input: query parameter "q", optional query parameters "limit" and "offset"
+        Output HTTP responses:
+            200
+            400 (when the query parameters are invalid)
+        '''
+        try:
+            q, limit, offset = parse_search_args()
+            query = fts_query(q)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        books = Book.query.from_statement(SEARCH_QUERY).params(
+            query=query, limit=limit + 1, offset=offset
+        ).all()
+        has_next = len(books) > limit
+        books = books[:limit]
+
+        body = LibraryBuilder(items=[book_item(book) for book in books])
+        body.add_namespace("inlibris", LINK_RELATIONS_URL + "#")
+        body.add_control("self", request.full_path)
+        body.add_control("profile", BOOK_PROFILE)
+        body.add_control("collection", url_for("api.bookcollection"))
+        body.add_control_search_pages(url_for("api.booksearch"), q, limit, offset, has_next)
+        body.add_control_all_patrons()
+        body.add_control_add_book()
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
@@ -0,0 +1,244 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+from datetime import datetime, timedelta
+from functools import partial
+import json
+from jsonschema import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+
+from inlibris.models import Loan, Book, Patron
+from inlibris.utils import LibraryBuilder, create_error_response, date_converter, url_templates
+from inlibris.holds import promote_next_holds, fulfill_holds, held_for_others
+from inlibris.constants import *
+from inlibris.schemas import schemas
+from inlibris import db
+
+'''
+Bulk circulation resources for the circulation desk. A whole cart of books is
+checked out to a patron or returned with one request: the barcodes are
+resolved with one query, all the changes are committed in one transaction
+and the response reports the result of each book separately.
+
+If another request loans or returns some of the books between the read and
+the commit, the commit fails and nothing is saved. The cart is then processed
+again against the current state, where those books are reported as
+conflicts.
+'''
+
+RESULT_OK = "ok"
+RESULT_CONFLICT = "conflict"
+RESULT_NOT_FOUND = "not found"
+
+# Times a cart is processed before giving up on concurrent changes
+ATTEMPTS = 2
+
+def _resolve_barcodes(barcodes):
+    '''
+    Find the books with the given barcodes and their loans with one query.
+    Returns a dictionary from barcode to a tuple (book, loan), where the loan
+    is None if the book is not loaned. Unknown barcodes are left out.
+    '''
+    rows = (db.session.query(Book, Loan)
+        .outerjoin(Loan, Loan.book_id == Book.id)
+        .filter(Book.barcode.in_(barcodes))
+        .all()
+    )
+    return dict((book.barcode, (book, loan)) for book, loan in rows)
+
+def _result_item(barcode, result, message=None, book=None):
+    item = LibraryBuilder(book_barcode=barcode, result=result)
+    if message is not None:
+        item["message"] = message
+    if book is not None:
+        item.add_control_target_book(book.id)
+    return item
+
+def _commit_items(build):
+    '''
+    Build the result items with "build" and commit the changes it made,
+    processing the cart again if another request wrote the same books in
+    between. Returns the items, or None if the commit kept failing.
+    '''
+    for _ in range(ATTEMPTS):
+        try:
+            items = build()
+            db.session.commit()
+            return items
+        except (IntegrityError, StaleDataError):
+            db.session.rollback()
+    return None
+
+def _conflict_response():
+    return create_error_response(409,
+        "Conflict",
+        "The books were changed by other requests, try again"
+    )
+
+def _checkout(patron_id, barcodes, duedate):
+    '''
+    Loan the free books of "barcodes" to the patron in the session and return
+    the result items.
+    '''
+    books = _resolve_barcodes(barcodes)
+    loandate = datetime.now()
+
+    held = held_for_others(patron_id, [book.id for book, loan in books.values() if loan is None])
+
+    loaned = []
+    items = []
+    for barcode in barcodes:
+        book, loan = books.get(barcode, (None, None))
+        if book is None:
+            item = _result_item(barcode, RESULT_NOT_FOUND,
+                "No book was found with the barcode {}".format(barcode)
+            )
+        elif loan is not None:
+            item = _result_item(barcode, RESULT_CONFLICT,
+                "Book '{}' is already loaned".format(barcode), book
+            )
+        elif book.id in held:
+            item = _result_item(barcode, RESULT_CONFLICT,
+                "Book '{}' is kept for another patron's hold".format(barcode), book
+            )
+        else:
+            db.session.add(Loan(
+                patron_id=patron_id,
+                book_id=book.id,
+                loandate=loandate.date(),
+                duedate=duedate or loandate + timedelta(days=book.loantime)
+            ))
+            loaned.append(book.id)
+            item = _result_item(barcode, RESULT_OK, book=book)
+            item.add_control("inlibris:loan-of", url_templates().url("api.loanitem", book_id=book.id))
+        items.append(item)
+
+    fulfill_holds(patron_id, loaned)
+    return items
+
+def _checkin(barcodes):
+    '''
+    Delete the loans of the loaned books of "barcodes" in the session and
+    return the result items.
+    '''
+    books = _resolve_barcodes(barcodes)
+
+    returned = []
+    items = []
+    for barcode in barcodes:
+        book, loan = books.get(barcode, (None, None))
+        if book is None:
+            item = _result_item(barcode, RESULT_NOT_FOUND,
+                "No book was found with the barcode {}".format(barcode)
+            )
+        elif loan is None:
+            item = _result_item(barcode, RESULT_CONFLICT,
+                "Book '{}' is not loaned".format(barcode), book
+            )
+        else:
+            db.session.delete(loan)
+            returned.append(book.id)
+            item = _result_item(barcode, RESULT_OK, book=book)
+        items.append(item)
+
+    promote_next_holds(returned)
+    return items
+
+def _validate(schema):
+    '''
+    Common checks of the request body. Returns an error response or None.
+    '''
+    if not request.json:
+        return create_error_response(415,
+            "Unsupported media type",
+            "Requests must be JSON"
+        )
+
+    try:
+        schemas.validate(schema, request.json)
+    except ValidationError as e:
+        return create_error_response(400, "Invalid JSON document", str(e))
+
+class CheckoutsByPatron(Resource):
+    '''
+    HTTP method implementations for the CheckoutsByPatron resource. Supports POST.
+    '''
+
+    def post(self, patron_id):
+        '''
+        Loan a list of books to a patron. Books that are already loaned, kept
+        for another patron's hold or don't exist are reported and skipped,
+        the others are loaned and the patron's holds on them are fulfilled.
+
+        Input: patron_id in URI and JSON document as HTTP request body.
+        Output HTTP responses:
+            200 (with the result of each book in the items)
+            400 (when JSON document didn't validate against the schema)
+            404 (when the patron_id is invalid)
+            409 (when other requests kept changing the books)
+            415 (when HTTP request body is not JSON)
+        '''
+
+        error = _validate("checkout")
+        if error is not None:
+            return error
+
+        patron = Patron.query.filter_by(id=patron_id).first()
+        if patron is None:
+            return create_error_response(404,
+                "Patron not found",
+                None
+            )
+
+        if "duedate" in request.json:
+            duedate = date_converter(request.json["duedate"])
+        else:
+            duedate = None
+
+        items = _commit_items(partial(_checkout, patron.id, request.json["book_barcodes"], duedate))
+        if items is None:
+            return _conflict_response()
+
+        body = LibraryBuilder(items=items)
+        body.add_namespace("inlibris", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.checkoutsbypatron", patron_id=patron_id))
+        body.add_control("author", url_for("api.patronitem", patron_id=patron_id))
+        body.add_control("profile", LOAN_PROFILE)
+        body.add_control_loans_by(patron_id)
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
+
+class Checkins(Resource):
+    '''
+    HTTP method implementations for the Checkins resource. Supports POST.
+    '''
+
+    def post(self):
+        '''
+        Return a list of loaned books. Books that are not loaned or don't
+        exist are reported and skipped, the loans of the others are deleted
+        and the first hold in the queue of each book is promoted.
+
+        Input: JSON document as HTTP request body.
+        Output HTTP responses:
+            200 (with the result of each book in the items)
+            400 (when JSON document didn't validate against the schema)
+            409 (when other requests kept changing the books)
+            415 (when HTTP request body is not JSON)
+        '''
+
+        error = _validate("checkin")
+        if error is not None:
+            return error
+
+        items = _commit_items(partial(_checkin, request.json["book_barcodes"]))
+        if items is None:
+            return _conflict_response()
+
+        body = LibraryBuilder(items=items)
+        body.add_namespace("inlibris", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.checkins"))
+        body.add_control("profile", LOAN_PROFILE)
+        body.add_control_all_books()
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
@@ -2,74 +2,260 @@ from flask import Response, request, url_for
 from flask_restful import Resource
 from datetime import datetime, timedelta
 import json
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy.orm import joinedload
 
 from inlibris.models import Loan, Book, Patron, Hold
-from inlibris.utils import LibraryBuilder, create_error_response, date_converter
+from inlibris.utils import LibraryBuilder, hold_item, create_error_response, conditional, date_converter
+from inlibris.holds import ACTIVE_STATUSES, ON_HOLD, REQUESTED, EXPIRATION_DAYS, queue_position, position_of, promote_next_holds
 from inlibris.constants import *
+from inlibris.schemas import schemas
 from inlibris import db
 
-'''
-THESE RESOURCES ARE STILL UNIMPLEMENTED.
-'''
-
 class HoldItem(Resource):
     '''
-    HTTP method implementations for the HoldItem resource. Supports GET, PUT and DELETE.
-
-    So far unimplemented.
+    HTTP method implementations for the HoldItem resource. Supports GET and DELETE.
     '''
-    pass
 
-    '''
+    @conditional("hold", "book", "patron")
     def get(self, patron_id, hold_id):
-        return Response("Placeholder get hold item", status=200, mimetype=MASON)
+        '''
+        Gets the information for a single hold, including its position in the
+        queue of the book (0 when the book is waiting for pickup).
+
+        Input: patron_id, hold_id
+        Output HTTP responses:
+            200 (when patron_id and hold_id are valid)
+            404 (when patron_id or hold_id is invalid)
+        '''
 
-    def put(self, patron_id, hold_id):
-                if not request.json:
-                    return create_error_response(415,
-                        "Unsupported media type",
-                        "Requests must be JSON"
-                    )
-        return Response("Placeholder put hold item", status=200, mimetype=MASON)
+        row = (db.session.query(Hold, queue_position())
+            .options(joinedload(Hold.book), joinedload(Hold.patron))
+            .filter(Hold.id == hold_id, Hold.patron_id == patron_id)
+            .first()
+        )
+        if row is None:
+            return create_error_response(404,
+                "Hold not found",
+                None
+            )
+        hold, ahead = row
 
+        body = hold_item(hold, hold.book, hold.patron)
+        body["position"] = position_of(hold, ahead)
+        body.add_namespace("inlibris", LINK_RELATIONS_URL)
+        body.add_control("author", url_for("api.patronitem", patron_id=hold.patron_id))
+        body.add_control_holds_by(hold.patron_id)
+        body.add_control_holds_on(hold.book_id)
+        body.add_control_all_patrons()
+        body.add_control_all_books()
+        body.add_control_delete_hold(hold.patron_id, hold.id)
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
 
     def delete(self, patron_id, hold_id):
-        return Response("Placeholder delete hold item", status=204, mimetype=MASON)
-    '''
+        '''
+        Cancel a hold. If the book was kept for this hold, the next hold in
+        the queue is promoted in the same transaction.
+
+        Input: patron_id, hold_id
+        Output HTTP responses:
+            204 (when the hold was deleted succesfully)
+            404 (when patron_id or hold_id is invalid)
+        '''
+
+        hold = Hold.query.filter_by(id=hold_id, patron_id=patron_id).first()
+        if hold is None:
+            return create_error_response(404,
+                "Hold not found",
+                None
+            )
+
+        db.session.delete(hold)
+        if hold.status == ON_HOLD:
+            promote_next_holds([hold.book_id])
+        db.session.commit()
+
+        return Response(status=204)
 
 class HoldsOnBook(Resource):
     '''
     HTTP method implementations for the HoldsOnBook resource. Supports GET.
-
-    So far unimplemented.
     '''
 
+    @conditional("book", "hold", "patron")
     def get(self, book_id):
-        return Response("Placeholder HoldsOnBook", status=200, mimetype=MASON)
+        '''
+        Get the hold queue of a book: the hold waiting for pickup, if any,
+        followed by the requested holds in the order they were placed.
+
+        Input: book_id
+        Output HTTP responses:
+            200 (when book_id is valid)
+            404 (when book_id is invalid)
+        '''
+
+        book = Book.query.filter_by(id=book_id).first()
+        if book is None:
+            return create_error_response(404,
+                "Book not found",
+                None
+            )
+
+        # "On hold" sorts before "Requested", so the index on
+        # (book_id, status, id) gives the holds in queue order.
+        holds = (Hold.query
+            .options(joinedload(Hold.patron))
+            .filter(Hold.book_id == book.id, Hold.status.in_(ACTIVE_STATUSES))
+            .order_by(Hold.status, Hold.id)
+            .all()
+        )
+
+        body = LibraryBuilder(items=[])
+        ahead = 0
+        for hold in holds:
+            item = hold_item(hold, book, hold.patron)
+            item["position"] = position_of(hold, ahead)
+            if hold.status == REQUESTED:
+                ahead += 1
+            body["items"].append(item)
+
+        body.add_namespace("inlibris", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.holdsonbook", book_id=book_id))
+        body.add_control("profile", HOLD_PROFILE)
+        body.add_control_target_book(book_id)
+        body.add_control_loan_of(book_id)
+        body.add_control_all_books()
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
 
 class HoldsByPatron(Resource):
     '''
     HTTP method implementations for the HoldsByPatron resource. Supports GET and POST.
-
-    So far unimplemented.
     '''
-    pass
 
-    '''
+    @conditional("patron", "hold", "book")
     def get(self, patron_id):
-        return Response("Placeholder Get HoldsByPatron", status=200, mimetype=MASON)
+        '''
+        Get all the holds of a patron with their positions in the queues.
+
+        Input: patron_id
+        Output HTTP responses:
+            200 (when patron_id is valid)
+            404 (when patron_id is invalid)
+        '''
+
+        patron = Patron.query.filter_by(id=patron_id).first()
+        if patron is None:
+            return create_error_response(404,
+                "Patron not found",
+                None
+            )
+
+        rows = (db.session.query(Hold, queue_position())
+            .options(joinedload(Hold.book))
+            .filter(Hold.patron_id == patron.id)
+            .order_by(Hold.id)
+            .all()
+        )
+
+        body = LibraryBuilder(items=[])
+        for hold, ahead in rows:
+            item = hold_item(hold, hold.book, patron)
+            item["position"] = position_of(hold, ahead)
+            body["items"].append(item)
+
+        body.add_namespace("inlibris", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.holdsbypatron", patron_id=patron_id))
+        body.add_control("author", url_for("api.patronitem", patron_id=patron_id))
+        body.add_control("profile", HOLD_PROFILE)
+        body.add_control_loans_by(patron_id)
+        body.add_control_all_patrons()
+        body.add_control_all_books()
+        body.add_control_add_hold(patron_id)
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
 
     def post(self, patron_id):
+        '''
+        Place a hold on a book for a patron. The hold goes to the end of the
+        queue of the book, or is put on hold right away if the book is free.
 
-                if not request.json:
-                    return create_error_response(415,
-                        "Unsupported media type",
-                        "Requests must be JSON"
-                    )
+        Input: patron_id in URI and JSON document as HTTP request body.
+        Output HTTP responses:
+            201 (when the hold was added succesfully)
+            400 (when JSON document didn't validate against the schema)
+            404 (when the patron_id is invalid or book_barcode in the request body is invalid)
+            409 (when the patron already has a hold on the book or has it on loan)
+            415 (when HTTP request body is not JSON)
+        '''
 
-        return Response("Placeholder Post HoldsByPatron", status=201, mimetype=MASON)
-    '''
+        if not request.json:
+            return create_error_response(415,
+                "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        try:
+            schemas.validate("add_hold", request.json)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        patron = Patron.query.filter_by(id=patron_id).first()
+        if patron is None:
+            return create_error_response(404,
+                "Patron not found",
+                None
+            )
+
+        book = (Book.query
+            .options(joinedload(Book.loan))
+            .filter_by(barcode=request.json["book_barcode"])
+            .first()
+        )
+        if book is None:
+            return create_error_response(404,
+                "Book not found",
+                None
+            )
+
+        if book.loan and book.loan[0].patron_id == patron.id:
+            return create_error_response(409,
+                "Already loaned",
+                "Patron '{}' already has book '{}' on loan"
+                .format(patron.barcode, book.barcode)
+            )
+
+        conflict_hold = (Hold.query
+            .filter(Hold.book_id == book.id, Hold.patron_id == patron.id)
+            .filter(Hold.status.in_(ACTIVE_STATUSES))
+            .first()
+        )
+        if conflict_hold:
+            return create_error_response(409,
+                "Already exists",
+                "Patron '{}' already has a hold on book '{}'"
+                .format(patron.barcode, book.barcode)
+            )
+
+        if "expirationdate" in request.json:
+            expirationdate = date_converter(request.json["expirationdate"])
+        else:
+            expirationdate = datetime.now() + timedelta(days=EXPIRATION_DAYS)
 
+        hold = Hold(
+            patron_id=patron.id,
+            book_id=book.id,
+            holddate=datetime.now().date(),
+            expirationdate=expirationdate,
+            status=REQUESTED
+        )
+        db.session.add(hold)
+        if not book.loan:
+            promote_next_holds([book.id])
+        db.session.commit()
 
+        headerDictionary = {}
+        headerDictionary['Location'] = url_for("api.holditem", patron_id=patron.id, hold_id=hold.id)
 
+        return Response(status=201, headers=headerDictionary)
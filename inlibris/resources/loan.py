@@ -2,18 +2,82 @@ from flask import Response, request, url_for
 from flask_restful import Resource
 from datetime import datetime, timedelta
 import json
-from jsonschema import validate, ValidationError
-
-from inlibris.models import Loan, Book, Patron
-from inlibris.utils import LibraryBuilder, create_error_response, date_converter
+from jsonschema import ValidationError
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import StaleDataError
+
+from inlibris.models import Loan, Book, Patron, bump_versions
+from inlibris.utils import (
+    LibraryBuilder, book_item, patron_item, loan_item, create_error_response,
+    conditional, check_if_match, row_etag, stale_response,
+    parse_embed_arg, date_converter
+)
+from inlibris.cache import invalidate_on_commit
+from inlibris.holds import REQUESTED, ON_HOLD, promote_next_holds, fulfill_holds, held_for_others
 from inlibris.constants import *
+from inlibris.schemas import schemas
 from inlibris import db
 
+# Renews the loan of a book if it has renewals left and nobody is waiting for
+# the book. The new due date is counted from today with the loan time of the
+# book, in the format SQLAlchemy stores dates in.
+RENEW_STATEMENT = text("""
+    UPDATE loan SET
+        renewed = renewed + 1,
+        version = version + 1,
+        renewaldate = :now,
+        duedate = (
+            SELECT strftime('%Y-%m-%d 00:00:00.000000', :today, '+' || book.loantime || ' days')
+            FROM book WHERE book.id = loan.book_id
+        ),
+        status = 'Renewed'
+    WHERE book_id = :book_id
+    AND renewed < (SELECT renewlimit FROM book WHERE book.id = loan.book_id)
+    AND NOT EXISTS (
+        SELECT 1 FROM hold
+        WHERE hold.book_id = loan.book_id AND hold.status IN (:requested, :on_hold)
+    )
+""").bindparams(bindparam("now", type_=db.DateTime))
+
+def _loan_document(book, loan):
+    '''
+    Build the document of the loan of "book" with all of its controls. A loan
+    left behind by a deleted patron is built without the patron's barcode
+    and the links to the patron.
+    '''
+
+    body = LibraryBuilder(id=loan.id, book_barcode=book.barcode)
+    if loan.patron is not None:
+        body["patron_barcode"] = loan.patron.barcode
+    body.update(
+        loandate=str(loan.loandate.date()),
+        renewaldate=None if not loan.renewaldate else str(loan.renewaldate.date()),
+        duedate=str(loan.duedate.date()),
+        renewed=loan.renewed,
+        status=loan.status
+    )
+
+    body.add_namespace("inlibris", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.loanitem", book_id=book.id))
+    body.add_control("profile", LOAN_PROFILE)
+    if loan.patron is not None:
+        body.add_control("author", url_for("api.patronitem", patron_id=loan.patron_id))
+        body.add_control_loans_by(loan.patron_id)
+    body.add_control_target_book(book.id)
+    body.add_control_all_books()
+    body.add_control_all_patrons()
+    body.add_control_edit_loan(book.id)
+    body.add_control_renew_loan(book.id)
+    body.add_control_delete_loan(book.id)
+    return body
+
 class LoanItem(Resource):
     '''
     HTTP method implementations for the LoanItem resource. Supports GET, PUT and DELETE.
     '''
 
+    @conditional("book", "patron", row=(Loan.book_id, "book_id"))
     def get(self, book_id):
         '''
         Gets the information for a single loan.
@@ -25,55 +89,37 @@ class LoanItem(Resource):
             404 (when book_id is invalid)
         '''
 
-        book = Book.query.filter_by(id=book_id).first()
+        book = (Book.query
+            .options(joinedload(Book.loan).joinedload(Loan.patron))
+            .filter_by(id=book_id)
+            .first()
+        )
         if book is None:
             return create_error_response(404,
                 "Book not found", 
                 None
             )
 
-        loan = Loan.query.filter_by(book_id=book_id).first()
-        if loan is None:
+        if not book.loan:
             return create_error_response(400, "Book not loaned", None)
 
-        book_barcode = Book.query.filter_by(id=book_id).first().barcode
-        patron_barcode = Patron.query.filter_by(id=loan.patron_id).first().barcode
-
-        body = LibraryBuilder(
-            id=loan.id,
-            book_barcode=book_barcode,
-            patron_barcode=patron_barcode,
-            loandate=str(loan.loandate.date()),
-            renewaldate=None if not loan.renewaldate else str(loan.renewaldate.date()),
-            duedate=str(loan.duedate.date()),
-            renewed=loan.renewed,
-            status=loan.status
-        )
-
-        body.add_namespace("inlibris", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.loanitem", book_id=book_id))
-        body.add_control("profile", LOAN_PROFILE)
-        body.add_control("author", url_for("api.patronitem", patron_id=loan.patron_id))
-        body.add_control_loans_by(loan.patron_id)
-        body.add_control_target_book(book_id)
-        body.add_control_all_books()
-        body.add_control_all_patrons()
-        body.add_control_edit_loan(book_id)
-        body.add_control_delete_loan(book_id)
-        
+        body = _loan_document(book, book.loan[0])
         return Response(json.dumps(body), 200, mimetype=MASON)
 
     def put(self, book_id):
         '''
-        Edit a loan (e.g. renew)
+        Edit a loan. With an "If-Match" header the loan is only edited if it
+        hasn't changed since the ETag was read.
 
         Input: book_id in URI and a JSON document as HTTP request body.
         Output HTTP responses:
-            200 (when loan information was updated succesfully)
+            200 (when loan information was updated succesfully, with the new ETag)
             204 (when book_id is valid but book is not on loan)
             400 (when JSON document didn't validate against the schema)
             404 (when book_id is invalid or patron barcode in request body is invalid)
+            412 (when the loan has changed since the ETag in If-Match was read)
             415 (when HTTP request body is not JSON)
+            428 (when If-Match is missing and REQUIRE_IF_MATCH is set)
         '''
 
         if not request.json:
@@ -83,11 +129,11 @@ class LoanItem(Resource):
             )
 
         try:
-            validate(request.json, LibraryBuilder.edit_loan_schema())
+            schemas.validate("edit_loan", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        book = Book.query.filter_by(id=book_id).first()
+        book = Book.query.options(joinedload(Book.loan)).filter_by(id=book_id).first()
         patron = Patron.query.filter_by(barcode=request.json["patron_barcode"]).first()
 
         if patron is None:
@@ -102,16 +148,17 @@ class LoanItem(Resource):
                 None
             )
                 
-        loan = Loan.query.filter_by(book_id=book_id).first()
-        if loan is None:
+        if not book.loan:
             return Response(status=204)
+        loan = book.loan[0]
+
+        error = check_if_match(loan)
+        if error is not None:
+            return error
 
         # TODO: Check more errors: what if they try to change book_id to a book that is already
         # on loan or something like that?
 
-        db.session.delete(loan)
-        db.session.commit()
-
         if "renewaldate" in request.json:
             renewaldate = date_converter(request.json["renewaldate"])
         else:
@@ -127,64 +174,156 @@ class LoanItem(Resource):
         else:
             status = "Charged"
 
-        loan = Loan(
-            patron_id = patron.id,
-            book_id = book_id,
-            duedate = date_converter(request.json["duedate"]),
-            renewaldate = renewaldate,
-            loandate = date_converter(request.json["loandate"]),
-            renewed = renewed,
-            status = status
-        )
-
-        db.session.add(loan)
-        db.session.commit()
+        # Update the row in place instead of deleting and adding it again
+        loan.patron_id = patron.id
+        loan.duedate = date_converter(request.json["duedate"])
+        loan.renewaldate = renewaldate
+        loan.loandate = date_converter(request.json["loandate"])
+        loan.renewed = renewed
+        loan.status = status
+        try:
+            db.session.flush()
+            etag = row_etag(loan)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return stale_response()
 
-        return Response(status=200)
+        response = Response(status=200)
+        response.set_etag(etag)
+        return response
 
     def delete(self, book_id):
         '''
-        Delete a loan from the database
+        Delete a loan from the database. The first hold in the queue of the
+        book is promoted in the same transaction. With an "If-Match" header
+        the loan is only deleted if it hasn't changed since the ETag was read.
 
         Input: book_id
         Output HTTP responses:
             204 (when loan was deleted succesfully or the book is not loaned)
             404 (when book_id is invalid)
+            412 (when the loan has changed since the ETag in If-Match was read)
+            428 (when If-Match is missing and REQUIRE_IF_MATCH is set)
         '''
 
-        book = Book.query.filter_by(id=book_id).first()
+        book = Book.query.options(joinedload(Book.loan)).filter_by(id=book_id).first()
         if book is None:
             return create_error_response(404,
                 "Book not found", 
                 None
             )
 
-        loan = Loan.query.filter_by(book_id=book_id).first()
-
-        if not loan:
+        if not book.loan:
             return Response(status=204)
 
-        db.session.delete(loan)
-        db.session.commit()
+        error = check_if_match(book.loan[0])
+        if error is not None:
+            return error
+
+        db.session.delete(book.loan[0])
+        try:
+            promote_next_holds([book.id])
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return stale_response()
 
         return Response(status=204)
 
+class LoanRenewal(Resource):
+    '''
+    HTTP method implementations for the LoanRenewal resource. Supports POST.
+    '''
+
+    def post(self, book_id):
+        '''
+        Renew the loan of a book. The loan is renewed with one conditional
+        UPDATE, so two renewals at the same time can't both pass the
+        renewal limit. The due date is counted from today with the loan
+        time of the book.
+
+        Input: book_id
+        Output HTTP responses:
+            200 (with the renewed loan)
+            400 (when book_id is valid but book is not loaned)
+            404 (when book_id is invalid)
+            409 (when the loan has no renewals left or the book has holds)
+        '''
+
+        now = datetime.now()
+        result = db.session.execute(RENEW_STATEMENT, {
+            "now": now,
+            "today": str(now.date()),
+            "book_id": book_id,
+            "requested": REQUESTED,
+            "on_hold": ON_HOLD
+        })
+
+        book = (Book.query
+            .options(joinedload(Book.loan).joinedload(Loan.patron))
+            .filter_by(id=book_id)
+            .first()
+        )
+
+        if result.rowcount == 0:
+            db.session.rollback()
+            if book is None:
+                return create_error_response(404,
+                    "Book not found",
+                    None
+                )
+            if not book.loan:
+                return create_error_response(400, "Book not loaned", None)
+            if book.loan[0].renewed >= book.renewlimit:
+                return create_error_response(409,
+                    "Renewal limit reached",
+                    "Book '{}' has been renewed {} times"
+                    .format(book.barcode, book.loan[0].renewed)
+                )
+            return create_error_response(409,
+                "Book has holds",
+                "Book '{}' can't be renewed, other patrons are waiting for it"
+                .format(book.barcode)
+            )
+
+        # Built before the commit expires the loaded rows
+        body = _loan_document(book, book.loan[0])
+        bump_versions(db.session.connection(), ["loan"])
+        invalidate_on_commit(db.session, book.loan[0])
+        db.session.commit()
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
+
 class LoansByPatron(Resource):
     '''
     HTTP method implementations for the LoansByPatron resource. Supports GET and POST.
     '''
 
+    @conditional("patron", "loan", "book")
     def get(self, patron_id):
         '''
-        Get the info for all the loans by a patron.
+        Get the info for all the loans by a patron. With the query parameter
+        "embed=book" the book of each loan is included in its item, and with
+        "patron" the patron is included in the document.
 
-        Input: patron_id
+        Input: patron_id, optional query parameter "embed"
         Output HTTP responses:
             200 (patron_id is valid)
+            400 (embed is invalid)
             404 (patron_id is invalid)
         '''
 
-        patron = Patron.query.filter_by(id=patron_id).first()
+        try:
+            embed = parse_embed_arg(("book", "patron"))
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        patron = (Patron.query
+            .options(joinedload(Patron.loans).joinedload(Loan.book))
+            .filter_by(id=patron_id)
+            .first()
+        )
 
         if patron is None:
             return create_error_response(404,
@@ -192,27 +331,15 @@ class LoansByPatron(Resource):
                 None
             )
 
-        loans = Loan.query.filter_by(patron_id=patron_id).all()
         body = LibraryBuilder(items=[])
 
-        for loan in loans:
-            book_barcode = Book.query.filter_by(id=loan.book_id).first().barcode
-            patron_barcode = Patron.query.filter_by(id=patron_id).first().barcode
-
-            item = LibraryBuilder(
-                id=loan.id,
-                book_barcode=book_barcode,
-                patron_barcode=patron_barcode,
-                loandate=str(loan.loandate.date()),
-                renewaldate=None if not loan.renewaldate else str(loan.renewaldate.date()),
-                duedate=str(loan.duedate.date()),
-                renewed=loan.renewed,
-                status=loan.status
-            )
-
-            item.add_control("self", url_for("api.loanitem", book_id=loan.book_id))
-            item.add_control("profile", LOAN_PROFILE)
+        for loan in patron.loans:
+            item = loan_item(loan, loan.book, patron)
+            if "book" in embed:
+                item["book"] = book_item(loan.book)
             body["items"].append(item)
+        if "patron" in embed:
+            body["patron"] = patron_item(patron)
 
         body.add_namespace("inlibris", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.loansbypatron", patron_id=patron_id))
@@ -221,6 +348,8 @@ class LoansByPatron(Resource):
         body.add_control_all_patrons()
         body.add_control_all_books()
         body.add_control_add_loan(patron_id)
+        body.add_control_checkout(patron_id)
+        body.add_control_checkin()
 
         return Response(json.dumps(body), 200, mimetype=MASON)
 
@@ -234,7 +363,7 @@ class LoansByPatron(Resource):
             201 (when loan was added succesfully)
             400 (when JSON document didn't validate against the schema)
             404 (when the patron_id is invalid or book_barcode in the request body is invalid)
-            409 (when the book is already loaned)
+            409 (when the book is already loaned or kept for another patron's hold)
             415 (when HTTP request body is not JSON)
         '''
 
@@ -245,7 +374,7 @@ class LoansByPatron(Resource):
             )
 
         try:
-            validate(request.json, LibraryBuilder.add_loan_schema())
+            schemas.validate("add_loan", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -273,6 +402,13 @@ class LoansByPatron(Resource):
                 "Patron '{}' already has loan with book '{}'"
                 .format(conflict_patron.barcode, book.barcode)
             )
+
+        if held_for_others(patron.id, [book.id]):
+            return create_error_response(409,
+                "On hold",
+                "Book '{}' is kept for another patron's hold"
+                .format(book.barcode)
+            )
     
         if "duedate" in request.json:
             duedate = date_converter(request.json["duedate"])
@@ -287,6 +423,7 @@ class LoansByPatron(Resource):
         )
 
         db.session.add(loan)
+        fulfill_holds(patron.id, [book.id])
         db.session.commit()
         
         headerDictionary = {}
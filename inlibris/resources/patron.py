@@ -1,29 +1,57 @@
-from flask import Response, request, url_for
+from flask import Response, request, url_for, stream_with_context
 from flask_restful import Resource
 from datetime import datetime
 import json
-from jsonschema import validate, ValidationError
-
-from inlibris.models import Patron
-from inlibris.utils import LibraryBuilder, create_error_response
+from jsonschema import ValidationError
+from sqlalchemy import and_, false, or_
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.exc import StaleDataError
+
+from inlibris.models import Patron, Loan, Hold
+from inlibris.utils import (
+    LibraryBuilder, patron_item, book_item, loan_item, hold_item, create_error_response,
+    conditional, check_if_match, row_etag, stale_response, update_from_json,
+    parse_embed_arg, parse_page_args, parse_key_list_arg, parse_search_args,
+    fetch_by_keys, keyset_page, stream_collection
+)
+from inlibris.holds import ON_HOLD, promote_next_holds
+from inlibris.cache import cached
 from inlibris.constants import *
+from inlibris.schemas import schemas
 from inlibris import db
 
 class PatronItem(Resource):
     '''
     HTTP method implementations for the PatronItem resource. Supports GET, PUT and DELETE.
     '''
+    @cached("patron:{patron_id}", embed={"loans": ("book",), "holds": ("book",), "book": ("book",)})
+    @conditional(embed={"loans": ("loan", "book"), "holds": ("hold", "book")}, row=(Patron.id, "patron_id"))
     def get(self, patron_id):
         '''
-        Gets the information for a single patron.
+        Gets the information for a single patron. With the query parameter
+        "embed=loans,holds" the patron's loans and holds are included in the
+        document, and with "book" also the book of each loan and hold.
 
-        Input: patron_id
+        Input: patron_id, optional query parameter "embed"
         Output HTTP responses:
             200 OK (when patron_id is valid)
+            400 Bad Request (when embed is invalid)
             404 Not Found (when patron_id is invalid)
         '''
 
-        patron = Patron.query.filter_by(id=patron_id).first()
+        try:
+            embed = parse_embed_arg(("loans", "holds", "book"))
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # Each embedded collection is loaded with one more query
+        query = Patron.query
+        if "loans" in embed:
+            query = query.options(selectinload(Patron.loans).joinedload(Loan.book))
+        if "holds" in embed:
+            query = query.options(selectinload(Patron.holds).joinedload(Hold.book))
+
+        patron = query.filter_by(id=patron_id).first()
         if patron is None:
             return create_error_response(404, "Not found", 
                 "No patron was found with the id {}".format(patron_id)
@@ -48,20 +76,38 @@ class PatronItem(Resource):
         body.add_control("collection", url_for("api.patroncollection"))
         body.add_control_edit_patron(patron_id)
         body.add_control_delete_patron(patron_id)
-        
+
+        if "loans" in embed:
+            body["loans"] = []
+            for loan in patron.loans:
+                item = loan_item(loan, loan.book, patron)
+                if "book" in embed:
+                    item["book"] = book_item(loan.book)
+                body["loans"].append(item)
+        if "holds" in embed:
+            body["holds"] = []
+            for hold in patron.holds:
+                item = hold_item(hold, hold.book, patron)
+                if "book" in embed:
+                    item["book"] = book_item(hold.book)
+                body["holds"].append(item)
+
         return Response(json.dumps(body), 200, mimetype=MASON)
 
     def put(self, patron_id):
         '''
-        Edit a patron.
+        Edit a patron. With an "If-Match" header the patron is only edited
+        if it hasn't changed since the ETag was read.
 
         Input: patron_id in URI and a JSON document as HTTP request body.
         Output HTTP responses:
-            204 (when patron information was updated succesfully)
+            204 (when patron information was updated succesfully, with the new ETag)
             400 (when JSON document didn't validate against the schema)
             404 (when patron_id is invalid)
-            409 (when trying to change the barcode to one that is already reserved)
+            409 (when trying to change the barcode or email to one that is already reserved)
+            412 (when the patron has changed since the ETag in If-Match was read)
             415 (when HTTP request body is not JSON)
+            428 (when If-Match is missing and REQUIRE_IF_MATCH is set)
         '''
         if not request.json:
             return create_error_response(415,
@@ -70,59 +116,92 @@ class PatronItem(Resource):
             )
 
         try:
-            validate(request.json, LibraryBuilder.patron_schema())
+            schemas.validate("patron", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        if (Patron.query.filter_by(barcode=request.json["barcode"]).all()
-            and int(Patron.query.filter_by(barcode=request.json["barcode"]).first().id) != int(patron_id)):
+        # One query finds both the patron being edited and possible other
+        # patrons that already have the new barcode or email.
+        patrons = Patron.query.filter(or_(
+            Patron.id == patron_id,
+            Patron.barcode == request.json["barcode"],
+            Patron.email == request.json["email"]
+        )).all()
+        patron = next((p for p in patrons if str(p.id) == str(patron_id)), None)
+
+        for other in patrons:
+            if other is patron:
+                continue
+            if other.barcode == request.json["barcode"]:
+                return create_error_response(409,
+                    "Patron barcode reserved",
+                    "Another patron already has a barcode '{}'".format(request.json["barcode"])
+                )
             return create_error_response(409,
-                "Patron barcode reserved",
-                "Another patron already has a barcode '{}'".format(request.json["barcode"])
+                "Patron email reserved",
+                "Another patron already has an email '{}'".format(request.json["email"])
             )
         
-        if not Patron.query.filter_by(id=patron_id).all():
+        if patron is None:
             return create_error_response(404,
                 "Not found",
                 "Patron does not exist"
             )
 
-        patron = Patron.query.filter_by(id=patron_id).first()
-        regdate = patron.regdate
-
-        db.session.delete(patron)
-        db.session.commit()
+        error = check_if_match(patron)
+        if error is not None:
+            return error
 
-        patron = Patron(
-            id=patron_id,
-            regdate=regdate,
-            **request.json
-        )
-
-        db.session.add(patron)
-        db.session.commit()
+        # Update the row in place, the registration date stays as it was
+        update_from_json(patron, LibraryBuilder.patron_schema(), request.json)
+        try:
+            db.session.flush()
+            etag = row_etag(patron)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return stale_response()
 
-        return Response(status=204) 
+        response = Response(status=204)
+        response.set_etag(etag)
+        return response
 
     def delete(self, patron_id):
         '''
-        Delete a patron from the database
+        Delete a patron from the database. The holds of the patron are
+        cancelled, and the books kept for them go to the next hold in their
+        queues. With an "If-Match" header the patron is only deleted if it
+        hasn't changed since the ETag was read.
 
         Input: patron_id
         Output HTTP responses:
             204 (when patron was deleted succesfully)
             404 (when patron_id is invalid)
+            412 (when the patron has changed since the ETag in If-Match was read)
+            428 (when If-Match is missing and REQUIRE_IF_MATCH is set)
         '''
 
-        if not Patron.query.filter_by(id=patron_id).all():
+        patron = Patron.query.filter_by(id=patron_id).first()
+        if patron is None:
             return create_error_response(404,
                 "Patron not found",
                 None
             )
-        
-        patron = Patron.query.filter_by(id=patron_id).first()
+
+        error = check_if_match(patron)
+        if error is not None:
+            return error
+
+        held = [hold.book_id for hold in patron.holds if hold.status == ON_HOLD]
+        for hold in patron.holds:
+            db.session.delete(hold)
         db.session.delete(patron)
-        db.session.commit()
+        promote_next_holds(held)
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return stale_response()
 
         return Response(status=204)
 
@@ -131,39 +210,63 @@ class PatronCollection(Resource):
     HTTP method implementations for the PatronCollection resource. Supports GET and POST.
     '''
 
+    @cached("patron")
+    @conditional("patron")
     def get(self):
         '''
-        Gets the info for all the patrons in the database.
-
-        Input: None
+        Gets one page of the patrons in the database, ordered by id. With the
+        query parameter "stream=true" all the patrons are returned in a
+        streamed response instead, which is generated while the patrons are
+        read from the database. With "ids" or "barcodes" (a comma separated
+        list) exactly those patrons are returned in the given order, and the
+        keys without a patron are listed in "missing".
+
+        Input: optional query parameters "limit" and "after" or "before", "stream", or "ids" or "barcodes"
         Output HTTP responses:
             200
+            400 (when the pagination parameters or the list of keys are invalid)
         '''
+
+        try:
+            keys = parse_key_list_arg()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        stream = request.args.get("stream") == "true" and keys is None
+        if not stream and keys is None:
+            try:
+                limit, after, before = parse_page_args()
+            except ValueError as e:
+                return create_error_response(400, "Invalid query parameter", str(e))
         
         body = LibraryBuilder(items=[])
-        patrons = Patron.query.all()
-        print(len(patrons))
-
-        for patron in patrons:
-            item = LibraryBuilder(
-                id=patron.id,
-                barcode=patron.barcode,
-                firstname=patron.firstname,
-                lastname=patron.lastname,
-                email=patron.email,
-                group=patron.group,
-                status=patron.status,
-                regdate=str(patron.regdate.date())
-            )
-            item.add_control("self", url_for("api.patronitem", patron_id=patron.id))
-            item.add_control("profile", PATRON_PROFILE)
-            body["items"].append(item)
-
         body.add_namespace("inlibris", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.patroncollection"))
         body.add_control("profile", PATRON_PROFILE)
+
+        if stream:
+            body.add_control_add_patron()
+            body.add_control_all_books()
+            body.add_control_search_patrons()
+            patrons = Patron.query.order_by(Patron.id).yield_per(STREAM_BATCH_SIZE)
+            return Response(
+                stream_with_context(stream_collection(body, patrons, patron_item)),
+                200,
+                mimetype=MASON
+            )
+
+        if keys is not None:
+            name, values = keys
+            column = Patron.id if name == "ids" else Patron.barcode
+            patrons, body["missing"] = fetch_by_keys(Patron.query, column, values)
+            body["items"] = [patron_item(patron) for patron in patrons]
+        else:
+            patrons, has_prev, has_next = keyset_page(Patron.query, Patron.id, limit, after, before)
+            body["items"] = [patron_item(patron) for patron in patrons]
+            body.add_control_pages(url_for("api.patroncollection"), patrons, limit, has_prev, has_next)
         body.add_control_add_patron()
         body.add_control_all_books()
+        body.add_control_search_patrons()
 
         return Response(json.dumps(body), 200, mimetype=MASON)
 
@@ -186,7 +289,7 @@ class PatronCollection(Resource):
             )
 
         try:
-            validate(request.json, LibraryBuilder.patron_schema())
+            schemas.validate("patron", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -213,4 +316,72 @@ class PatronCollection(Resource):
         headerDictionary = {}
         headerDictionary['Location'] = url_for("api.patronitem", patron_id=Patron.query.filter_by(barcode=request.json["barcode"]).first().id)
         
-        return Response(status=201, headers=headerDictionary)
\ No newline at end of file
+        return Response(status=201, headers=headerDictionary)
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _word_filter(word):
+    '''
+    Build the filter for one word of a patron search. A number is a barcode
+    prefix, which is turned into a range of barcodes. Anything else is a
+    prefix of the first name, last name or email. Both use an index.
+    '''
+    if word.isascii() and word.isdigit():
+        if len(word) > 6:
+            return false()
+        scale = 10 ** (6 - len(word))
+        return Patron.barcode.between(int(word) * scale, (int(word) + 1) * scale - 1)
+
+    pattern = _escape_like(word) + "%"
+    return or_(
+        Patron.firstname.like(pattern, escape="\\"),
+        Patron.lastname.like(pattern, escape="\\"),
+        Patron.email.like(pattern, escape="\\")
+    )
+
+class PatronSearch(Resource):
+    '''
+    HTTP method implementations for the PatronSearch resource. Supports GET.
+    '''
+
+    @cached("patron")
+    @conditional("patron")
+    def get(self):
+        '''
+        Search patrons by barcode prefix or by the prefix of their first name,
+        last name or email. With several words every word must match, e.g.
+        "sally sto" finds Sally Stover. Results are ordered by name.
+
+        Input: query parameter "q", optional query parameters "limit" and "offset"
+        Output HTTP responses:
+            200
+            400 (when the query parameters are invalid)
+        '''
+        try:
+            q, limit, offset = parse_search_args()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        words = q.split()[:MAX_SEARCH_TERMS]
+        patrons = (Patron.query
+            .filter(and_(*[_word_filter(word) for word in words]))
+            .order_by(Patron.lastname, Patron.firstname, Patron.id)
+            .offset(offset)
+            .limit(limit + 1)
+            .all()
+        )
+        has_next = len(patrons) > limit
+        patrons = patrons[:limit]
+
+        body = LibraryBuilder(items=[patron_item(patron) for patron in patrons])
+        body.add_namespace("inlibris", LINK_RELATIONS_URL + "#")
+        body.add_control("self", request.full_path)
+        body.add_control("profile", PATRON_PROFILE)
+        body.add_control("collection", url_for("api.patroncollection"))
+        body.add_control_search_pages(url_for("api.patronsearch"), q, limit, offset, has_next)
+        body.add_control_add_patron()
+        body.add_control_all_books()
+
+        return Response(json.dumps(body), 200, mimetype=MASON)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+from flask import current_app
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+'''
+Registry for the JSON schemas in the static schema folder. The schemas are
+read and their validators built once when the app is created, so requests
+don't have to touch the disk to validate a document or to add a schema to a
+hypermedia control.
+
+Each schema also has a version, a hash of the file, which makes the URLs the
+schemas are served from (see schema_url in utils) change with the content so
+that they can be cached for good.
+'''
+
+class _SchemaEntry(object):
+    """
+    A loaded schema file together with its prebuilt validator.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.load()
+
+    def load(self):
+        self.mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+        self.schema = json.loads(self.data.decode("utf-8"))
+        self.version = hashlib.sha256(self.data).hexdigest()[:12]
+        cls = validator_for(self.schema)
+        cls.check_schema(self.schema)
+        self.validator = cls(self.schema)
+
+    def reload_if_modified(self):
+        if os.stat(self.path).st_mtime != self.mtime:
+            self.load()
+
+class SchemaRegistry(object):
+    """
+    Flask extension that holds the schemas of an app, keyed by the name of the
+    schema file without the ".json" suffix (e.g. "book", "add_loan").
+
+    If the config value SCHEMA_AUTO_RELOAD is true (by default only in debug
+    mode), a schema file is read again when its modification time changes.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SCHEMA_AUTO_RELOAD", app.debug)
+        folder = os.path.join(app.static_folder, "schema")
+        entries = {}
+        for filename in sorted(os.listdir(folder)):
+            name, ext = os.path.splitext(filename)
+            if ext == ".json":
+                entries[name] = _SchemaEntry(os.path.join(folder, filename))
+        app.extensions["schemas"] = entries
+
+    def _entry(self, name):
+        entry = current_app.extensions["schemas"][name]
+        if current_app.config["SCHEMA_AUTO_RELOAD"]:
+            entry.reload_if_modified()
+        return entry
+
+    def schema(self, name):
+        """
+        Return the schema called "name" as a dictionary. The same dictionary is
+        shared by all callers so it must not be modified.
+        """
+
+        return self._entry(name).schema
+
+    def version(self, name):
+        """
+        Return the version of the schema called "name".
+        """
+
+        return self._entry(name).version
+
+    def source(self, name):
+        """
+        Return the schema file called "name" as bytes, together with its
+        version. Raises KeyError if there is no such schema.
+        """
+
+        entry = self._entry(name)
+        return entry.data, entry.version
+
+    def validate(self, name, instance):
+        """
+        Validate "instance" against the schema called "name". Raises the most
+        relevant jsonschema ValidationError if the instance is not valid, like
+        jsonschema.validate does.
+        """
+
+        error = best_match(self._entry(name).validator.iter_errors(instance))
+        if error is not None:
+            raise error
+
+schemas = SchemaRegistry()
@@ -0,0 +1,144 @@
+import atexit
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from inlibris import db
+
+'''
+Slow query log. With the config value SLOW_QUERY_THRESHOLD (in seconds) set,
+every SQL statement of the app's engine that takes at least that long is
+logged with its parameters, the endpoint and method of the request that ran
+it, and the plan SQLite reports for it with EXPLAIN QUERY PLAN, e.g. in
+instance/config.py:
+
+    SLOW_QUERY_THRESHOLD = 0.05
+
+The request thread only puts the record on a queue. A listener thread runs
+the EXPLAIN on a connection of its own and writes to SLOW_QUERY_LOG (default:
+"slow_queries.log" in the instance folder), which is rotated at
+SLOW_QUERY_LOG_BYTES with SLOW_QUERY_LOG_BACKUPS old files kept.
+'''
+
+_logger = logging.getLogger("inlibris.slow_queries")
+
+# Statements that SQLite can explain; PRAGMAs and transaction control can't
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+class QueryPlanHandler(RotatingFileHandler):
+    """
+    Rotating file handler that adds the query plan of the statement to the
+    slow query records before writing them.
+    """
+
+    def __init__(self, engine, filename, max_bytes, backups):
+        super(QueryPlanHandler, self).__init__(filename, maxBytes=max_bytes, backupCount=backups)
+        self.engine = engine
+        self.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    def explain(self, statement, parameters):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            # (id, parent, notused, detail), the detail is indented by the
+            # depth of its parent
+            depths = {0: 0}
+            lines = []
+            for node, parent, _, detail in cursor.fetchall():
+                depths[node] = depths.get(parent, 0) + 1
+                lines.append("    " + "  " * depths[node] + detail)
+            cursor.close()
+            return "\n".join(lines)
+        finally:
+            connection.close()
+
+    def emit(self, record):
+        if record.executemany or not record.statement.lstrip().upper().startswith(EXPLAINABLE):
+            plan = "    (not explained)"
+        else:
+            try:
+                plan = self.explain(record.statement, record.parameters)
+            except Exception as e:
+                plan = "    (not explained: {})".format(e)
+        record.msg = "{}\n  plan:\n{}".format(record.msg, plan)
+        super(QueryPlanHandler, self).emit(record)
+
+class SlowQueryLog(object):
+    """
+    Times the statements of an engine and queues the slow ones for the
+    listener thread.
+    """
+
+    def __init__(self, engine, threshold, filename, max_bytes, backups):
+        self.threshold = threshold
+        self.queue = queue.Queue(-1)
+        self.handler = QueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, QueryPlanHandler(engine, filename, max_bytes, backups))
+        self.running = False
+        event.listen(engine, "before_cursor_execute", self._before_query)
+        event.listen(engine, "after_cursor_execute", self._after_query)
+
+    def start(self):
+        self.listener.start()
+        self.running = True
+
+    def stop(self):
+        """
+        Write the queued records and stop the listener thread.
+        """
+
+        if self.running:
+            self.listener.stop()
+            self.running = False
+        for handler in self.listener.handlers:
+            handler.close()
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._slow_query_start = time.perf_counter()
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_slow_query_start", None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        if duration < self.threshold:
+            return
+
+        if has_request_context():
+            origin = "{} {}".format(request.method, request.endpoint)
+        else:
+            origin = "-"
+        record = _logger.makeRecord(
+            _logger.name, logging.WARNING, __file__, 0,
+            "%.2f ms %s\n  %s\n  parameters: %r",
+            (duration * 1000, origin, " ".join(statement.split()), parameters),
+            None,
+            extra={"statement": statement, "parameters": parameters, "executemany": executemany}
+        )
+        self.handler.handle(record)
+
+def init_app(app):
+    app.config.setdefault("SLOW_QUERY_THRESHOLD", None)
+    app.config.setdefault("SLOW_QUERY_LOG", os.path.join(app.instance_path, "slow_queries.log"))
+    app.config.setdefault("SLOW_QUERY_LOG_BYTES", 10 * 1024 * 1024)
+    app.config.setdefault("SLOW_QUERY_LOG_BACKUPS", 5)
+
+    if app.config["SLOW_QUERY_THRESHOLD"] is None:
+        return
+
+    log = SlowQueryLog(
+        db.get_engine(app),
+        app.config["SLOW_QUERY_THRESHOLD"],
+        app.config["SLOW_QUERY_LOG"],
+        app.config["SLOW_QUERY_LOG_BYTES"],
+        app.config["SLOW_QUERY_LOG_BACKUPS"]
+    )
+    app.extensions["slow_query_log"] = log
+    log.start()
+    atexit.register(log.stop)
@@ -7,7 +7,13 @@ const ENTRYPOINT = "http://localhost:5000/inlibris/api/";
 
 var current_book_object = null;
 var current_patron_object = null;
-var all_patrons = null;
+var patron_search_href = null;
+var patron_search_timer = null;
+var patron_search_seq = 0;
+
+// Milliseconds to wait after the last keystroke before searching
+const SEARCH_DELAY = 250;
+const SEARCH_LIMIT = 10;
 
 /*
 
@@ -58,6 +64,7 @@ function emptySecondTable() {
 }
 
 function renderEntrypoint(body) {
+    patron_search_href = body["@controls"]["inlibris:patrons-search"].href;
     $("div.navigation").html(
         "<a href='" +
         body["@controls"]["inlibris:patrons-all"].href +
@@ -73,6 +80,22 @@ function renderEntrypoint(body) {
     emptySecondTable();
 }
 
+function pageLinks(body, renderer) {
+    // Renders links to the previous and next pages of a paginated collection
+    let links = [];
+    if (body["@controls"].prev) {
+        links.push("<a href='" +
+            body["@controls"].prev.href +
+            "' onClick='followLink(event, this, " + renderer + ")'>&lt;&lt; Previous</a>");
+    }
+    if (body["@controls"].next) {
+        links.push("<a href='" +
+            body["@controls"].next.href +
+            "' onClick='followLink(event, this, " + renderer + ")'>Next &gt;&gt;</a>");
+    }
+    return links.join(" | ");
+}
+
 function patronRow(item) {
     let link = "<a href='" +
             item["@controls"].self.href +
@@ -111,7 +134,7 @@ function renderPatrons(body) {
     items.forEach(function (item) {
         tbody.append(patronRow(item));
     });
-    $("div.form").empty();
+    $("div.form").html(pageLinks(body, "renderPatrons"));
     emptySecondTable();
 }
 
@@ -123,29 +146,23 @@ function refreshPatron(item) {
 }
 
 function renewLoan(item) {
-    $.ajax({
-        url: item["@controls"]["inlibris:target-book"].href,
-        success: function(data) {
-            if (item.renewed < data.renewlimit) {
-                item.renewed = item.renewed + 1;
-                let m = new Date();
-                item.renewaldate = m.getUTCFullYear() + "-" + (m.getUTCMonth() + 1) + "-" + m.getUTCDate();
-                m.setDate(m.getDate() + data.loantime);
-                item.duedate = m.getUTCFullYear() + "-" + (m.getUTCMonth() + 1) + "-" + m.getUTCDate();
-                item.status = "Renewed";
-                sendData(item["@controls"].edit.href, item["@controls"].edit.method, item, refreshPatronView(item));
-            }
-        },
-        error: renderError
+    // The server checks the renewal limit and counts the new due date
+    let ctrl = item["@controls"]["inlibris:renew"];
+    sendData(ctrl.href, ctrl.method, {}, function () {
+        refreshPatron(item);
     });
 }
 
 function returnLoan(item) {
-    sendData(item["@controls"]["inlibris:delete"].href, item["@controls"]["inlibris:delete"].method, item, refreshPatronView(item));
+    let ctrl = item["@controls"]["inlibris:delete"];
+    sendData(ctrl.href, ctrl.method, item, function () {
+        refreshPatron(item);
+    });
 }
 
 function appendLoanRow(body) {
-    // Appends a row to secondtable when patron has loans. Is called from renderLoansBy
+    // Appends a row to secondtable when patron has loans. Is called from renderLoansBy with
+    // a loan item that has its book embedded, so no more requests are needed.
     let link = "<a href='" +
             body["@controls"]["inlibris:target-book"].href +
             "' onClick='followLink(event, this, renderBook)'>" + body.book_barcode + "</a>";
@@ -153,35 +170,28 @@ function appendLoanRow(body) {
     let renewLink = "Book late, cannot be renewed!";
     let status = body.status;
 
-    $.ajax({
-        url: body["@controls"]["inlibris:target-book"].href,
-        success: function(data) {
+    if (status === "Renewed") {
+        status = status + " (" + body.renewed + "/" + body.book.renewlimit + ")";
+    }
 
-            if (status === "Renewed") {
-                status = status + " (" + body.renewed + "/" + data.renewlimit + ")";
-            }
-
-            let duedate = Date.parse(body.duedate);
-            if (duedate > Date.now()) {
-                renewLink = "<a href='" +
-                        body["@controls"].self.href +
-                        "' onClick='followLink(event, this, renewLoan)'>Renew</a>";
-            }
-
-            let returnLink = "<a href='" +
-                    body["@controls"].self.href +
-                    "' onClick='followLink(event, this, returnLoan)'>Return</a>";
-
-            $(".secondresulttable tbody").append(
-                "<tr><td>" + link +
-                "</td><td>" + body.loandate +
-                "</td><td>" + body.duedate +
-                "</td><td>" + status +
-                "</td><td>" + renewLink + "  |  " + returnLink + "</td></tr>"
-            );
-        },
-        error: renderError
-    });
+    let duedate = Date.parse(body.duedate);
+    if (duedate > Date.now()) {
+        renewLink = "<a href='" +
+                body["@controls"].self.href +
+                "' onClick='followLink(event, this, renewLoan)'>Renew</a>";
+    }
+
+    let returnLink = "<a href='" +
+            body["@controls"].self.href +
+            "' onClick='followLink(event, this, returnLoan)'>Return</a>";
+
+    $(".secondresulttable tbody").append(
+        "<tr><td>" + link +
+        "</td><td>" + body.loandate +
+        "</td><td>" + body.duedate +
+        "</td><td>" + status +
+        "</td><td>" + renewLink + "  |  " + returnLink + "</td></tr>"
+    );
 }
 
 function renderLoansBy(body) {
@@ -193,9 +203,7 @@ function renderLoansBy(body) {
             "<tr><th>Barcode</th><th>Loan date</th><th>Due date</th><th>Status</th><th>Actions</th></tr>"
         );   
         $(".secondresulttable tbody").empty();
-        items.forEach(function (item) {
-            getResource(item["@controls"].self.href, appendLoanRow);
-        });
+        items.forEach(appendLoanRow);
     } else {
         $(".secondresulttable thead").html(
             "<p>No loans</p>"
@@ -246,7 +254,7 @@ function renderPatron(body) {
             "<td>" + body.regdate + "</td>" +
         "</tr>"
     );
-    getResource(body["@controls"]["inlibris:loans-by"].href, renderLoansBy);
+    getResource(body["@controls"]["inlibris:loans-by"].href + "?embed=book", renderLoansBy);
 }
 
 function bookRow(item) {
@@ -266,42 +274,34 @@ function renderLoanOf(item) {
         "<h3>Loan status</h3>"
     );
     $(".secondresulttable thead").empty();
-    $(".secondresulttable tbody").empty();
-    $.ajax({
-        url: item["@controls"]["inlibris:target-book"].href,
-        success: function(data) {
 
-            let status = item.status;
-            if (status === "Renewed") {
-                status = status + " (" + item.renewed + "/" + data.renewlimit + ")";
-            }
-
-            let link = "<a href='" +
-                    item["@controls"].author.href +
-                    "' onClick='followLink(event, this, renderPatron)'>" + item.patron_barcode + "</a>";
-
-
-            $(".secondresulttable tbody").html(
-                "<tr>" +
-                    "<th>Status</th>" +
-                    "<td>" + status + "</td>" +
-                "</tr>" +
-                "<tr>" +
-                    "<th>Patron</th>" +
-                    "<td>" + link + "</td>" +
-                "</tr>" +
-                "<tr>" +
-                    "<th>Loan date</th>" +
-                    "<td>" + item.loandate + "</td>" +
-                "</tr>" +
-                "<tr>" +
-                    "<th>Due date</th>" +
-                    "<td>" + item.duedate + "</td>" +
-                "</tr>"
-            );
-        },
-        error: renderError
-    });
+    let status = item.status;
+    if (status === "Renewed") {
+        status = status + " (" + item.renewed + "/" + current_book_object.renewlimit + ")";
+    }
+
+    let link = "<a href='" +
+            item["@controls"].author.href +
+            "' onClick='followLink(event, this, renderPatron)'>" + item.patron_barcode + "</a>";
+
+    $(".secondresulttable tbody").html(
+        "<tr>" +
+            "<th>Status</th>" +
+            "<td>" + status + "</td>" +
+        "</tr>" +
+        "<tr>" +
+            "<th>Patron</th>" +
+            "<td>" + link + "</td>" +
+        "</tr>" +
+        "<tr>" +
+            "<th>Loan date</th>" +
+            "<td>" + item.loandate + "</td>" +
+        "</tr>" +
+        "<tr>" +
+            "<th>Due date</th>" +
+            "<td>" + item.duedate + "</td>" +
+        "</tr>"
+    );
 }
 
 function refreshBook(data) {
@@ -339,45 +339,50 @@ function renderLoanPatronLink(item) {
     return "<td>" + link + "</td>";
 }
 
-function filterPatronsFunction() {
+function searchPatronsFunction() {
     /*
-    Filters the patron list held at global variable all_patrons with the contents of the
-    input field created at renderLoanOfError. Is called every time the user writes a letter
-    in the input field. Renders the results in the second table with a link to create the loan.
-
-    Filtering is modified from https://www.w3schools.com/howto/howto_js_filter_lists.asp
+    Searches patrons by barcode, name or email with the contents of the input field created
+    at renderLoanOfError. Is called every time the user writes a letter in the input field,
+    but only sends the request once the user has stopped typing for SEARCH_DELAY ms. Renders
+    the results in the second table with a link to create the loan.
     */
-    var input = document.getElementById("patronSearch");
-    var filter = input.value.toUpperCase();
-    var filtered_patrons = [];
-    var i, patron;
-
-    var tbody = $(".secondresulttable tbody");
-    tbody.empty();
-    tbody.append("<br>");
-
-    for (i = 0; i < all_patrons.length; i += 1) {
-        patron = all_patrons[i];
-        if (patron.barcode.toString().indexOf(filter) > -1) {
-            filtered_patrons.push(patron);
+    clearTimeout(patron_search_timer);
+    patron_search_timer = setTimeout(function () {
+        let query = document.getElementById("patronSearch").value.trim();
+        let tbody = $(".secondresulttable tbody");
+        // Responses to older searches that arrive late are ignored
+        let seq = patron_search_seq += 1;
+
+        if (query === "") {
+            tbody.empty();
+            return;
         }
-    }
 
-    if (filtered_patrons.length > 10) {
-        tbody.append("Too many results!");
-    } else {
-        for (i = 0; i < filtered_patrons.length; i += 1) {
-            patron = filtered_patrons[i];
-            tbody.append("<tr>");
-            tbody.append(renderLoanPatronLink(patron));
-            tbody.append("</tr>");
-        }
-    }
+        $.ajax({
+            url: patron_search_href.replace("{q}", encodeURIComponent(query)) + "&limit=" + SEARCH_LIMIT,
+            success: function (body) {
+                if (seq !== patron_search_seq) {
+                    return;
+                }
+                tbody.empty();
+                tbody.append("<br>");
+                body.items.forEach(function (patron) {
+                    tbody.append("<tr>");
+                    tbody.append(renderLoanPatronLink(patron));
+                    tbody.append("</tr>");
+                });
+                if (body["@controls"].next) {
+                    tbody.append("More results, keep typing...");
+                }
+            },
+            error: renderError
+        });
+    }, SEARCH_DELAY);
 }
 
 function renderLoanOfError(xhr, ajaxOptions, thrownError) {
     /*
-    Renders an input field to search patrons using patron barcode to create a loan for a book.
+    Renders an input field to search patrons to create a loan for a book.
     Is called from renderBook when the book is not loaned.
     Is called renderLoanOfError because renderBook works by trying to GET the LoanItem and if
     it receives an error code 400, this function renders the input form.
@@ -388,25 +393,8 @@ function renderLoanOfError(xhr, ajaxOptions, thrownError) {
             "<h3>Loan status</h3>"
         );
 
-        if (all_patrons === null) {
-            $.ajax({
-                url: current_book_object["@controls"].collection.href,
-                success: function(data) {
-                    $.ajax({
-                        url: data["@controls"]["inlibris:patrons-all"].href,
-                        book_barcode: current_book_object.barcode,
-                        success: function(data) {
-                            all_patrons = data.items;
-                        },
-                        error: renderError
-                    });
-                },
-                error: renderError
-            });
-        }
-
         $(".secondresulttable thead").html(
-            "Create a loan for: <input type='text' id='patronSearch' onkeyup='filterPatronsFunction()' placeholder='Enter patron barcode...'>"
+            "Create a loan for: <input type='text' id='patronSearch' onkeyup='searchPatronsFunction()' placeholder='Enter patron barcode, name or email...'>"
         );
     }
 }
@@ -493,7 +481,7 @@ function renderBooks(body) {
     items.forEach(function (item) {
         tbody.append(bookRow(item));
     });
-    $("div.form").empty();
+    $("div.form").html(pageLinks(body, "renderBooks"));
     emptySecondTable();
 }
 
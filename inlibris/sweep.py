@@ -0,0 +1,189 @@
+import click
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, exists, func, select
+
+from inlibris.models import Loan, Hold, bump_versions
+from inlibris.holds import REQUESTED, ON_HOLD, EXPIRED, PICKUP_DAYS
+from inlibris import db
+
+'''
+Status sweeper. Moves the requested holds past their expiration date and the
+holds that were not picked up in time to "Expired", promoting the next hold
+of those books, and the loans past their due date to "Late".
+
+The holds and loans are updated with set-based UPDATEs that pick at most
+SWEEP_BATCH_SIZE rows through the date indexes, without loading them. Each
+batch is its own short transaction, so the write lock is released between
+the batches and a sweep over a large table doesn't block the requests for
+long. The sweep can be run with the "flask sweep" command, or every
+SWEEP_INTERVAL seconds in the process of the app.
+'''
+
+LATE = "Late"
+OVERDUE_STATUSES = ("Charged", "Renewed")
+
+def _update_in_batches(table, values, condition, batch_size):
+    """
+    Update the rows of "table" that match "condition" with "values", at most
+    "batch_size" rows per transaction. Returns the number of updated rows.
+    """
+
+    batch = select([table.c.id]).where(condition).limit(batch_size)
+    total = 0
+    while True:
+        with db.engine.begin() as connection:
+            count = connection.execute(
+                table.update().where(table.c.id.in_(batch)).values(**values)
+            ).rowcount
+            if count:
+                bump_versions(connection, [table.name])
+        total += count
+        if count < batch_size:
+            return total
+
+def _expire_pickups(today, batch_size):
+    """
+    Expire the holds that were not picked up by their pickup date, at most
+    "batch_size" per transaction, and promote the next requested hold of
+    each of their books. Returns the number of expired and promoted holds.
+    """
+
+    holds = Hold.__table__
+    loans = Loan.__table__
+    expiring = holds.alias("expiring")
+    waiting = holds.alias("waiting")
+    # Both statements pick the same batch: the promotion runs first, while
+    # the expired holds still mark their books, and gives the new holds a
+    # pickup date in the future so that the second statement skips them.
+    batch = (select([expiring.c.id, expiring.c.book_id])
+        .where(and_(expiring.c.status == ON_HOLD, expiring.c.pickupdate < today))
+        .order_by(expiring.c.id)
+        .limit(batch_size)
+        .alias("batch")
+    )
+    first = (select([func.min(waiting.c.id)])
+        .where(and_(
+            waiting.c.status == REQUESTED,
+            waiting.c.book_id.in_(select([batch.c.book_id])),
+            ~exists().where(loans.c.book_id == waiting.c.book_id)
+        ))
+        .group_by(waiting.c.book_id)
+    )
+    promote = (holds.update()
+        .where(holds.c.id.in_(first))
+        .values(status=ON_HOLD, pickupdate=today + timedelta(days=PICKUP_DAYS))
+    )
+    expire = (holds.update()
+        .where(holds.c.id.in_(select([batch.c.id])))
+        .values(status=EXPIRED)
+    )
+
+    total = 0
+    promoted = 0
+    while True:
+        with db.engine.begin() as connection:
+            promoted += connection.execute(promote).rowcount
+            count = connection.execute(expire).rowcount
+            if count:
+                bump_versions(connection, [holds.name])
+        total += count
+        if count < batch_size:
+            return total, promoted
+
+def sweep(today=None, batch_size=None):
+    """
+    Run one sweep. Holds and loans are expired or late from the day after
+    their date. "today" defaults to the current date. Returns the number of
+    rows changed by each step as a dictionary.
+
+    Raises ValueError if "batch_size" is less than 1.
+    """
+
+    if batch_size is None:
+        batch_size = current_app.config["SWEEP_BATCH_SIZE"]
+    if batch_size < 1:
+        raise ValueError("The batch size must be at least 1")
+    today = datetime.combine(today or datetime.now().date(), datetime.min.time())
+
+    holds = Hold.__table__
+    loans = Loan.__table__
+    counts = {}
+    counts["expired_holds"] = _update_in_batches(
+        holds,
+        {"status": EXPIRED},
+        and_(holds.c.status == REQUESTED, holds.c.expirationdate < today),
+        batch_size
+    )
+    counts["expired_pickups"], counts["promoted_holds"] = _expire_pickups(today, batch_size)
+    counts["late_loans"] = _update_in_batches(
+        loans,
+        {"status": LATE, "version": loans.c.version + 1},
+        and_(loans.c.status.in_(OVERDUE_STATUSES), loans.c.duedate < today),
+        batch_size
+    )
+
+    # The UPDATEs bypass the session, so they can't invalidate single entries
+    # of the response cache.
+    if any(counts.values()) and "response_cache" in current_app.extensions:
+        current_app.extensions["response_cache"].clear()
+
+    return counts
+
+@click.command("sweep")
+@click.option("--batch-size", default=None, type=click.IntRange(min=1), help="Rows per transaction (default: SWEEP_BATCH_SIZE).")
+@with_appcontext
+def sweep_command(batch_size):
+    counts = sweep(batch_size=batch_size)
+    click.echo(
+        'Swept the database: {expired_holds} holds and {expired_pickups} pickups expired, '
+        '{promoted_holds} holds promoted, {late_loans} loans late.'.format(**counts)
+    )
+
+class Sweeper(object):
+    """
+    Background thread that runs a sweep every "interval" seconds in the
+    process of the app.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="inlibris-sweeper", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    sweep()
+                except Exception:
+                    self.app.logger.exception("Sweep failed")
+                finally:
+                    db.session.remove()
+
+def init_app(app):
+    """
+    Add the sweep command and start the sweeper thread if SWEEP_INTERVAL (in
+    seconds) is set.
+    """
+
+    app.config.setdefault("SWEEP_INTERVAL", 0)
+    app.config.setdefault("SWEEP_BATCH_SIZE", 1000)
+    if app.config["SWEEP_BATCH_SIZE"] < 1:
+        raise ValueError("SWEEP_BATCH_SIZE must be at least 1")
+    app.cli.add_command(sweep_command)
+
+    if app.config["SWEEP_INTERVAL"] > 0:
+        sweeper = Sweeper(app, app.config["SWEEP_INTERVAL"])
+        app.extensions["sweeper"] = sweeper
+        sweeper.start()
@@ -1,13 +1,17 @@
 from datetime import datetime, timedelta
+from functools import wraps
 import json
+import re
+from urllib.parse import urlencode
 
 from flask_restful import Resource, Api
-from flask import Flask, Response, request
+from flask import Flask, Response, current_app, g, request, url_for
 from flask_sqlalchemy import SQLAlchemy
 
-from inlibris.models import Patron, Book, Hold, Loan
+from inlibris.models import Patron, Book, Hold, Loan, get_versions, get_row_versions
 from inlibris.constants import *
-from . import api
+from inlibris import db
+from inlibris.schemas import schemas
 
 '''
 This is a collection of random utility functions and classes for the API.
@@ -36,6 +40,328 @@ def date_converter(date_str):
 
     return datetime.strptime(date_str, "%Y-%m-%d").date()
 
+def update_from_json(obj, schema, document):
+    """
+    Replace the attributes of the model instance "obj" that are described by
+    the properties of "schema" with the values from "document". Properties
+    missing from the document get the default of the schema (or None), the
+    same values a new row created from the document would get.
+    """
+
+    for name, prop in schema["properties"].items():
+        setattr(obj, name, document.get(name, prop.get("default")))
+
+def _parse_sql_integer(value):
+    """
+    Parse a query parameter as a non-negative integer that fits a SQLite
+    INTEGER. Returns None if it doesn't.
+    """
+
+    if not value.isascii() or not value.isdigit():
+        return None
+    number = int(value)
+    if number > MAX_SQL_INTEGER:
+        return None
+    return number
+
+def parse_page_args():
+    """
+    Read the pagination query parameters "limit", "after" and "before" from
+    the current request. Returns a tuple (limit, after, before) where the
+    cursors are None when not given.
+
+    Raises ValueError if a parameter is not a positive integer that fits a
+    SQLite INTEGER or if both "after" and "before" are given.
+    """
+
+    args = {}
+    for name in ("limit", "after", "before"):
+        value = request.args.get(name)
+        if value is None:
+            args[name] = None
+            continue
+        number = _parse_sql_integer(value)
+        if number is None or number < 1:
+            raise ValueError("Query parameter '{}' must be a positive integer".format(name))
+        args[name] = number
+
+    if args["after"] is not None and args["before"] is not None:
+        raise ValueError("Query parameters 'after' and 'before' can't be used together")
+
+    limit = min(args["limit"] or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    return limit, args["after"], args["before"]
+
+def parse_key_list_arg():
+    """
+    Read the query parameter "ids" or "barcodes" of a multi-get request: a
+    comma separated list of at most MAX_BATCH_KEYS integers. Returns a tuple
+    (name, keys) with the keys in the given order without duplicates, or
+    None if neither parameter is given.
+
+    Raises ValueError if both parameters are given or the list is invalid.
+    """
+
+    names = [name for name in ("ids", "barcodes") if name in request.args]
+    if not names:
+        return None
+    if len(names) > 1:
+        raise ValueError("Query parameters 'ids' and 'barcodes' can't be used together")
+
+    name = names[0]
+    keys = []
+    seen = set()
+    for value in request.args[name].split(","):
+        key = _parse_sql_integer(value.strip())
+        if key is None:
+            raise ValueError("Query parameter '{}' must be a comma separated list of integers".format(name))
+        if key in seen:
+            continue
+        if len(keys) == MAX_BATCH_KEYS:
+            raise ValueError("Query parameter '{}' can have at most {} values".format(name, MAX_BATCH_KEYS))
+        seen.add(key)
+        keys.append(key)
+    return name, keys
+
+def fetch_by_keys(query, column, keys):
+    """
+    Fetch the rows of "query" whose "column" is one of "keys" with a single
+    IN query. Returns a tuple (rows, missing), where the rows are in the
+    order of "keys" and "missing" lists the keys that matched no row.
+    """
+
+    found = dict((getattr(row, column.key), row) for row in query.filter(column.in_(keys)))
+    rows = [found[key] for key in keys if key in found]
+    missing = [key for key in keys if key not in found]
+    return rows, missing
+
+def parse_search_args():
+    """
+    Read the search query parameters "q", "limit" and "offset" from the
+    current request. Returns a tuple (q, limit, offset).
+
+    Raises ValueError if "q" is missing or "limit" or "offset" is not a
+    non-negative integer that fits a SQLite INTEGER.
+    """
+
+    q = request.args.get("q", "").strip()
+    if not q:
+        raise ValueError("Query parameter 'q' is required")
+
+    args = {}
+    for name in ("limit", "offset"):
+        value = request.args.get(name)
+        if value is None:
+            args[name] = None
+            continue
+        args[name] = _parse_sql_integer(value)
+        if args[name] is None:
+            raise ValueError("Query parameter '{}' must be a non-negative integer".format(name))
+
+    limit = min(args["limit"] or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    return q, limit, args["offset"] or 0
+
+def fts_query(q):
+    """
+    Turn the free text "q" into an FTS5 MATCH expression that finds rows
+    containing all of its words. Every word is quoted, so the FTS5 query
+    syntax (AND, NEAR, column filters...) can't be injected, and the last
+    word matches as a prefix for search-as-you-type.
+
+    Raises ValueError if "q" has no words.
+    """
+
+    words = re.findall(r"\w+", q)[:MAX_SEARCH_TERMS]
+    if not words:
+        raise ValueError("Query parameter 'q' must contain at least one word")
+    terms = ['"{}"'.format(word) for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def keyset_page(query, column, limit, after=None, before=None):
+    """
+    Fetch one page of "query" using keyset pagination on the unique, indexed
+    "column". Only rows with "column" greater than "after" (or less than
+    "before") are read, so the cost of a page does not depend on how deep the
+    client has paged. One extra row is fetched to find out if there is more.
+
+    Returns a tuple (rows, has_prev, has_next).
+    """
+
+    if before is not None:
+        rows = query.filter(column < before).order_by(column.desc()).limit(limit + 1).all()
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_prev, True
+
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(limit + 1).all()
+    return rows[:limit], after is not None, len(rows) > limit
+
+def stream_collection(body, rows, render):
+    """
+    Generate the JSON of the collection document "body" piece by piece with
+    the items rendered from "rows" by the function "render". The output is
+    the same as json.dumps would give for the whole document, but only one
+    batch of items is held in memory at a time. Should be used with rows
+    from a query using yield_per, wrapped in stream_with_context.
+    """
+
+    envelope = dict(body)
+    envelope.pop("items", None)
+
+    yield '{"items": ['
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(render(row)))
+        if len(batch) == STREAM_BATCH_SIZE:
+            yield ", ".join(batch)
+            # The empty string makes the next batch start with a separator
+            batch = [""]
+    if batch != [""]:
+        yield ", ".join(batch)
+    if envelope:
+        yield "], " + json.dumps(envelope)[1:]
+    else:
+        yield "]}"
+
+def embed_names():
+    """
+    The names in the comma separated "embed" query parameter of the current
+    request as a set, without checking them.
+    """
+
+    return set(name.strip() for name in request.args.get("embed", "").split(",") if name.strip())
+
+def parse_embed_arg(allowed):
+    """
+    Read the "embed" query parameter that lists the related resources to
+    embed in the requested document. Returns the names as a set.
+
+    Raises ValueError if a name is not one of "allowed".
+    """
+
+    names = embed_names()
+    unknown = names.difference(allowed)
+    if unknown:
+        raise ValueError("Can't embed '{}', choose from: {}".format(
+            "', '".join(sorted(unknown)), ", ".join(allowed)
+        ))
+    return names
+
+def with_embedded(values, embed, names):
+    """
+    Add the values that "embed" maps to each of the "names" after "values",
+    leaving out duplicates. Used by the decorators to widen what a response
+    depends on when related resources are embedded in it.
+    """
+
+    result = list(values)
+    for name in sorted(names):
+        for value in embed.get(name, ()):
+            if value not in result:
+                result.append(value)
+    return result
+
+def row_etag(obj):
+    """
+    The part of an ETag that identifies the version of a versioned row, e.g.
+    "book.1.v3" for version 3 of book 1.
+    """
+
+    return "{}.{}.v{}".format(obj.__tablename__, obj.id, obj.version)
+
+def conditional(*tables, embed=None, row=None):
+    """
+    Decorator for resource GET methods that adds a strong ETag to 200
+    responses and answers "If-None-Match" requests with 304 Not Modified. The
+    ETag is made from the change counters of "tables", which must contain all
+    the tables the representation is built from. A request whose ETag still
+    matches costs just one query for the counters.
+
+    "embed" maps the names accepted in the "embed" query parameter to the
+    extra tables the embedded documents are built from.
+
+    "row" is a tuple (column, name) for item resources of versioned models,
+    e.g. (Book.id, "book_id"). The ETag then starts with the version of the
+    row whose column equals the keyword argument "name" (see row_etag), which
+    is what "If-Match" is checked against on writes.
+
+    Representations with schema URLs (see prefers_schema_urls) get their own
+    ETags.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            used = with_embedded(tables, embed or {}, embed_names())
+            # The counters are read before the data, so a concurrent write can
+            # only make the ETag older than the body, never newer.
+            if row is not None:
+                column, name = row
+                versions = get_row_versions(column, kwargs[name], used)
+                if versions is None:
+                    return method(*args, **kwargs)
+                row_id, row_version, counters = versions
+                parts = ["{}.{}.v{}".format(column.class_.__tablename__, row_id, row_version)]
+            else:
+                counters = get_versions(used)
+                parts = []
+            parts.extend("{}.{}".format(table, version) for table, version in zip(used, counters))
+            if prefers_schema_urls():
+                parts.append("schemaurl")
+            etag = "-".join(parts)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = method(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+def check_if_match(obj):
+    """
+    Check the "If-Match" header of a write request against the version of
+    the row "obj". Only the row part of the ETags is compared, so the ETag of
+    any representation of the item (with or without embedded documents) can
+    be used. Returns an error response or None if the write can go on.
+
+    Without the header the write goes on, unless the config value
+    REQUIRE_IF_MATCH is true.
+    """
+
+    if not request.if_match:
+        if current_app.config["REQUIRE_IF_MATCH"]:
+            return create_error_response(428,
+                "Precondition required",
+                "Requests must have an If-Match header with the ETag of the resource"
+            )
+        return None
+
+    current = row_etag(obj)
+    if request.if_match.star_tag or any(tag.split("-")[0] == current for tag in request.if_match):
+        return None
+    return create_error_response(412,
+        "Precondition failed",
+        "The resource has been modified since it was read"
+    )
+
+def stale_response():
+    """
+    The response for a write whose row was changed by another request after
+    it was read, detected by the version check of the UPDATE or DELETE.
+    """
+
+    return create_error_response(412,
+        "Precondition failed",
+        "The resource was modified by another request"
+    )
+
 class MasonBuilder(dict):
     """
     A convenience class for managing dictionaries that represent Mason
@@ -106,34 +432,30 @@ class MasonBuilder(dict):
 class LibraryBuilder(MasonBuilder):
     """
     An application specific subclass for MasonBuilder to manage adding
-    hypermedia controls to json documents. Loads and reads all the schemas
-    from the static schema folder.
+    hypermedia controls to json documents. The schemas come from the schema
+    registry, which loads them from the static schema folder when the app is
+    created.
     """
 
     @staticmethod
-    def patron_schema():
-        print(api.api_bp.static_folder + '/schema/patron.json')
-        with open(api.api_bp.static_folder + '/schema/patron.json', 'r') as f:
-            schema = json.load(f)
-        return schema
+    def schema_property(name):
+        """
+        The schema property of a control for the schema called "name": the
+        schema itself, or its URL as "schemaUrl" when the client prefers
+        schema URLs (see prefers_schema_urls).
+        """
 
-    @staticmethod
-    def book_schema():
-        with open(api.api_bp.static_folder + '/schema/book.json', 'r') as f:
-            schema = json.load(f)
-        return schema
+        if prefers_schema_urls():
+            return {"schemaUrl": schema_url(name)}
+        return {"schema": schemas.schema(name)}
 
     @staticmethod
-    def edit_loan_schema():
-        with open(api.api_bp.static_folder + '/schema/edit_loan.json', 'r') as f:
-            schema = json.load(f)
-        return schema
+    def patron_schema():
+        return schemas.schema("patron")
 
     @staticmethod
-    def add_loan_schema():
-        with open(api.api_bp.static_folder + '/schema/add_loan.json', 'r') as f:
-            schema = json.load(f)
-        return schema
+    def book_schema():
+        return schemas.schema("book")
 
     '''
     # Commented out due to holds not being implemented
@@ -180,29 +502,6 @@ class LibraryBuilder(MasonBuilder):
         return schema
     '''
 
-    '''
-    # Commented out due to holds not being implemented
-    @staticmethod
-    def add_hold_schema():    
-        schema = {
-            "type": "object",
-            "required": ["book_barcode"]
-        }
-        props = schema["properties"] = {}
-        props["book_barcode"] = {
-            "description": "Book's unique barcode",
-            "type": "integer",
-            "minimum": 200000,
-            "maximum": 299999
-        }
-        props["expirationdate"] = {
-            "description": "Hold's expiration date",
-            "type": "string",
-            "format": "date"
-        }
-        return schema
-    '''
-
     def add_control_all_patrons(self):
         self.add_control(
             "inlibris:patrons-all",
@@ -219,6 +518,72 @@ class LibraryBuilder(MasonBuilder):
             title="Get all books"
         )
 
+    def add_control_pages(self, href, rows, limit, has_prev, has_next):
+        """
+        Adds "prev" and "next" controls for a page of a collection that was
+        fetched with keyset_page. The cursors are the ids of the first and
+        last rows of the page.
+        """
+
+        if not rows:
+            return
+
+        if has_prev:
+            self.add_control(
+                "prev",
+                "{}?limit={}&before={}".format(href, limit, rows[0].id),
+                method="GET",
+                title="Previous page"
+            )
+
+        if has_next:
+            self.add_control(
+                "next",
+                "{}?limit={}&after={}".format(href, limit, rows[-1].id),
+                method="GET",
+                title="Next page"
+            )
+
+    def add_control_search_pages(self, href, q, limit, offset, has_next):
+        """
+        Adds "prev" and "next" controls for a page of search results, which
+        are ordered by rank and paged by offset.
+        """
+
+        if offset > 0:
+            self.add_control(
+                "prev",
+                "{}?{}".format(href, urlencode({"q": q, "limit": limit, "offset": max(offset - limit, 0)})),
+                method="GET",
+                title="Previous page"
+            )
+
+        if has_next:
+            self.add_control(
+                "next",
+                "{}?{}".format(href, urlencode({"q": q, "limit": limit, "offset": offset + limit})),
+                method="GET",
+                title="Next page"
+            )
+
+    def add_control_search_patrons(self):
+        self.add_control(
+            "inlibris:patrons-search",
+            "/inlibris/api/patrons/search/?q={q}",
+            isHrefTemplate=True,
+            method="GET",
+            title="Search patrons by barcode, name or email"
+        )
+
+    def add_control_search_books(self):
+        self.add_control(
+            "inlibris:books-search",
+            "/inlibris/api/books/search/?q={q}",
+            isHrefTemplate=True,
+            method="GET",
+            title="Search books by title, author and description"
+        )
+
     def add_control_delete_patron(self, patron_id):
         self.add_control(
             "inlibris:delete",
@@ -243,8 +608,6 @@ class LibraryBuilder(MasonBuilder):
             title="Delete this loan"
         )
 
-    '''
-    # Commented out due to holds not being implemented
     def add_control_delete_hold(self, patron_id, hold_id):
         self.add_control(
             "inlibris:delete",
@@ -252,7 +615,6 @@ class LibraryBuilder(MasonBuilder):
             method="DELETE",
             title="Delete this hold"
         )
-    '''
 
     def add_control_add_patron(self):
         self.add_control(
@@ -261,7 +623,7 @@ class LibraryBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a patron",
-            schema=self.patron_schema()
+            **self.schema_property("patron")
         )
         
     def add_control_edit_patron(self, patron_id):
@@ -271,7 +633,7 @@ class LibraryBuilder(MasonBuilder):
             title="Edit this patron",
             encoding="json",
             method="PUT",
-            schema=self.patron_schema()
+            **self.schema_property("patron")
         )
 
     def add_control_add_book(self):
@@ -281,7 +643,7 @@ class LibraryBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a book",
-            schema=self.book_schema()
+            **self.schema_property("book")
         )
 
     def add_control_edit_book(self, book_id):
@@ -291,7 +653,7 @@ class LibraryBuilder(MasonBuilder):
             title="Edit this book",
             encoding="json",
             method="PUT",
-            schema=self.book_schema()
+            **self.schema_property("book")
         )
 
     def add_control_loans_by(self, patron_id):
@@ -309,7 +671,27 @@ class LibraryBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title="Add a new loan to this patron",
-            schema=self.add_loan_schema()
+            **self.schema_property("add_loan")
+        )
+
+    def add_control_checkout(self, patron_id):
+        self.add_control(
+            "inlibris:checkout",
+            "/inlibris/api/patrons/%s/checkouts/" % patron_id,
+            method="POST",
+            encoding="json",
+            title="Loan several books to this patron",
+            **self.schema_property("checkout")
+        )
+
+    def add_control_checkin(self):
+        self.add_control(
+            "inlibris:checkin",
+            "/inlibris/api/checkins/",
+            method="POST",
+            encoding="json",
+            title="Return several books",
+            **self.schema_property("checkin")
         )
 
     def add_control_edit_loan(self, book_id):
@@ -319,7 +701,15 @@ class LibraryBuilder(MasonBuilder):
             title="Edit this loan",
             encoding="json",
             method="PUT",
-            schema=self.edit_loan_schema()
+            **self.schema_property("edit_loan")
+        )
+
+    def add_control_renew_loan(self, book_id):
+        self.add_control(
+            "inlibris:renew",
+            "/inlibris/api/books/%s/loan/renew/" % book_id,
+            method="POST",
+            title="Renew this loan"
         )
 
     def add_control_holds_by(self, patron_id):
@@ -330,6 +720,16 @@ class LibraryBuilder(MasonBuilder):
             method="GET"
         )
 
+    def add_control_add_hold(self, patron_id):
+        self.add_control(
+            "inlibris:add-hold",
+            "/inlibris/api/patrons/%s/holds/" % patron_id,
+            method="POST",
+            encoding="json",
+            title="Place a hold for this patron",
+            **self.schema_property("add_hold")
+        )
+
     def add_control_loan_of(self, book_id):
         self.add_control(
             "inlibris:loan-of",
@@ -347,12 +747,7 @@ class LibraryBuilder(MasonBuilder):
         )
 
     def add_control_target_book(self, book_id):
-        self.add_control(
-            "inlibris:target-book",
-            "/inlibris/api/books/%s/" % book_id,
-            title="Target book",
-            method="GET"
-        )
+        self.setdefault("@controls", {})["inlibris:target-book"] = TARGET_BOOK.build(book_id=book_id)
 
 def create_error_response(status_code, title, message=None):
     """
@@ -365,4 +760,195 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
\ No newline at end of file
+    return Response(json.dumps(body), status_code, mimetype=MASON)
+
+'''
+Control templates. Building a URL with url_for matches the endpoint and its
+arguments against the URL map on every call, which adds up in collections of
+hundreds of items. The URL rules of the app are compiled once into format
+strings instead, so the controls of an item only cost a string format. The
+URLs are the same as url_for gives for the integer arguments used here.
+'''
+
+_RULE_ARGUMENT = re.compile(r"<(?:[^:<>]+:)?([^<>]+)>")
+
+class UrlTemplates(object):
+    """
+    The URL rules of an app as format strings by endpoint, e.g.
+    "api.bookitem" -> "/inlibris/api/books/{book_id}/".
+    """
+
+    def __init__(self, url_map, script_root=""):
+        self.urls = {}
+        for endpoint in {rule.endpoint for rule in url_map.iter_rules()}:
+            # url_for uses the first rule added for an endpoint, iter_rules()
+            # without an endpoint gives them in matching order
+            rule = next(url_map.iter_rules(endpoint))
+            template = rule.rule.replace("{", "{{").replace("}", "}}")
+            self.urls[endpoint] = script_root + _RULE_ARGUMENT.sub(r"{\1}", template)
+
+    def url(self, endpoint, **values):
+        return self.urls[endpoint].format(**values)
+
+def url_templates():
+    """
+    The URL templates of the current app, compiled on first use for each
+    script root the app is served under.
+    """
+
+    compiled = current_app.extensions.setdefault("url_templates", {})
+    script_root = request.script_root
+    templates = compiled.get(script_root)
+    if templates is None:
+        templates = compiled[script_root] = UrlTemplates(current_app.url_map, script_root)
+    return templates
+
+class ControlTemplate(object):
+    """
+    A control with a fixed set of properties whose href is the URL of
+    "endpoint" from the URL templates. The properties are kept in the order
+    add_control would give them.
+    """
+
+    def __init__(self, endpoint, **kwargs):
+        self.endpoint = endpoint
+        self.control = dict(kwargs, href=None)
+
+    def build(self, **values):
+        control = self.control.copy()
+        control["href"] = url_templates().url(self.endpoint, **values)
+        return control
+
+TARGET_BOOK = ControlTemplate("api.bookitem", title="Target book", method="GET")
+
+'''
+Schema URLs. The controls carry their JSON schemas inline by default, which
+can be most of a small document. A client that sends "Prefer: schema=url"
+gets the schemas as "schemaUrl" links instead. The linked URLs contain the
+version of the schema, so the client can cache them for good.
+'''
+
+SCHEMA_URL_PREFERENCE = "schema=url"
+
+def prefers_schema_urls():
+    """
+    Whether the current request asked for schema URLs with the "Prefer"
+    header. Parameters of the preference are ignored.
+    """
+
+    prefers = g.get("prefers_schema_urls")
+    if prefers is None:
+        preferences = ",".join(request.headers.getlist("Prefer")).split(",")
+        prefers = g.prefers_schema_urls = any(
+            preference.split(";", 1)[0].replace(" ", "").replace('"', "").lower() == SCHEMA_URL_PREFERENCE
+            for preference in preferences
+        )
+    return prefers
+
+def schema_url(name):
+    """
+    The versioned URL of the schema called "name".
+    """
+
+    return url_templates().url("api.schema", name=name, version=schemas.version(name))
+
+'''
+Item documents of the resources. The collections list them as their items,
+and the item resources embed them when asked with the "embed" query
+parameter. The related rows are passed in explicitly, so building a document
+never loads anything from the database.
+'''
+
+def book_item(book):
+    """
+    Build the collection item document for one book.
+    """
+
+    item = LibraryBuilder(
+        id=book.id,
+        barcode=book.barcode,
+        title=book.title,
+        author=book.author,
+        pubyear=book.pubyear,
+        format=book.format,
+        description=book.description,
+        loantime=book.loantime,
+        renewlimit=book.renewlimit
+    )
+
+    item["@controls"] = {
+        "self": {"href": url_templates().url("api.bookitem", book_id=book.id)},
+        "profile": {"href": BOOK_PROFILE}
+    }
+    return item
+
+def patron_item(patron):
+    """
+    Build the collection item document for one patron.
+    """
+
+    item = LibraryBuilder(
+        id=patron.id,
+        barcode=patron.barcode,
+        firstname=patron.firstname,
+        lastname=patron.lastname,
+        email=patron.email,
+        group=patron.group,
+        status=patron.status,
+        regdate=str(patron.regdate.date())
+    )
+    item["@controls"] = {
+        "self": {"href": url_templates().url("api.patronitem", patron_id=patron.id)},
+        "profile": {"href": PATRON_PROFILE}
+    }
+    return item
+
+def loan_item(loan, book, patron):
+    """
+    Build the collection item document for the loan of "book" by "patron".
+    Loans left behind by a deleted patron have no patron, and are built
+    without the patron's barcode.
+    """
+
+    item = LibraryBuilder(id=loan.id, book_barcode=book.barcode)
+    if patron is not None:
+        item["patron_barcode"] = patron.barcode
+    item.update(
+        loandate=str(loan.loandate.date()),
+        renewaldate=None if not loan.renewaldate else str(loan.renewaldate.date()),
+        duedate=str(loan.duedate.date()),
+        renewed=loan.renewed,
+        status=loan.status
+    )
+    item["@controls"] = {
+        "self": {"href": url_templates().url("api.loanitem", book_id=book.id)},
+        "profile": {"href": LOAN_PROFILE}
+    }
+    item["@controls"]["inlibris:target-book"] = TARGET_BOOK.build(book_id=book.id)
+    return item
+
+def hold_item(hold, book, patron):
+    """
+    Build the collection item document for the hold of "patron" on "book".
+    Holds left behind by a deleted patron have no patron, and are built
+    without the patron's barcode and the self link, which goes through the
+    patron.
+    """
+
+    item = LibraryBuilder(id=hold.id, book_barcode=book.barcode)
+    if patron is not None:
+        item["patron_barcode"] = patron.barcode
+    item.update(
+        holddate=str(hold.holddate.date()),
+        expirationdate=str(hold.expirationdate.date()),
+        pickupdate=None if not hold.pickupdate else str(hold.pickupdate.date()),
+        status=hold.status
+    )
+    item["@controls"] = {}
+    if patron is not None:
+        item["@controls"]["self"] = {
+            "href": url_templates().url("api.holditem", patron_id=patron.id, hold_id=hold.id)
+        }
+    item["@controls"]["profile"] = {"href": HOLD_PROFILE}
+    item["@controls"]["inlibris:target-book"] = TARGET_BOOK.build(book_id=book.id)
+    return item
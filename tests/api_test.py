@@ -1,14 +1,22 @@
+import gc
 import os
 import pytest
+import threading
 import json
 import tempfile
+from flask import url_for
+from werkzeug.test import EnvironBuilder
 from datetime import datetime, timedelta
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
 
+from jsonschema import ValidationError
+
 from inlibris import create_app, db
-from inlibris.models import Patron, Book, Loan
+from inlibris.schemas import schemas, _SchemaEntry
+from inlibris.models import Patron, Book, Loan, Hold
+from inlibris.utils import LibraryBuilder, book_item, hold_item, url_templates
 from tests import utils
 
 '''
@@ -30,7 +38,8 @@ def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        "QUERY_COUNT_HEADER": True
     }
     
     app = create_app(config)
@@ -59,6 +68,258 @@ class TestEntryPoint(object):
         utils._check_namespace(client, body)
         utils._check_control_get_method("inlibris:books-all", client, body)
         utils._check_control_get_method("inlibris:patrons-all", client, body)
+        assert body["@controls"]["inlibris:patrons-search"]["isHrefTemplate"]
+        assert body["@controls"]["inlibris:books-search"]["isHrefTemplate"]
+
+class TestSchemaRegistry(object):
+    """
+    This class tests the registry that holds the JSON schemas.
+    """
+
+    def test_schemas(self, client):
+        """
+        Checks that every schema file is loaded once and shared, that the
+        validators accept and reject documents, and that a modified schema file
+        is reloaded when auto reloading is on.
+        """
+
+        with client.application.app_context():
+            assert schemas.schema("book") is schemas.schema("book")
+            assert schemas.schema("patron")["required"] == ["barcode", "firstname", "email"]
+            schemas.validate("book", utils._get_book_json())
+            with pytest.raises(ValidationError):
+                schemas.validate("book", utils._get_patron_json())
+
+        fd, fname = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"type": "object", "required": ["a"]}, f)
+        entry = _SchemaEntry(fname)
+        with pytest.raises(ValidationError):
+            entry.validator.validate({})
+        with open(fname, "w") as f:
+            json.dump({"type": "object"}, f)
+        os.utime(fname, (0, 0))
+        entry.reload_if_modified()
+        entry.validator.validate({})
+        os.unlink(fname)
+
+class TestMetrics(object):
+    """
+    This class tests the request metrics endpoint.
+    """
+
+    RESOURCE_URL = "/inlibris/api/_metrics"
+
+    def test_get(self, client):
+        """
+        Tests that the requests are counted per resource class, method and
+        status code with their SQL statements and response sizes, in the
+        Prometheus text format.
+        """
+
+        client.get("/inlibris/api/books/1/")
+        client.get("/inlibris/api/books/2/")
+        client.get("/inlibris/api/books/100/")
+        client.delete("/inlibris/api/books/100/")
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        samples = dict(
+            line.rsplit(" ", 1) for line in resp.data.decode().splitlines()
+            if not line.startswith("#")
+        )
+        labels = 'resource="BookItem",method="GET"'
+        assert samples["inlibris_request_duration_seconds_count{" + labels + "}"] == "3"
+        assert samples["inlibris_request_duration_seconds_bucket{" + labels + ',le="+Inf"}'] == "3"
+        assert samples["inlibris_requests_total{" + labels + ',status="200"}'] == "2"
+        assert samples["inlibris_requests_total{" + labels + ',status="404"}'] == "1"
+        assert samples['inlibris_requests_total{resource="BookItem",method="DELETE",status="404"}'] == "1"
+        assert int(samples["inlibris_sql_statements_total{" + labels + "}"]) >= 3
+        assert int(samples["inlibris_response_size_bytes_sum{" + labels + "}"]) > 0
+        assert "inlibris_response_cache_misses_total" in samples
+
+    def test_threads(self, client):
+        """
+        Tests that the counters of finished threads are kept in one total
+        instead of a shard per thread, also when a thread is collected while
+        the lock of the metrics is held.
+        """
+
+        metrics = client.application.extensions["metrics"]
+
+        def observe():
+            metrics.observe("BookItem", "GET", 0.001, 200, 10, 2, 0.0005)
+
+        for i in range(50):
+            thread = threading.Thread(target=observe)
+            thread.start()
+            thread.join()
+        # the finalizer of a thread may run while the lock is held
+        with metrics._lock:
+            del thread
+            gc.collect()
+
+        series = metrics.collect()[("BookItem", "GET")]
+        assert len(metrics._shards) <= 1
+        assert series.count == 50
+        assert series.statements == 100
+
+class TestProfiling(object):
+    """
+    This class tests the profiling of single requests.
+    """
+
+    RESOURCE_URL = "/inlibris/api/patrons/2/loans/"
+
+    def test_profile(self, client, tmp_path):
+        """
+        Tests that only the requests with the secret are profiled, and that
+        the profile and its summary with the SQL timeline are written.
+        """
+
+        config = client.application.config
+        config["PROFILE_DIR"] = str(tmp_path)
+        resp = client.get(self.RESOURCE_URL, headers={"X-Profile": "secret"})
+        assert "X-Profile" not in resp.headers
+
+        config["PROFILING_SECRET"] = "secret"
+        resp = client.get(self.RESOURCE_URL, headers={"X-Profile": "wrong"})
+        assert resp.status_code == 200
+        assert "X-Profile" not in resp.headers
+        assert list(tmp_path.iterdir()) == []
+
+        resp = client.get(self.RESOURCE_URL, headers={"X-Profile": "secret"})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"]
+        name = resp.headers["X-Profile"]
+        assert (tmp_path / (name + ".prof")).stat().st_size > 0
+        summary = (tmp_path / (name + ".txt")).read_text()
+        assert summary.startswith("GET /inlibris/api/patrons/2/loans/? -> 200 OK")
+        assert "{} SQL statements".format(resp.headers["X-Query-Count"]) in summary
+        assert "FROM change_counter" in summary
+        assert "cumulative" in summary
+
+        # the secret is only accepted in the header, not in the URL
+        resp = client.get(self.RESOURCE_URL + "?profile=secret")
+        assert "X-Profile" not in resp.headers
+        assert len(list(tmp_path.iterdir())) == 2
+
+    def test_start_response(self, client, tmp_path):
+        """
+        Tests that the name of the profile is in the headers the server gets
+        from start_response, since servers may not look at the list later.
+        """
+
+        app = client.application
+        app.config["PROFILE_DIR"] = str(tmp_path)
+        app.config["PROFILING_SECRET"] = "secret"
+        environ = EnvironBuilder(self.RESOURCE_URL, headers={"X-Profile": "secret"}).get_environ()
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started.append((status, dict(headers)))
+
+        body = b"".join(app.wsgi_app(environ, start_response))
+        assert len(started) == 1
+        status, headers = started[0]
+        assert status == "200 OK"
+        assert (tmp_path / (headers["X-Profile"] + ".prof")).exists()
+        assert json.loads(body)["items"]
+
+class TestControlTemplates(object):
+    """
+    This class tests the compiled URL and control templates.
+    """
+
+    def test_templates(self, client):
+        """
+        Tests that the templates give the same URLs as url_for for every
+        endpoint, and the same item documents as building them control by
+        control.
+        """
+
+        app = client.application
+        with app.test_request_context("/inlibris/api/"):
+            for rule in app.url_map.iter_rules():
+                values = {name: 7 for name in rule.arguments}
+                assert url_templates().url(rule.endpoint, **values) == url_for(rule.endpoint, **values)
+
+            book = Book.query.get(2)
+            expected = LibraryBuilder(book_item(book))
+            expected["@controls"] = {}
+            expected.add_control("self", url_for("api.bookitem", book_id=book.id))
+            expected.add_control("profile", "/profiles/book-profile/")
+            assert json.dumps(book_item(book)) == json.dumps(expected)
+
+            hold = Hold.query.get(1)
+            expected = LibraryBuilder(hold_item(hold, hold.book, hold.patron))
+            expected["@controls"] = {}
+            expected.add_control("self", url_for("api.holditem", patron_id=hold.patron.id, hold_id=hold.id))
+            expected.add_control("profile", "/profiles/hold-profile/")
+            expected.add_control("inlibris:target-book", "/inlibris/api/books/1/", title="Target book", method="GET")
+            assert json.dumps(hold_item(hold, hold.book, hold.patron)) == json.dumps(expected)
+
+        with app.test_request_context("/inlibris/api/", base_url="http://localhost/library/"):
+            assert url_templates().url("api.bookitem", book_id=3) == "/library/inlibris/api/books/3/"
+            hold = Hold.query.get(1)
+            controls = hold_item(hold, hold.book, hold.patron)["@controls"]
+            assert controls["self"]["href"].startswith("/library/inlibris/api/")
+            assert controls["inlibris:target-book"]["href"] == "/library/inlibris/api/books/1/"
+
+class TestSchemaItem(object):
+    """
+    This class tests the schema resources and the controls that link to them.
+    """
+
+    BOOK_URL = "/inlibris/api/books/1/"
+
+    def test_get(self, client):
+        """
+        Tests that the controls link to the schemas when asked with the
+        "Prefer" header, that the linked schemas are served with long cache
+        headers, and that the two representations are cached apart.
+        """
+
+        with client.application.app_context():
+            book_schema = schemas.schema("book")
+
+        resp = client.get(self.BOOK_URL)
+        inline = json.loads(resp.data)
+        assert inline["@controls"]["edit"]["schema"] == book_schema
+        assert "Prefer" in resp.headers["Vary"]
+        assert "Preference-Applied" not in resp.headers
+        etag = resp.headers["ETag"]
+
+        resp = client.get(self.BOOK_URL, headers={"Prefer": "return=minimal, schema=url"})
+        assert resp.headers["X-Cache"] == "MISS"
+        assert resp.headers["Preference-Applied"] == "schema=url"
+        assert resp.headers["ETag"] != etag
+        body = json.loads(resp.data)
+        control = body["@controls"]["edit"]
+        assert "schema" not in control
+        assert list(control) == list(inline["@controls"]["edit"])[:-2] + ["schemaUrl", "href"]
+        assert len(resp.data) < len(json.dumps(inline))
+
+        resp = client.get(self.BOOK_URL, headers={"Prefer": "schema=url"})
+        assert resp.headers["X-Cache"] == "HIT"
+        assert json.loads(resp.data) == body
+        resp = client.get(self.BOOK_URL)
+        assert json.loads(resp.data) == inline
+
+        resp = client.get(control["schemaUrl"])
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/schema+json"
+        assert json.loads(resp.data) == book_schema
+        assert "immutable" in resp.headers["Cache-Control"]
+
+        resp = client.get("/inlibris/api/patrons/1/", headers={"Prefer": "schema=url"})
+        assert json.loads(resp.data)["@controls"]["edit"]["schemaUrl"].startswith("/inlibris/api/schemas/patron/")
+
+        resp = client.get("/inlibris/api/schemas/book/0123456789ab/")
+        assert resp.status_code == 404
+        resp = client.get("/inlibris/api/schemas/nope/0123456789ab/")
+        assert resp.status_code == 404
 
 class TestPatronCollection(object):
     """
@@ -78,6 +339,7 @@ class TestPatronCollection(object):
 
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
         body = json.loads(resp.data)
         utils._check_namespace(client, body)
         utils._check_control_get_method("self", client, body)
@@ -96,6 +358,95 @@ class TestPatronCollection(object):
             assert "group" in item
             assert "status" in item
 
+    def test_get_pages(self, client):
+        """
+        Tests the keyset pagination of the GET method. Walks through the
+        collection forwards and backwards with the "next" and "prev" controls
+        and checks that invalid pagination parameters result in 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?limit=5")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [1, 2, 3, 4, 5]
+        assert "prev" not in body["@controls"]
+        utils._check_control_get_method("next", client, body)
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [6, 7, 8, 9, 10]
+        utils._check_control_get_method("prev", client, body)
+        utils._check_control_get_method("next", client, body)
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [11]
+        assert "next" not in body["@controls"]
+
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [6, 7, 8, 9, 10]
+
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [1, 2, 3, 4, 5]
+        assert "prev" not in body["@controls"]
+
+        # test invalid parameters for 400
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=abc")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=99999999999999999999")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=1&before=5")
+        assert resp.status_code == 400
+
+    def test_get_stream(self, client):
+        """
+        Tests the streaming mode of the GET method. Checks that the streamed
+        document is the same as the normal one when all the patrons fit on one
+        page.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?stream=true")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        streamed = json.loads(resp.data)
+        assert streamed == json.loads(client.get(self.RESOURCE_URL).data)
+        assert len(streamed["items"]) == 11
+
+    def test_get_many(self, client):
+        """
+        Tests the multi-get of the GET method. Checks that the patrons are
+        returned in the requested order with one query, that the unknown keys
+        are reported and that invalid lists result in 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?ids=3,1,99,3")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [3, 1]
+        assert body["missing"] == [99]
+        assert "next" not in body["@controls"]
+        utils._check_control_get_method("self", client, body["items"][0])
+
+        resp = client.get(self.RESOURCE_URL + "?barcodes=100027,100002,199999")
+        body = json.loads(resp.data)
+        assert [item["barcode"] for item in body["items"]] == [100027, 100002]
+        assert body["missing"] == [199999]
+
+        # test invalid parameters for 400
+        resp = client.get(self.RESOURCE_URL + "?ids=1,abc")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=1&barcodes=100001")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=99999999999999999999")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=" + ",".join(str(i) for i in range(1, 102)))
+        assert resp.status_code == 400
+
     def test_post(self, client):
         """
         Tests the POST method. Checks all of the possible error codes, and 
@@ -134,6 +485,67 @@ class TestPatronCollection(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+class TestPatronSearch(object):
+    """
+    This class implements tests for the GET method of the patron search
+    resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/patrons/search/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the controls and the searches by barcode,
+        name and email prefix, and that LIKE wildcards in the query are
+        matched literally.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?q=1000")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("profile", client, body)
+        utils._check_control_get_method("collection", client, body)
+        utils._check_control_get_method("inlibris:books-all", client, body)
+        utils._check_control_post_patron_method("inlibris:add-patron", client, body)
+        assert [item["id"] for item in body["items"]] == [1, 2, 7, 5, 6, 11, 3, 4]
+        utils._check_control_get_method("self", client, body["items"][0])
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=sto").data)
+        assert [item["id"] for item in body["items"]] == [11, 3]
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=SALLY+sto").data)
+        assert [item["id"] for item in body["items"]] == [3]
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=stacy@").data)
+        assert [item["id"] for item in body["items"]] == [10]
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=1000000").data)
+        assert body["items"] == []
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=%25").data)
+        assert body["items"] == []
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=s_a").data)
+        assert body["items"] == []
+
+        # test paging with a small limit
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=10&limit=4").data)
+        assert len(body["items"]) == 4
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert len(body["items"]) == 4
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert len(body["items"]) == 3
+        assert "next" not in body["@controls"]
+
+        # test missing query and out of range offset for 400
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=a&offset=99999999999999999999")
+        assert resp.status_code == 400
+
+        # a non-ASCII digit is a name prefix, not a barcode
+        resp = client.get(self.RESOURCE_URL + "?q=%C2%B2")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
 class TestPatronItem(object):
     """
     This class implements tests for each HTTP method in patron item
@@ -152,6 +564,7 @@ class TestPatronItem(object):
 
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
         body = json.loads(resp.data)
         assert body["barcode"] == 100001
         assert body["firstname"] == "Hilma"
@@ -170,6 +583,50 @@ class TestPatronItem(object):
         assert resp.status_code == 404
 
 
+    def test_get_embed(self, client):
+        """
+        Tests embedding the loans and holds of the patron, and their books.
+        Checks that every embedded collection costs one query, that the
+        embedded documents follow writes and that unknown names are rejected.
+        """
+
+        resp = client.get("/inlibris/api/patrons/2/?embed=loans,holds,book")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "4"
+        body = json.loads(resp.data)
+        assert [loan["book_barcode"] for loan in body["loans"]] == [200001, 200003]
+        assert body["loans"][0]["book"]["title"] == "Garpin maailma"
+        utils._check_control_get_method("self", client, body["loans"][0])
+        utils._check_control_get_method("self", client, body["loans"][0]["book"])
+        assert body["holds"] == []
+
+        body = json.loads(client.get("/inlibris/api/patrons/1/?embed=holds").data)
+        assert [hold["book_barcode"] for hold in body["holds"]] == [200001, 200003]
+        assert "book" not in body["holds"][0]
+        assert "loans" not in body
+
+        # returning a book drops the cached document of its borrower
+        client.get("/inlibris/api/patrons/2/?embed=loans")
+        resp = client.get("/inlibris/api/patrons/2/?embed=loans")
+        assert resp.headers["X-Cache"] == "HIT"
+        client.post("/inlibris/api/checkins/", json={"book_barcodes": [200001]})
+        resp = client.get("/inlibris/api/patrons/2/?embed=loans")
+        assert resp.headers["X-Cache"] == "MISS"
+        assert len(json.loads(resp.data)["loans"]) == 1
+
+        # the barcodes of the embedded holds follow their books
+        client.get("/inlibris/api/patrons/1/?embed=holds")
+        resp = client.get("/inlibris/api/patrons/1/?embed=holds")
+        assert resp.headers["X-Cache"] == "HIT"
+        resp = client.put("/inlibris/api/books/1/", json=utils._get_book_json(barcode=200099))
+        assert resp.status_code == 204
+        resp = client.get("/inlibris/api/patrons/1/?embed=holds")
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["holds"][0]["book_barcode"] == 200099
+
+        resp = client.get("/inlibris/api/patrons/2/?embed=loans,patron")
+        assert resp.status_code == 400
+
     def test_put(self, client):
         """
         Tests the PUT method. Checks all of the possible error codes, and also
@@ -191,16 +648,44 @@ class TestPatronItem(object):
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 409
         
-        # test with valid
+        # test with another patron's email
         valid["barcode"] = 100001
+        valid["email"] = "kayttaja@test.com"
+        resp = client.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 409
+
+        # test with valid, registration date is kept
+        valid["email"] = "test@test.com"
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 204
+        assert resp.headers["X-Query-Count"] == "3"
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["firstname"] == "Testi"
+        assert body["lastname"] is None
+        assert body["regdate"] == "2020-01-01"
         
         # remove field for 400
         valid.pop("email")
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+    def test_put_if_match(self, client):
+        """
+        Tests that PUT and DELETE with an old ETag in If-Match result in 412
+        and with the current one succeed.
+        """
+
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        resp = client.put(self.RESOURCE_URL, json=utils._get_patron_json(), headers={"If-Match": etag})
+        assert resp.status_code == 204
+        new_etag = resp.headers["ETag"]
+        resp = client.put(self.RESOURCE_URL, json=utils._get_patron_json(), headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.delete(self.RESOURCE_URL, headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.delete(self.RESOURCE_URL, headers={"If-Match": new_etag})
+        assert resp.status_code == 204
+
     def test_delete(self, client):
         """
         Tests the DELETE method. Checks that a valid request reveives 204
@@ -216,6 +701,39 @@ class TestPatronItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_delete_holds(self, client):
+        """
+        Tests that the holds of a deleted patron are cancelled, and that a book
+        kept for the patron goes to the next hold in the queue.
+        """
+
+        resp = client.post("/inlibris/api/patrons/3/holds/", json=utils._get_add_hold_json(200007))
+        assert resp.status_code == 201
+        resp = client.post("/inlibris/api/patrons/4/holds/", json=utils._get_add_hold_json(200007))
+        assert resp.status_code == 201
+
+        resp = client.delete("/inlibris/api/patrons/3/")
+        assert resp.status_code == 204
+        body = json.loads(client.get("/inlibris/api/books/7/holds/").data)
+        assert [(hold["patron_barcode"], hold["status"]) for hold in body["items"]] == [(100004, "On hold")]
+
+        resp = client.delete(self.RESOURCE_URL)
+        assert resp.status_code == 204
+        resp = client.get("/inlibris/api/books/1/holds/")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
+        # holds that an earlier version left without a patron are listed
+        # without the patron's barcode and link
+        with client.application.app_context():
+            Hold.query.filter_by(status="On hold").one().patron_id = None
+            db.session.commit()
+        resp = client.get("/inlibris/api/books/7/holds/")
+        assert resp.status_code == 200
+        item = json.loads(resp.data)["items"][0]
+        assert "patron_barcode" not in item
+        assert "self" not in item["@controls"]
+
 class TestBookCollection(object):
     """
     This class implements tests for each HTTP method in book collection
@@ -234,6 +752,7 @@ class TestBookCollection(object):
         
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
         body = json.loads(resp.data)
         utils._check_namespace(client, body)
         utils._check_control_get_method("self", client, body)
@@ -254,6 +773,123 @@ class TestBookCollection(object):
             assert "loantime" in item
             assert "renewlimit" in item
 
+    def test_get_pages(self, client):
+        """
+        Tests the keyset pagination of the GET method. Checks that the pages
+        don't overlap and that the last page has no "next" control.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?limit=4")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [1, 2, 3, 4]
+        utils._check_control_get_method("next", client, body)
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [5, 6, 7]
+        assert "next" not in body["@controls"]
+        utils._check_control_get_method("prev", client, body)
+
+        # test invalid limit for 400
+        resp = client.get(self.RESOURCE_URL + "?limit=-1")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=99999999999999999999")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=99999999999999999999")
+        assert resp.status_code == 400
+
+
+    def test_get_cache(self, client):
+        """
+        Tests the response cache of the GET methods. Checks that repeated
+        requests are served from the cache and that writes invalidate only
+        the affected entries.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "HIT"
+        assert resp.headers["X-Query-Count"] == "0"
+        assert len(json.loads(resp.data)["items"]) == 7
+        client.get("/inlibris/api/books/1/")
+        client.get("/inlibris/api/books/2/")
+
+        # editing book 1 drops its own entry and the collection
+        resp = client.put("/inlibris/api/books/1/", json=utils._get_book_json(barcode=200001))
+        assert resp.status_code == 204
+        assert client.get("/inlibris/api/books/1/").headers["X-Cache"] == "MISS"
+        assert client.get("/inlibris/api/books/2/").headers["X-Cache"] == "HIT"
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["items"][0]["title"] == "Testikirja"
+
+        # adding a book drops the collection
+        resp = client.post(self.RESOURCE_URL, json=utils._get_book_json())
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert len(json.loads(resp.data)["items"]) == 8
+
+        stats = json.loads(client.get("/inlibris/api/_cache/").data)
+        assert stats["hits"] == 2
+        assert stats["misses"] == 6
+
+        # the tags are made from the id, not from how it was written in the URL
+        assert client.get("/inlibris/api/books/01/").status_code == 200
+        assert client.get("/inlibris/api/books/01/").headers["X-Cache"] == "HIT"
+        resp = client.put("/inlibris/api/books/1/", json=utils._get_book_json(barcode=200001, pubyear=2021))
+        assert resp.status_code == 204
+        resp = client.get("/inlibris/api/books/01/")
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["pubyear"] == 2021
+
+    def test_get_stream(self, client, monkeypatch):
+        """
+        Tests the streaming mode of the GET method. Checks that the streamed
+        document is the same as the normal one when all the books fit on one
+        page, also when the items are streamed in several batches.
+        """
+
+        monkeypatch.setattr("inlibris.utils.STREAM_BATCH_SIZE", 3)
+        resp = client.get(self.RESOURCE_URL + "?stream=true")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        streamed = json.loads(resp.data)
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert streamed == body
+        assert len(streamed["items"]) == 7
+
+    def test_get_many(self, client):
+        """
+        Tests the multi-get of the GET method. Checks that the books are
+        returned in the requested order with one query, that the unknown keys
+        are reported and that invalid lists result in 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?barcodes=200007,200001,299999")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [7, 1]
+        assert body["missing"] == [299999]
+        utils._check_control_get_method("self", client, body["items"][0])
+
+        resp = client.get(self.RESOURCE_URL + "?ids=5,42,2")
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [5, 2]
+        assert body["missing"] == [42]
+
+        # test invalid parameters for 400
+        resp = client.get(self.RESOURCE_URL + "?barcodes=")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=-1")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?barcodes=200001,99999999999999999999")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ids=" + ",".join(["1"] * 500))
+        assert json.loads(resp.data)["missing"] == []
 
     def test_post(self, client):
         """
@@ -307,6 +943,7 @@ class TestBookItem(object):
 
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
         body = json.loads(resp.data)
         assert body["barcode"] == 200001
         assert body["title"] == "Garpin maailma"
@@ -322,6 +959,101 @@ class TestBookItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
     
+    def test_get_etag(self, client):
+        """
+        Tests the conditional GET. Checks that a matching "If-None-Match"
+        receives 304 straight from the response cache, and that editing the
+        book changes the ETag.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.headers["X-Query-Count"] == "0"
+
+        resp = client.put(self.RESOURCE_URL, json=utils._get_book_json(barcode=200001))
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+        # 404 responses have no ETag
+        resp = client.get(self.INVALID_URL)
+        assert "ETag" not in resp.headers
+
+    def test_get_embed(self, client):
+        """
+        Tests embedding the loan and holds of the book, and their patrons.
+        Checks that every embedded collection costs one query and that a book
+        that is not loaned has a null loan.
+        """
+
+        resp = client.get("/inlibris/api/books/1/?embed=loan,holds,patron")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "4"
+        body = json.loads(resp.data)
+        assert body["loan"]["patron_barcode"] == 100002
+        assert body["loan"]["patron"]["firstname"] == "Testi"
+        utils._check_control_get_method("self", client, body["loan"])
+        assert [hold["patron_barcode"] for hold in body["holds"]] == [100001]
+        assert body["holds"][0]["patron"]["firstname"] == "Hilma"
+
+        body = json.loads(client.get("/inlibris/api/books/7/?embed=loan").data)
+        assert body["loan"] is None
+        assert "holds" not in body
+
+        # the ETag depends on what is embedded
+        etag = client.get("/inlibris/api/books/1/").headers["ETag"]
+        assert client.get("/inlibris/api/books/1/?embed=loan").headers["ETag"] != etag
+
+        # the barcodes of the embedded loan and holds follow their patrons
+        client.get("/inlibris/api/books/1/?embed=loan,holds")
+        resp = client.get("/inlibris/api/books/1/?embed=loan,holds")
+        assert resp.headers["X-Cache"] == "HIT"
+        resp = client.put("/inlibris/api/patrons/2/", json=utils._get_patron_json(barcode=100098, email="loan@test.com"))
+        assert resp.status_code == 204
+        resp = client.put("/inlibris/api/patrons/1/", json=utils._get_patron_json(barcode=100099, email="hold@test.com"))
+        assert resp.status_code == 204
+        resp = client.get("/inlibris/api/books/1/?embed=loan,holds")
+        assert resp.headers["X-Cache"] == "MISS"
+        body = json.loads(resp.data)
+        assert body["loan"]["patron_barcode"] == 100098
+        assert body["holds"][0]["patron_barcode"] == 100099
+
+        resp = client.get("/inlibris/api/books/1/?embed=loans")
+        assert resp.status_code == 400
+
+    def test_get_embed_deleted_patron(self, client):
+        """
+        Tests that the loan and holds of a deleted patron are embedded without
+        the patron, also when the document was cached before the deletion.
+        """
+
+        with client.application.app_context():
+            Hold.query.get(1).patron_id = None
+            db.session.commit()
+        url = "/inlibris/api/books/1/?embed=loan,holds,patron"
+        assert client.get(url).status_code == 200
+
+        resp = client.delete("/inlibris/api/patrons/2/")
+        assert resp.status_code == 204
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert resp.headers["X-Cache"] == "MISS"
+        body = json.loads(resp.data)
+        assert "patron_barcode" not in body["loan"]
+        assert body["loan"]["patron"] is None
+        assert "patron_barcode" not in body["holds"][0]
+        assert body["holds"][0]["patron"] is None
+
+        resp = client.get("/inlibris/api/books/1/loan/")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert "patron_barcode" not in body
+        assert "author" not in body["@controls"]
+
     def test_put(self, client):
         """
         Tests the PUT method. Checks all of the possible error codes, and also
@@ -343,10 +1075,17 @@ class TestBookItem(object):
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 409
         
-        # test with valid
+        # test with valid, the book is updated in place and keeps its loan
         valid["barcode"] = 200001
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 204
+        assert resp.headers["X-Query-Count"] == "3"
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["title"] == "Testikirja"
+        assert body["author"] is None
+        assert body["loantime"] == 28
+        resp = client.get(self.RESOURCE_URL + "loan/")
+        assert resp.status_code == 200
         
         # remove field for 400
         valid.pop("pubyear")
@@ -354,6 +1093,41 @@ class TestBookItem(object):
         assert resp.status_code == 400
     
 
+    def test_put_if_match(self, client):
+        """
+        Tests the optimistic concurrency control of PUT and DELETE. Checks
+        that a write with the current ETag succeeds and returns the new ETag,
+        that a write with an old ETag results in 412, and that If-Match is
+        required with REQUIRE_IF_MATCH.
+        """
+
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        resp = client.put(self.RESOURCE_URL, json=utils._get_book_json(barcode=200001),
+            headers={"If-Match": etag})
+        assert resp.status_code == 204
+        new_etag = resp.headers["ETag"]
+        assert new_etag != etag
+
+        # a second writer with the old ETag loses
+        resp = client.put(self.RESOURCE_URL, json=utils._get_book_json(barcode=200001, pubyear=1999),
+            headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.delete(self.RESOURCE_URL, headers={"If-Match": etag})
+        assert resp.status_code == 412
+
+        # the ETag of a GET with embedded documents works too
+        etag = client.get(self.RESOURCE_URL + "?embed=loan").headers["ETag"]
+        assert etag.strip('"').split("-")[0] == new_etag.strip('"')
+        resp = client.put(self.RESOURCE_URL, json=utils._get_book_json(barcode=200001, pubyear=1999),
+            headers={"If-Match": etag})
+        assert resp.status_code == 204
+
+        client.application.config["REQUIRE_IF_MATCH"] = True
+        resp = client.delete(self.RESOURCE_URL)
+        assert resp.status_code == 428
+        resp = client.delete(self.RESOURCE_URL, headers={"If-Match": client.get(self.RESOURCE_URL).headers["ETag"]})
+        assert resp.status_code == 204
+
     def test_delete(self, client):
         """
         Tests the DELETE method. Checks that a valid request reveives 204
@@ -369,6 +1143,96 @@ class TestBookItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+class TestBookSearch(object):
+    """
+    This class implements tests for the GET method of the book search
+    resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/books/search/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the controls, that all the words must
+        match with the last one as a prefix, that diacritics are ignored and
+        that the index follows edits and deletes of the books.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?q=hotelli")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("profile", client, body)
+        utils._check_control_get_method("collection", client, body)
+        utils._check_control_get_method("inlibris:patrons-all", client, body)
+        utils._check_control_post_book_method("inlibris:add-book", client, body)
+        assert [item["id"] for item in body["items"]] == [6]
+        utils._check_control_get_method("self", client, body["items"][0])
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=IRVING+john").data)
+        assert len(body["items"]) == 7
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=isani+hot").data)
+        assert [item["id"] for item in body["items"]] == [6]
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=isani+karhut").data)
+        assert body["items"] == []
+
+        # matches in the title rank above matches in the description
+        book = utils._get_book_json(barcode=200003)
+        book["description"] = "Hotellit"
+        resp = client.put("/inlibris/api/books/2/", json=book)
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=hotellit").data)
+        assert [item["id"] for item in body["items"]] == [6, 2]
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=sankari").data)
+        assert body["items"] == []
+
+        resp = client.delete("/inlibris/api/books/6/")
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=hotellit").data)
+        assert [item["id"] for item in body["items"]] == [2]
+
+        # the query syntax of FTS5 is treated as plain words
+        resp = client.get(self.RESOURCE_URL + '?q=title:"garpin OR NEAR(')
+        assert resp.status_code == 200
+
+        # test missing and empty queries for 400
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=!!!")
+        assert resp.status_code == 400
+
+    def test_get_pages(self, client):
+        """
+        Tests the pagination of the search results. Checks that the pages
+        don't overlap and that the last page has no "next" control.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?q=irving&limit=3")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        ids = [item["id"] for item in body["items"]]
+        assert len(ids) == 3
+        assert "prev" not in body["@controls"]
+        utils._check_control_get_method("next", client, body)
+
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        ids += [item["id"] for item in body["items"]]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        ids += [item["id"] for item in body["items"]]
+        assert sorted(ids) == [1, 2, 3, 4, 5, 6, 7]
+        assert "next" not in body["@controls"]
+        utils._check_control_get_method("prev", client, body)
+
+        # test invalid offset for 400
+        resp = client.get(self.RESOURCE_URL + "?q=irving&offset=-1")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=irving&offset=99999999999999999999")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=irving&limit=%C2%B2")
+        assert resp.status_code == 400
+
 class TestLoanItem(object):
     """
     This class implements tests for each HTTP method in loan item
@@ -388,6 +1252,7 @@ class TestLoanItem(object):
 
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
         body = json.loads(resp.data)
         assert body["id"] == 1
         assert body["book_barcode"] == 200001
@@ -433,10 +1298,15 @@ class TestLoanItem(object):
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 404
         
-        # test with valid
+        # test with valid, the loan keeps its id
         valid["patron_barcode"] = 100001
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "4"
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["id"] == 1
+        assert body["patron_barcode"] == 100001
+        assert body["renewed"] == 1
 
         # test book which not loaned
         resp = client.put(self.NOT_LOANED_URL, json=valid)
@@ -464,6 +1334,29 @@ class TestLoanItem(object):
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 200
 
+    def test_put_if_match(self, client):
+        """
+        Tests that a renewal in between makes a PUT or DELETE with the ETag
+        read before it fail with 412, and that the ETag of the renewed loan
+        works.
+        """
+
+        url = "/inlibris/api/books/3/loan/"
+        etag = client.get(url).headers["ETag"]
+        resp = client.post(url + "renew/")
+        assert resp.status_code == 200
+
+        resp = client.put(url, json=utils._get_edit_loan_json(), headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.delete(url, headers={"If-Match": etag})
+        assert resp.status_code == 412
+
+        etag = client.get(url).headers["ETag"]
+        resp = client.put(url, json=utils._get_edit_loan_json(), headers={"If-Match": etag})
+        assert resp.status_code == 200
+        resp = client.delete(url, headers={"If-Match": resp.headers["ETag"]})
+        assert resp.status_code == 204
+
     def test_delete(self, client):
         """
         Tests the DELETE method. Checks that a valid request reveives 204
@@ -479,6 +1372,60 @@ class TestLoanItem(object):
         resp = client.delete(self.NO_BOOK_URL)
         assert resp.status_code == 404
 
+class TestLoanRenewal(object):
+    """
+    This class implements tests for the POST method of the loan renewal
+    resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/books/3/loan/renew/"
+
+    def test_post(self, client):
+        """
+        Tests the POST method. Checks that a renewal updates the loan with
+        one statement, that the cached documents of the patron are
+        invalidated and that the renewal limit, holds and the other error
+        cases are answered with the right codes.
+        """
+
+        book = json.loads(client.get("/inlibris/api/books/3/").data)
+        client.get("/inlibris/api/patrons/4/?embed=loans")
+
+        resp = client.post(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "3"
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        assert body["renewed"] == 1
+        assert body["status"] == "Renewed"
+        assert body["renewaldate"] == str(datetime.now().date())
+        assert body["duedate"] == str((datetime.now() + timedelta(days=book["loantime"])).date())
+        assert body["@controls"]["inlibris:renew"]["method"] == "POST"
+
+        resp = client.get("/inlibris/api/patrons/4/?embed=loans")
+        assert resp.headers["X-Cache"] == "MISS"
+        assert json.loads(resp.data)["loans"][0]["renewed"] == 1
+
+        # renew until the limit is reached
+        for renewed in range(2, book["renewlimit"] + 1):
+            body = json.loads(client.post(self.RESOURCE_URL).data)
+            assert body["renewed"] == renewed
+        resp = client.post(self.RESOURCE_URL)
+        assert resp.status_code == 409
+        body = json.loads(client.get("/inlibris/api/books/3/loan/").data)
+        assert body["renewed"] == book["renewlimit"]
+
+        # other patrons are waiting for book 1
+        resp = client.post("/inlibris/api/books/1/loan/renew/")
+        assert resp.status_code == 409
+
+        # book not loaned for 400 and nonexistent book for 404
+        resp = client.post("/inlibris/api/books/7/loan/renew/")
+        assert resp.status_code == 400
+        resp = client.post("/inlibris/api/books/100/loan/renew/")
+        assert resp.status_code == 404
+
 class TestLoansByPatron(object):
     """
     This class implements tests for each HTTP method in loans by patron collection
@@ -498,6 +1445,7 @@ class TestLoansByPatron(object):
 
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
         body = json.loads(resp.data)
         utils._check_namespace(client, body)
         utils._check_control_get_method("self", client, body)
@@ -519,6 +1467,58 @@ class TestLoansByPatron(object):
             assert "renewed" in item
             assert "status" in item
 
+    def test_get_embed(self, client):
+        """
+        Tests embedding the books of the loans and the patron. Checks that
+        the whole document still costs the same two queries.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?embed=book,patron")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        body = json.loads(resp.data)
+        assert [item["book"]["barcode"] for item in body["items"]] == [200001, 200003]
+        assert body["items"][0]["book"]["renewlimit"] == 10
+        assert body["patron"]["barcode"] == 100002
+
+        resp = client.get(self.RESOURCE_URL + "?embed=holds")
+        assert resp.status_code == 400
+
+    def test_get_etag(self, client):
+        """
+        Tests the conditional GET. Checks that a matching "If-None-Match"
+        receives 304 with only the change counters queried, and that a new
+        loan changes the ETag of the loans collection.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["X-Query-Count"] == "1"
+
+        resp = client.post(self.RESOURCE_URL, json=utils._get_add_loan_json())
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 3
+
+    def test_get_query_budget(self, client):
+        """
+        Tests that the GET method runs a single query for the loans (and one
+        for the change counters) no matter how many loans the patron has.
+        """
+
+        for barcode in (200002, 200004, 200007):
+            resp = client.post(self.RESOURCE_URL, json=utils._get_add_loan_json(barcode))
+            assert resp.status_code == 201
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 5
+        assert set(item["patron_barcode"] for item in body["items"]) == {100002}
     
     def test_post(self, client):
         """
@@ -554,6 +1554,16 @@ class TestLoansByPatron(object):
         resp = client.delete("/inlibris/api/books/7/loan/")
         assert resp.status_code == 204
 
+        # a book kept for another patron's hold can't be loaned for 409
+        resp = client.post("/inlibris/api/patrons/3/holds/", json={"book_barcode": 200007})
+        assert resp.status_code == 201
+        hold_url = resp.headers["Location"]
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 409
+        assert json.loads(resp.data)["@error"]["@message"] == "On hold"
+        resp = client.delete(hold_url)
+        assert resp.status_code == 204
+
         # send with custom duedate
         valid["duedate"] = "2020-08-08"
         resp = client.post(self.RESOURCE_URL, json=valid)
@@ -581,4 +1591,351 @@ class TestLoansByPatron(object):
         valid = utils._get_patron_json()
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
-    
\ No newline at end of file
+    
+class TestCheckoutsByPatron(object):
+    """
+    This class implements tests for the POST method of the bulk checkout
+    resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/patrons/1/checkouts/"
+    INVALID_URL = "/inlibris/api/patrons/100/checkouts/"
+
+    def test_post(self, client):
+        """
+        Tests the POST method. Checks that the free books are loaned, that
+        loaned and missing books are reported without failing the others, and
+        that the query count doesn't grow with the lookups. Also checks the
+        error codes.
+        """
+
+        valid = {"book_barcodes": [200002, 200004, 200001, 299999]}
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "7"
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("author", client, body)
+        utils._check_control_get_method("inlibris:loans-by", client, body)
+        assert [item["result"] for item in body["items"]] == ["ok", "ok", "conflict", "not found"]
+        utils._check_control_get_method("inlibris:loan-of", client, body["items"][0])
+        utils._check_control_get_method("inlibris:target-book", client, body["items"][2])
+
+        body = json.loads(client.get("/inlibris/api/patrons/1/loans/").data)
+        assert sorted(item["book_barcode"] for item in body["items"]) == [200002, 200004]
+        assert body["@controls"]["inlibris:checkout"]["method"] == "POST"
+
+        # a book kept for another patron's hold can only go to that patron
+        resp = client.post("/inlibris/api/patrons/3/holds/", json={"book_barcode": 200007})
+        assert resp.status_code == 201
+        body = json.loads(client.post(self.RESOURCE_URL, json={"book_barcodes": [200007]}).data)
+        assert [item["result"] for item in body["items"]] == ["conflict"]
+        assert "hold" in body["items"][0]["message"]
+
+        # with a custom duedate
+        resp = client.post("/inlibris/api/patrons/3/checkouts/", json={"book_barcodes": [200007], "duedate": "2020-08-08"})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"][0]["result"] == "ok"
+        assert json.loads(client.get("/inlibris/api/patrons/3/holds/").data)["items"] == []
+        body = json.loads(client.get("/inlibris/api/books/7/loan/").data)
+        assert body["duedate"] == "2020-08-08"
+
+        # test with wrong content type, invalid documents and invalid patron
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(valid))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"book_barcodes": []})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"book_barcodes": [200002, 200002]})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"book_barcodes": list(range(200000, 200101))})
+        assert resp.status_code == 400
+        resp = client.post(self.INVALID_URL, json=valid)
+        assert resp.status_code == 404
+
+    def test_post_race(self, client, monkeypatch):
+        """
+        Tests that a book loaned by another request after it was read is
+        reported as a conflict, and that the rest of the cart is loaned.
+        """
+
+        from inlibris.resources import circulation
+        resolve = circulation._resolve_barcodes
+        calls = []
+
+        def loan_between(barcodes):
+            books = resolve(barcodes)
+            if not calls:
+                with db.engine.begin() as connection:
+                    connection.execute(Loan.__table__.insert().values(
+                        book_id=5,
+                        patron_id=3,
+                        loandate=datetime(2020, 4, 2),
+                        duedate=datetime(2020, 4, 30)
+                    ))
+            calls.append(barcodes)
+            return books
+
+        monkeypatch.setattr(circulation, "_resolve_barcodes", loan_between)
+        resp = client.post(self.RESOURCE_URL, json={"book_barcodes": [200002, 200004]})
+        assert resp.status_code == 200
+        assert len(calls) == 2
+        body = json.loads(resp.data)
+        assert [item["result"] for item in body["items"]] == ["conflict", "ok"]
+        assert "already loaned" in body["items"][0]["message"]
+
+        body = json.loads(client.get("/inlibris/api/patrons/1/loans/").data)
+        assert [item["book_barcode"] for item in body["items"]] == [200004]
+        body = json.loads(client.get("/inlibris/api/patrons/3/loans/").data)
+        assert [item["book_barcode"] for item in body["items"]] == [200002]
+
+class TestCheckins(object):
+    """
+    This class implements tests for the POST method of the bulk checkin
+    resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/checkins/"
+
+    def test_post(self, client):
+        """
+        Tests the POST method. Checks that the loans of the loaned books are
+        deleted in one request and that books that are not loaned or don't
+        exist are reported. Also checks the error codes.
+        """
+
+        valid = {"book_barcodes": [200001, 200003, 200002, 299999]}
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "6"
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("inlibris:books-all", client, body)
+        assert [item["result"] for item in body["items"]] == ["ok", "ok", "conflict", "not found"]
+
+        resp = client.get("/inlibris/api/books/1/loan/")
+        assert resp.status_code == 400
+        body = json.loads(client.get("/inlibris/api/patrons/2/loans/").data)
+        assert body["items"] == []
+
+        # the holds on the returned books are ready for pickup
+        body = json.loads(client.get("/inlibris/api/patrons/1/holds/").data)
+        assert [item["status"] for item in body["items"]] == ["On hold", "On hold"]
+
+        # returning the same books again is a conflict
+        body = json.loads(client.post(self.RESOURCE_URL, json=valid).data)
+        assert [item["result"] for item in body["items"]] == ["conflict", "conflict", "conflict", "not found"]
+
+        # test with wrong content type and invalid document
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(valid))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"barcodes": [200001]})
+        assert resp.status_code == 400
+
+    def test_post_race(self, client, monkeypatch):
+        """
+        Tests that the whole checkin is rolled back with 409 when another
+        request keeps changing a loan after it was read.
+        """
+
+        from inlibris.resources import circulation
+        resolve = circulation._resolve_barcodes
+
+        def renew_between(barcodes):
+            books = resolve(barcodes)
+            with db.engine.begin() as connection:
+                connection.execute(Loan.__table__.update()
+                    .where(Loan.book_id == 1)
+                    .values(version=Loan.version + 1)
+                )
+            return books
+
+        monkeypatch.setattr(circulation, "_resolve_barcodes", renew_between)
+        resp = client.post(self.RESOURCE_URL, json={"book_barcodes": [200003, 200001]})
+        assert resp.status_code == 409
+
+        monkeypatch.undo()
+        body = json.loads(client.get("/inlibris/api/patrons/2/loans/").data)
+        assert sorted(item["book_barcode"] for item in body["items"]) == [200001, 200003]
+
+class TestHoldsByPatron(object):
+    """
+    This class implements tests for each HTTP method in holds by patron
+    resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/patrons/1/holds/"
+    NO_PATRON_URL = "/inlibris/api/patrons/100/holds/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks that the holds of the patron are listed
+        with their positions in the queues, and the controls.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("author", client, body)
+        utils._check_control_get_method("inlibris:loans-by", client, body)
+        assert body["@controls"]["inlibris:add-hold"]["method"] == "POST"
+        assert [item["book_barcode"] for item in body["items"]] == [200001, 200003]
+        assert [item["position"] for item in body["items"]] == [1, 1]
+        for item in body["items"]:
+            utils._check_control_get_method("self", client, item)
+            utils._check_control_get_method("inlibris:target-book", client, item)
+            assert item["status"] == "Requested"
+
+        resp = client.get(self.NO_PATRON_URL)
+        assert resp.status_code == 404
+
+    def test_post(self, client):
+        """
+        Tests the POST method. Checks that a hold on a loaned book goes to the
+        end of the queue, that a hold on a free book is ready for pickup right
+        away and all of the possible error codes.
+        """
+
+        valid = utils._get_add_hold_json()
+
+        # test with wrong content type
+        resp = client.post("/inlibris/api/patrons/3/holds/", data=json.dumps(valid))
+        assert resp.status_code == 415
+
+        # queue behind the hold of patron 1
+        resp = client.post("/inlibris/api/patrons/3/holds/", json=valid)
+        assert resp.status_code == 201
+        body = json.loads(client.get(resp.headers["Location"]).data)
+        assert body["patron_barcode"] == 100003
+        assert body["status"] == "Requested"
+        assert body["position"] == 2
+        assert body["pickupdate"] is None
+
+        # send same data again for 409
+        resp = client.post("/inlibris/api/patrons/3/holds/", json=valid)
+        assert resp.status_code == 409
+
+        # the patron who has the book on loan can't place a hold on it
+        resp = client.post("/inlibris/api/patrons/2/holds/", json=valid)
+        assert resp.status_code == 409
+
+        # a free book is put on hold right away
+        resp = client.post(self.RESOURCE_URL, json=utils._get_add_hold_json(200007))
+        assert resp.status_code == 201
+        body = json.loads(client.get(resp.headers["Location"]).data)
+        assert body["status"] == "On hold"
+        assert body["position"] == 0
+        assert body["pickupdate"] is not None
+
+        # send to nonexistent patron or book for 404
+        resp = client.post(self.NO_PATRON_URL, json=valid)
+        assert resp.status_code == 404
+        resp = client.post(self.RESOURCE_URL, json=utils._get_add_hold_json(200014))
+        assert resp.status_code == 404
+
+        # post wrong JSON for 400
+        resp = client.post(self.RESOURCE_URL, json=utils._get_patron_json())
+        assert resp.status_code == 400
+
+class TestHoldsOnBook(object):
+    """
+    This class implements tests for the GET method of holds on book resource.
+    """
+
+    RESOURCE_URL = "/inlibris/api/books/1/holds/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks that the queue is listed in order with
+        the positions of the holds, and that a nonexistent book results in
+        404.
+        """
+
+        client.post("/inlibris/api/patrons/4/holds/", json=utils._get_add_hold_json())
+        client.post("/inlibris/api/patrons/3/holds/", json=utils._get_add_hold_json())
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("inlibris:target-book", client, body)
+        utils._check_control_get_method("inlibris:loan-of", client, body)
+        assert [item["patron_barcode"] for item in body["items"]] == [100001, 100004, 100003]
+        assert [item["position"] for item in body["items"]] == [1, 2, 3]
+
+        resp = client.get("/inlibris/api/books/100/holds/")
+        assert resp.status_code == 404
+
+class TestHoldItem(object):
+    """
+    This class implements tests for each HTTP method in hold item resource,
+    and for moving the queue of a book forward.
+    """
+
+    RESOURCE_URL = "/inlibris/api/patrons/1/holds/1/"
+    WRONG_PATRON_URL = "/inlibris/api/patrons/2/holds/1/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the attributes and controls of the hold,
+        and that a hold of another patron results in 404.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("profile", client, body)
+        utils._check_control_get_method("author", client, body)
+        utils._check_control_get_method("inlibris:holds-by", client, body)
+        utils._check_control_get_method("inlibris:holds-on", client, body)
+        assert body["book_barcode"] == 200001
+        assert body["position"] == 1
+        assert body["@controls"]["inlibris:delete"]["method"] == "DELETE"
+
+        resp = client.get(self.WRONG_PATRON_URL)
+        assert resp.status_code == 404
+
+    def test_delete(self, client):
+        """
+        Tests the DELETE method and the promotion of the next hold. Cancels
+        and returns its way through the queue of a book and checks that the
+        next hold is always promoted and that borrowing the book fulfills it.
+        """
+
+        client.post("/inlibris/api/patrons/3/holds/", json=utils._get_add_hold_json())
+        client.post("/inlibris/api/patrons/4/holds/", json=utils._get_add_hold_json())
+
+        resp = client.delete(self.WRONG_PATRON_URL)
+        assert resp.status_code == 404
+        resp = client.delete(self.RESOURCE_URL)
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
+        body = json.loads(client.get("/inlibris/api/books/1/holds/").data)
+        assert [item["position"] for item in body["items"]] == [1, 2]
+
+        # returning the book promotes the first hold
+        resp = client.delete("/inlibris/api/books/1/loan/")
+        assert resp.status_code == 204
+        body = json.loads(client.get("/inlibris/api/books/1/holds/").data)
+        assert [item["patron_barcode"] for item in body["items"]] == [100003, 100004]
+        assert [item["status"] for item in body["items"]] == ["On hold", "Requested"]
+        assert [item["position"] for item in body["items"]] == [0, 1]
+
+        # cancelling the promoted hold promotes the next one
+        utils._check_control_delete_method("inlibris:delete", client,
+            json.loads(client.get(body["items"][0]["@controls"]["self"]["href"]).data)
+        )
+        body = json.loads(client.get("/inlibris/api/books/1/holds/").data)
+        assert [item["patron_barcode"] for item in body["items"]] == [100004]
+        assert body["items"][0]["status"] == "On hold"
+
+        # borrowing the book fulfills the hold
+        resp = client.post("/inlibris/api/patrons/4/loans/", json=utils._get_add_loan_json(200001))
+        assert resp.status_code == 201
+        body = json.loads(client.get("/inlibris/api/books/1/holds/").data)
+        assert body["items"] == []
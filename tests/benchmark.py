@@ -0,0 +1,434 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from sqlalchemy import exists
+
+from inlibris import create_app, db
+from inlibris.generate import generate_db
+from inlibris.models import Patron, Book, Loan, Hold
+
+'''
+Offline benchmark suite for the API. Builds a database for each of the
+dataset sizes with the generate-db generator, drives every resource of
+inlibris/api.py through the Flask test client and reports, per endpoint, the
+p50/p95/p99 latency, the throughput, the number of SQL statements per request
+and the peak memory allocated while serving a request.
+
+The results are written to a JSON file. Given a baseline file from an earlier
+run, the compare mode flags the endpoints that got slower, started running
+more queries or allocating more memory, and exits with status 1 if there are
+any such regressions.
+
+Run from the repository root:
+
+    python -m tests.benchmark --sizes 1k 100k --output results.json
+    python -m tests.benchmark --sizes 1k 100k --compare results.json
+
+The generated databases are kept in --db-dir and reused by later runs. The
+write endpoints undo their own changes (e.g. every POST is followed by a
+DELETE), so the same database gives comparable results every time.
+'''
+
+# Arguments of generate_db that give roughly the given number of rows in total
+SIZES = {
+    "1k": {"patrons": 100, "books": 500, "loans_ratio": 0.3, "holds_ratio": 0.5},
+    "100k": {"patrons": 10000, "books": 50000, "loans_ratio": 0.3, "holds_ratio": 0.5},
+    "1M": {"patrons": 50000, "books": 100000, "loans_ratio": 0.3, "holds_ratio": 8.2},
+}
+
+# Requests made for the memory measurement of each endpoint
+MEMORY_REQUESTS = 5
+
+'''
+The benchmarked endpoints. Each scenario is a function that makes the i:th
+request of the endpoint with the test client, using the ids and barcodes in
+"ctx". Scenarios whose requests are much slower than the others make at most
+the number of requests given in the "max_requests" attribute.
+'''
+
+def _pick(values, i):
+    return values[i % len(values)]
+
+def _book_document(book):
+    return {
+        "barcode": book.barcode,
+        "title": book.title,
+        "author": book.author,
+        "pubyear": book.pubyear,
+        "format": book.format,
+        "description": book.description,
+        "loantime": book.loantime,
+        "renewlimit": book.renewlimit
+    }
+
+def _patron_document(patron):
+    return {
+        "barcode": patron.barcode,
+        "firstname": patron.firstname,
+        "lastname": patron.lastname,
+        "email": patron.email,
+        "group": patron.group,
+        "status": patron.status
+    }
+
+def get_entrypoint(client, ctx, i):
+    return client.get("/inlibris/api/")
+
+def get_patrons(client, ctx, i):
+    return client.get("/inlibris/api/patrons/?after={}".format(_pick(ctx["patron_ids"], i)))
+
+def get_patrons_stream(client, ctx, i):
+    resp = client.get("/inlibris/api/patrons/?stream=true")
+    resp.get_data()
+    return resp
+get_patrons_stream.max_requests = 3
+
+def post_patron(client, ctx, i):
+    resp = client.post("/inlibris/api/patrons/", json={
+        "barcode": ctx["free_patron_barcode"],
+        "firstname": "Bench",
+        "email": "bench@example.com"
+    })
+    ctx["created_patron"] = resp.headers.get("Location")
+    return resp
+
+def get_patron(client, ctx, i):
+    return client.get("/inlibris/api/patrons/{}/".format(_pick(ctx["patron_ids"], i)))
+
+def put_patron(client, ctx, i):
+    patron_id, document = _pick(ctx["patron_documents"], i)
+    return client.put("/inlibris/api/patrons/{}/".format(patron_id), json=document)
+
+def delete_patron(client, ctx, i):
+    return client.delete(ctx["created_patron"])
+
+def get_books(client, ctx, i):
+    return client.get("/inlibris/api/books/?after={}".format(_pick(ctx["book_ids"], i)))
+
+def get_books_stream(client, ctx, i):
+    resp = client.get("/inlibris/api/books/?stream=true")
+    resp.get_data()
+    return resp
+get_books_stream.max_requests = 3
+
+def post_book(client, ctx, i):
+    resp = client.post("/inlibris/api/books/", json={
+        "barcode": ctx["free_book_barcode"],
+        "title": "Bench",
+        "pubyear": 2020
+    })
+    ctx["created_book"] = resp.headers.get("Location")
+    return resp
+
+def get_book(client, ctx, i):
+    return client.get("/inlibris/api/books/{}/".format(_pick(ctx["book_ids"], i)))
+
+def put_book(client, ctx, i):
+    book_id, document = _pick(ctx["book_documents"], i)
+    return client.put("/inlibris/api/books/{}/".format(book_id), json=document)
+
+def delete_book(client, ctx, i):
+    return client.delete(ctx["created_book"])
+
+def get_loans_by_patron(client, ctx, i):
+    return client.get("/inlibris/api/patrons/{}/loans/".format(_pick(ctx["borrower_ids"], i)))
+
+def post_loan(client, ctx, i):
+    return client.post(
+        "/inlibris/api/patrons/{}/loans/".format(_pick(ctx["patron_ids"], i)),
+        json={"book_barcode": _pick(ctx["free_books"], i)[1]}
+    )
+
+def get_loan(client, ctx, i):
+    return client.get("/inlibris/api/books/{}/loan/".format(_pick(ctx["loaned_book_ids"], i)))
+
+def put_loan(client, ctx, i):
+    book_id, document = _pick(ctx["loan_documents"], i)
+    return client.put("/inlibris/api/books/{}/loan/".format(book_id), json=document)
+
+def delete_loan(client, ctx, i):
+    return client.delete("/inlibris/api/books/{}/loan/".format(_pick(ctx["free_books"], i)[0]))
+
+def get_holds_on_book(client, ctx, i):
+    return client.get("/inlibris/api/books/{}/holds/".format(_pick(ctx["book_ids"], i)))
+
+# Pairs of scenarios are run interleaved, so that the second one undoes the
+# changes of the first one.
+SCENARIOS = [
+    ("GET /", get_entrypoint),
+    ("GET /patrons/", get_patrons),
+    ("GET /patrons/?stream=true", get_patrons_stream),
+    (("POST /patrons/", post_patron), ("DELETE /patrons/<patron_id>/", delete_patron)),
+    ("GET /patrons/<patron_id>/", get_patron),
+    ("PUT /patrons/<patron_id>/", put_patron),
+    ("GET /books/", get_books),
+    ("GET /books/?stream=true", get_books_stream),
+    (("POST /books/", post_book), ("DELETE /books/<book_id>/", delete_book)),
+    ("GET /books/<book_id>/", get_book),
+    ("PUT /books/<book_id>/", put_book),
+    ("GET /patrons/<patron_id>/loans/", get_loans_by_patron),
+    (("POST /patrons/<patron_id>/loans/", post_loan), ("DELETE /books/<book_id>/loan/", delete_loan)),
+    ("GET /books/<book_id>/loan/", get_loan),
+    ("PUT /books/<book_id>/loan/", put_loan),
+    ("GET /books/<book_id>/holds/", get_holds_on_book),
+]
+
+'''
+Building the databases and the benchmark context.
+'''
+
+def build_db(app, size):
+    with app.app_context():
+        db.create_all()
+        if Patron.query.first() is None:
+            generate_db(seed=0, **SIZES[size])
+
+def build_context(app, samples=50):
+    """
+    Collect the ids, barcodes and documents the scenarios use. Everything is
+    sampled evenly across the tables, so the requests don't only hit the
+    first pages of the database.
+    """
+
+    with app.app_context():
+        def spread(query, column):
+            total = query.count()
+            step = max(total // samples, 1)
+            return [row[0] for row in query.with_entities(column).order_by(column).all()[::step]][:samples]
+
+        patron_ids = spread(Patron.query, Patron.id)
+        book_ids = spread(Book.query, Book.id)
+        loaned_book_ids = spread(Loan.query, Loan.book_id)
+        borrower_ids = sorted(set(spread(Loan.query, Loan.patron_id)))
+
+        # Books that are not loaned and have no holds, so that loaning one
+        # isn't refused for another patron's hold and returning it doesn't
+        # promote a hold that the benchmark can't undo
+        free_books = [
+            (book.id, book.barcode) for book in Book.query
+            .filter(~exists().where(Loan.book_id == Book.id))
+            .filter(~exists().where(Hold.book_id == Book.id))
+            .order_by(Book.id)
+            .limit(samples)
+        ]
+        used_patron_barcodes = set(row[0] for row in db.session.query(Patron.barcode))
+        used_book_barcodes = set(row[0] for row in db.session.query(Book.barcode))
+
+        loan_documents = []
+        for book_id in loaned_book_ids:
+            loan = Loan.query.filter_by(book_id=book_id).first()
+            loan_documents.append((book_id, {
+                "patron_barcode": loan.patron.barcode,
+                "loandate": loan.loandate.strftime("%Y-%m-%d"),
+                "duedate": loan.duedate.strftime("%Y-%m-%d"),
+                "renewed": loan.renewed,
+                "status": loan.status
+            }))
+
+        return {
+            "patron_ids": patron_ids,
+            "book_ids": book_ids,
+            "loaned_book_ids": loaned_book_ids,
+            "borrower_ids": borrower_ids,
+            "free_books": free_books,
+            "free_patron_barcode": next(
+                b for b in range(199999, 99999, -1) if b not in used_patron_barcodes
+            ),
+            "free_book_barcode": next(
+                b for b in range(299999, 199999, -1) if b not in used_book_barcodes
+            ),
+            "patron_documents": [
+                (patron_id, _patron_document(Patron.query.filter_by(id=patron_id).first())) for patron_id in patron_ids
+            ],
+            "book_documents": [
+                (book_id, _book_document(Book.query.filter_by(id=book_id).first())) for book_id in book_ids
+            ],
+            "loan_documents": loan_documents,
+        }
+
+'''
+Measuring.
+'''
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile "p" (0-100) of a non-empty list of numbers.
+    """
+
+    ordered = sorted(values)
+    rank = max(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def _call(app, client, ctx, scenario, i):
+    with app.app_context():
+        start = time.perf_counter()
+        resp = scenario(client, ctx, i)
+        elapsed = time.perf_counter() - start
+    if resp.status_code >= 400:
+        raise RuntimeError("{} returned {}: {}".format(
+            scenario.__name__, resp.status_code, resp.get_data(as_text=True)[:200]
+        ))
+    return elapsed, int(resp.headers.get("X-Query-Count", 0))
+
+def run_scenarios(app, ctx, group, requests):
+    """
+    Run a scenario, or a pair of scenarios interleaved, and return the
+    measurements of each as a dictionary keyed by the endpoint name.
+    """
+
+    client = app.test_client()
+    requests = min([requests] + [getattr(s, "max_requests", requests) for _, s in group])
+    timings = dict((name, []) for name, _ in group)
+    queries = dict((name, []) for name, _ in group)
+    peaks = dict((name, 0) for name, _ in group)
+
+    # Warm up the caches of SQLite and Python
+    for name, scenario in group:
+        _call(app, client, ctx, scenario, 0)
+
+    started = time.perf_counter()
+    for i in range(requests):
+        for name, scenario in group:
+            elapsed, count = _call(app, client, ctx, scenario, i)
+            timings[name].append(elapsed)
+            queries[name].append(count)
+    wall = time.perf_counter() - started
+
+    tracemalloc.start()
+    for i in range(min(MEMORY_REQUESTS, requests)):
+        for name, scenario in group:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            _call(app, client, ctx, scenario, i)
+            peaks[name] = max(peaks[name], tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    results = {}
+    for name, _ in group:
+        results[name] = {
+            "requests": requests,
+            "p50_ms": percentile(timings[name], 50) * 1000,
+            "p95_ms": percentile(timings[name], 95) * 1000,
+            "p99_ms": percentile(timings[name], 99) * 1000,
+            # Interleaved pairs share the wall time, so their throughput is
+            # computed from their own latencies instead.
+            "throughput_rps": requests / (wall if len(group) == 1 else sum(timings[name])),
+            "queries": max(queries[name]),
+            "peak_memory_kb": peaks[name] / 1024.0,
+        }
+    return results
+
+def run_size(size, db_dir, requests, cache):
+    db_fname = os.path.join(db_dir, "inlibris-benchmark-{}.db".format(size))
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "QUERY_COUNT_HEADER": True,
+        "RESPONSE_CACHE_BACKEND": "lru" if cache else "null",
+    })
+    build_db(app, size)
+    ctx = build_context(app)
+
+    results = {}
+    for scenario in SCENARIOS:
+        group = scenario if isinstance(scenario[0], tuple) else (scenario,)
+        results.update(run_scenarios(app, ctx, group, requests))
+
+    with app.app_context():
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return results
+
+'''
+Comparing against a baseline.
+'''
+
+def compare(baseline, current, threshold, min_delta_ms=1.0):
+    """
+    Return the regressions of "current" against "baseline" as a list of
+    strings. Latency and memory regress when they grow more than "threshold"
+    (a fraction), the query count regresses when it grows at all. Latency
+    changes smaller than "min_delta_ms" are ignored as noise.
+    """
+
+    regressions = []
+    for size, endpoints in current["results"].items():
+        for name, result in endpoints.items():
+            old = baseline.get("results", {}).get(size, {}).get(name)
+            if old is None:
+                continue
+            for key in ("p95_ms", "peak_memory_kb"):
+                if key == "p95_ms" and result[key] - old[key] < min_delta_ms:
+                    continue
+                if old[key] > 0 and result[key] > old[key] * (1 + threshold):
+                    regressions.append("{} {}: {} {:.2f} -> {:.2f}".format(
+                        size, name, key, old[key], result[key]
+                    ))
+            if result["queries"] > old["queries"]:
+                regressions.append("{} {}: queries {} -> {}".format(
+                    size, name, old["queries"], result["queries"]
+                ))
+    return regressions
+
+def print_results(results):
+    print("{:<6} {:<36} {:>9} {:>9} {:>9} {:>9} {:>7} {:>10}".format(
+        "size", "endpoint", "p50 ms", "p95 ms", "p99 ms", "req/s", "queries", "peak KiB"
+    ))
+    for size, endpoints in results.items():
+        for name, r in endpoints.items():
+            print("{:<6} {:<36} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>7} {:>10.1f}".format(
+                size, name, r["p50_ms"], r["p95_ms"], r["p99_ms"],
+                r["throughput_rps"], r["queries"], r["peak_memory_kb"]
+            ))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints")
+    parser.add_argument("--sizes", nargs="+", default=["1k", "100k"], choices=sorted(SIZES))
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--db-dir", default=tempfile.gettempdir(),
+                        help="where the generated databases are kept")
+    parser.add_argument("--cache", action="store_true", help="enable the response cache")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative growth of latency and memory in compare mode")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="ignore latency changes smaller than this in compare mode")
+    args = parser.parse_args()
+
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "cache": args.cache,
+        },
+        "results": {},
+    }
+    for size in args.sizes:
+        report["results"][size] = run_size(size, args.db_dir, args.requests, args.cache)
+
+    print_results(report["results"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold, args.min_delta_ms)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,13 @@ import tempfile
 import time
 from datetime import datetime, timedelta
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, inspect, text
 from sqlalchemy.exc import IntegrityError, StatementError
+from sqlalchemy.orm.exc import StaleDataError
 
 from inlibris import create_app, db
-from inlibris.models import Patron, Book, Hold, Loan
+from inlibris.models import Patron, Book, Hold, Loan, get_versions, upgrade_db_command, generate_db_command
+from inlibris.sweep import sweep, sweep_command
 from tests import utils
 
 
@@ -567,3 +569,284 @@ def test_delete_loan(app):
         assert Book.query.count() == 1
         assert Patron.query.count() == 1
         assert Loan.query.count() == 0
+
+def test_change_counters(app):
+    """
+    Tests that the change counters are created with the tables and that
+    writes through the session bump the counters of the written tables,
+    including the tables a delete cascades to.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        start = get_versions(["patron", "book", "loan", "hold"])
+        assert len(set(start)) == 1
+
+        patron = utils._get_patron()
+        db.session.add(patron)
+        db.session.commit()
+        assert get_versions(["patron", "book"]) == [start[0] + 1, start[1]]
+
+        book = utils._get_book()
+        loan = utils._get_loan()
+        loan.patron = patron
+        loan.book = book
+        db.session.add(loan)
+        db.session.commit()
+        assert get_versions(["patron", "book", "loan"]) == [start[0] + 2, start[1] + 1, start[2] + 1]
+
+        db.session.delete(book)
+        db.session.commit()
+        assert get_versions(["book", "loan", "hold"]) == [start[1] + 2, start[2] + 2, start[3] + 1]
+
+def test_indexes(app):
+    """
+    Tests that looking up loans by patron and holds by book, moving the hold
+    queues, scanning loans and holds by date and searching patrons by
+    barcode, name and email prefix use the indexes instead of scanning the
+    tables.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        queries = [
+            "SELECT * FROM loan WHERE patron_id = 1",
+            "SELECT * FROM hold WHERE book_id = 1",
+            "SELECT * FROM hold WHERE patron_id = 1",
+            # position in the hold queue and the next hold to promote
+            "SELECT count(id) FROM hold WHERE book_id = 1 AND status = 'Requested' AND id < 10",
+            "SELECT min(id) FROM hold WHERE book_id IN (1, 2) AND status = 'Requested' GROUP BY book_id",
+            "SELECT * FROM loan WHERE status = 'Charged' AND duedate < '2020-01-01'",
+            "SELECT * FROM hold WHERE status = 'Requested' AND expirationdate < '2020-01-01'",
+            "SELECT * FROM patron WHERE barcode BETWEEN 100000 AND 100999",
+            "SELECT * FROM patron WHERE firstname LIKE 'sal%' ESCAPE '\\' "
+            "OR lastname LIKE 'sal%' ESCAPE '\\' OR email LIKE 'sal%' ESCAPE '\\'",
+        ]
+        for query in queries:
+            plan = " ".join(row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + query)))
+            assert "INDEX" in plan
+            assert "SCAN" not in plan
+
+def test_upgrade_db(app):
+    """
+    Tests that the upgrade-db command creates the missing indexes and the
+    full-text index of an existing database and keeps its data.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(utils._get_patron())
+        db.session.add(utils._get_book())
+        db.session.commit()
+        db.session.execute(text("DROP INDEX ix_loan_patron_id"))
+        db.session.execute(text("DROP INDEX ix_hold_status_expirationdate"))
+        db.session.execute(text("DROP TABLE book_fts"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(upgrade_db_command)
+    assert "created 3 indexes" in result.output
+
+    with app.app_context():
+        names = [index["name"] for index in inspect(db.engine).get_indexes("loan")]
+        assert "ix_loan_patron_id" in names
+        assert Patron.query.count() == 1
+        # the books that existed before are in the new full-text index
+        rows = db.session.execute(text("SELECT rowid FROM book_fts WHERE book_fts MATCH 'testikirja'"))
+        assert len(rows.fetchall()) == 1
+
+    result = app.test_cli_runner().invoke(upgrade_db_command)
+    assert "created 0 indexes" in result.output
+
+def test_generate_db(app):
+    """
+    Tests that the generate-db command replaces the database with the
+    requested number of rows, that the barcodes are valid, that the same
+    seed gives the same rows and that invalid arguments leave the database
+    as it was.
+    """
+    args = ["--patrons", "50", "--books", "200", "--loans-ratio", "0.25",
+            "--holds-ratio", "2", "--seed", "7", "--batch-size", "64"]
+    result = app.test_cli_runner().invoke(generate_db_command, args)
+    assert "50 patrons, 200 books, 50 loans, 400 holds" in result.output
+
+    with app.app_context():
+        assert Patron.query.count() == 50
+        assert Book.query.count() == 200
+        assert Loan.query.count() == 50
+        assert Hold.query.count() == 400
+        assert all(100000 <= p.barcode <= 199999 for p in Patron.query.all())
+        assert all(200000 <= b.barcode <= 299999 for b in Book.query.all())
+        first = [(b.barcode, b.title) for b in Book.query.order_by(Book.id)]
+
+        # the first hold on each book that is not loaned is kept for pickup
+        loaned = set(loan.book_id for loan in Loan.query)
+        for book_id in set(hold.book_id for hold in Hold.query):
+            statuses = [hold.status for hold in Hold.query.filter_by(book_id=book_id).order_by(Hold.id)]
+            if book_id in loaned:
+                assert set(statuses) == {"Requested"}
+            else:
+                assert statuses[0] == "On hold"
+                assert set(statuses[1:]) <= {"Requested"}
+
+    app.test_cli_runner().invoke(generate_db_command, args)
+    with app.app_context():
+        assert [(b.barcode, b.title) for b in Book.query.order_by(Book.id)] == first
+
+    result = app.test_cli_runner().invoke(generate_db_command, ["--books", "100001"])
+    assert result.exit_code != 0
+    result = app.test_cli_runner().invoke(generate_db_command, ["--loans-ratio", "2"])
+    assert result.exit_code != 0
+    with app.app_context():
+        assert Book.query.count() == 200
+        assert Patron.query.count() == 50
+
+def test_version_column(app):
+    """
+    Tests that the version of a row is bumped by every UPDATE through the
+    session, and that an UPDATE of a row that was changed after it was read
+    fails with StaleDataError.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        book = utils._get_book()
+        db.session.add(book)
+        db.session.commit()
+        assert book.version == 1
+
+        book.title = "Toinen kirja"
+        db.session.commit()
+        assert book.version == 2
+
+        # another writer changes the row behind the session's back
+        book.title = "Kolmas kirja"
+        db.session.execute(text("UPDATE book SET version = version + 1"))
+        with pytest.raises(StaleDataError):
+            db.session.commit()
+        db.session.rollback()
+
+def test_sweep(app):
+    """
+    Tests that a sweep in small batches expires the holds and pickups that
+    are past their dates, promotes the next hold of a book that was not
+    picked up and marks the overdue loans late, and that a second sweep
+    changes nothing.
+    """
+    today = datetime(2020, 5, 1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        patrons = [utils._get_patron(barcode=123450 + i, email="sweep{}@test.com".format(i)) for i in range(3)]
+        books = [utils._get_book(barcode=234560 + i) for i in range(5)]
+        db.session.add_all(patrons + books)
+        for i, book in enumerate(books):
+            db.session.add(Loan(
+                book=book, patron=patrons[0], loandate=datetime(2020, 4, 1),
+                duedate=today - timedelta(days=i - 1), status="Charged" if i % 2 else "Renewed"
+            ))
+        db.session.add(Hold(book=books[0], patron=patrons[1], holddate=datetime(2020, 3, 1),
+            expirationdate=today - timedelta(days=1)))
+        db.session.add(Hold(book=books[0], patron=patrons[2], holddate=datetime(2020, 3, 1),
+            expirationdate=today))
+        db.session.commit()
+
+        # return one book whose first hold is kept past its pickup date
+        db.session.delete(books[1].loan[0])
+        db.session.add(Hold(book=books[1], patron=patrons[1], holddate=datetime(2020, 3, 1),
+            expirationdate=today + timedelta(days=30), status="On hold", pickupdate=today - timedelta(days=1)))
+        db.session.add(Hold(book=books[1], patron=patrons[2], holddate=datetime(2020, 3, 2),
+            expirationdate=today + timedelta(days=30)))
+        # and a loaned book, whose next hold must wait for the return
+        db.session.add(Hold(book=books[2], patron=patrons[1], holddate=datetime(2020, 3, 1),
+            expirationdate=today + timedelta(days=30), status="On hold", pickupdate=today - timedelta(days=2)))
+        db.session.add(Hold(book=books[2], patron=patrons[2], holddate=datetime(2020, 3, 2),
+            expirationdate=today + timedelta(days=30)))
+        db.session.commit()
+
+        counts = sweep(today=today.date(), batch_size=1)
+        assert counts == {"expired_holds": 1, "expired_pickups": 2, "promoted_holds": 1, "late_loans": 3}
+        db.session.expire_all()
+        assert [h.status for h in books[0].holds] == ["Expired", "Requested"]
+        assert [h.status for h in books[1].holds] == ["Expired", "On hold"]
+        assert [h.status for h in books[2].holds] == ["Expired", "Requested"]
+        assert books[1].holds[1].pickupdate > today
+        assert [book.loan[0].status for book in books if book.loan] == ["Renewed", "Late", "Late", "Late"]
+
+        counts = sweep(today=today.date(), batch_size=1)
+        assert counts == {"expired_holds": 0, "expired_pickups": 0, "promoted_holds": 0, "late_loans": 0}
+
+    result = app.test_cli_runner().invoke(sweep_command, ["--batch-size", "10"])
+    assert result.exit_code == 0
+    assert "Swept the database" in result.output
+
+    # a batch size below 1 would never finish
+    result = app.test_cli_runner().invoke(sweep_command, ["--batch-size", "0"])
+    assert result.exit_code != 0
+    with app.app_context():
+        with pytest.raises(ValueError):
+            sweep(batch_size=-1)
+    with pytest.raises(ValueError):
+        create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True, "SWEEP_BATCH_SIZE": 0})
+
+def test_sqlite_profile():
+    """
+    Tests that the PRAGMAs of the production profile, with overrides from the
+    config, are set on the connections of the engine.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLITE_PROFILE": "production",
+        "SQLITE_PRAGMAS": {"busy_timeout": 1234}
+    })
+
+    with app.app_context():
+        pragma = lambda name: db.session.execute(text("PRAGMA " + name)).scalar()
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1
+        assert pragma("busy_timeout") == 1234
+        assert pragma("foreign_keys") == 1
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_slow_query_log(tmp_path):
+    """
+    Tests that the statements over the threshold are written to the slow
+    query log with their parameters, endpoint and query plan.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    log_fname = str(tmp_path / "slow.log")
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SLOW_QUERY_THRESHOLD": 0,
+        "SLOW_QUERY_LOG": log_fname
+    })
+
+    with app.app_context():
+        db.create_all()
+        utils._populate_db(db)
+        db.session.remove()
+
+    resp = app.test_client().get("/inlibris/api/patrons/2/loans/")
+    assert resp.status_code == 200
+    app.extensions["slow_query_log"].stop()
+
+    with open(log_fname) as f:
+        log = f.read()
+    assert "GET api.loansbypatron\n  SELECT" in log
+    assert "parameters: (2, " in log
+    assert "USING INDEX ix_loan_patron_id" in log
+    assert "(not explained)" in log
+
+    with app.app_context():
+        db.get_engine(app).dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
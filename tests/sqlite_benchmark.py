@@ -0,0 +1,102 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from inlibris import create_app, db
+from inlibris.models import Book
+from inlibris.engine import SQLITE_PROFILES
+
+'''
+Small benchmark that compares the SQLite connection profiles under concurrent
+traffic. Each profile gets a fresh database file and the same number of
+threads, and every thread mixes book page reads with book edits through the
+test client. Prints the throughput and the number of failed requests (e.g.
+"database is locked") for each profile.
+
+Run from the repository root:
+
+    python -m tests.sqlite_benchmark --threads 8 --operations 200
+'''
+
+def _create_db(app, books):
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Book.__table__.insert(), [
+            {"barcode": 200000 + i, "title": "Book {}".format(i), "pubyear": 2000}
+            for i in range(books)
+        ])
+        db.session.commit()
+
+def _worker(app, thread_no, operations, books, writes_every, results):
+    client = app.test_client()
+    ok = failed = 0
+    for i in range(operations):
+        if i % writes_every == 0:
+            book_id = (thread_no * operations + i) % books + 1
+            resp = client.put(
+                "/inlibris/api/books/{}/".format(book_id),
+                json={"barcode": 200000 + book_id - 1, "title": "Edit {}".format(i), "pubyear": 2001}
+            )
+        else:
+            resp = client.get("/inlibris/api/books/?limit=50&after={}".format(i % books))
+        if resp.status_code < 400:
+            ok += 1
+        else:
+            failed += 1
+    results[thread_no] = (ok, failed)
+
+def run_profile(profile, threads, operations, books, writes_every):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_PROFILE": profile,
+        "RESPONSE_CACHE_BACKEND": "null",
+    })
+    _create_db(app, books)
+
+    results = {}
+    workers = [
+        threading.Thread(target=_worker, args=(app, n, operations, books, writes_every, results))
+        for n in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        db.session.remove()
+        db.get_engine(app).dispose()
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+    ok = sum(r[0] for r in results.values())
+    failed = sum(r[1] for r in results.values())
+    return ok, failed, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SQLite connection profiles")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--operations", type=int, default=200, help="requests per thread")
+    parser.add_argument("--books", type=int, default=2000)
+    parser.add_argument("--writes-every", type=int, default=5, help="every Nth request is a PUT")
+    parser.add_argument("--profiles", nargs="+", default=sorted(SQLITE_PROFILES))
+    args = parser.parse_args()
+
+    print("{:<12} {:>10} {:>8} {:>10}".format("profile", "req/s", "failed", "seconds"))
+    for profile in args.profiles:
+        ok, failed, elapsed = run_profile(
+            profile, args.threads, args.operations, args.books, args.writes_every
+        )
+        print("{:<12} {:>10.1f} {:>8} {:>10.2f}".format(
+            profile, (ok + failed) / elapsed, failed, elapsed
+        ))
+
+if __name__ == "__main__":
+    main()
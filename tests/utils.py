@@ -266,6 +266,13 @@ def _get_add_loan_json(book_barcode=200007):
     
     return {"book_barcode": book_barcode}
 
+def _get_add_hold_json(book_barcode=200001):
+    """
+    Creates a valid hold JSON object to be used for POST tests.
+    """
+    
+    return {"book_barcode": book_barcode}
+
 def _get_edit_loan_json(book_barcode=200001, patron_barcode=100002):
     """
     Creates a valid loan JSON object to be used for PUT tests.